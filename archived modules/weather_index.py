@@ -9,6 +9,7 @@ from pprint import pprint
 import requests
 from elasticsearch import Elasticsearch
 from dl_data import *
+from wellcamp_urls import data_url, image_url
 
 # from time import sleep
 
@@ -84,7 +85,7 @@ def create_index(es_object, index_name):
 def store_record(elastic_object, index_name, record):
     is_stored = True
     try:
-        outcome = elastic_object.index(index=index_name, id=my_id, body=record)  # doc_type='observation',
+        outcome = elastic_object.index(index=index_name, id=record.doc_id, body=record.to_dict())  # doc_type='observation',
         print(outcome)
     except Exception as ex:
         print('Error in indexing data')
@@ -105,7 +106,7 @@ def connect_elasticsearch():
 
 
 def get_data():
-    weather_data = {}
+    weather_data = None
     # what happens if data download fails???
     try:
         weather_data = DownloadData().dl_weather(data_url, image_url)
@@ -127,11 +128,10 @@ if __name__ == '__main__':
     es = connect_elasticsearch()
 
     # Get data from website:
-    result = eval(str(get_data()))
+    result = get_data()
 
     # create index and stick data in it?
-    my_id = (str(result['local_date_time_full']))
-    if es is not None:
+    if es is not None and result:
         if create_index(es, 'weather_index'):
             out = store_record(es, 'weather_index', result)
             print('Data indexed successfully')
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+"""Backfill Missing Observations
+
+Every download of a station's data from the BOM website contains about
+the last 72 hours of half-hourly observations, not just the most recent
+one.  This script uses that history to fill in any observations that are
+missing from the Elasticsearch index (e.g. after the app or
+Elasticsearch was down for a while).
+
+For each station the whole history is downloaded once, the document ids
+are checked against the index in one request, and only the missing
+observations are added using the Elasticsearch bulk API in batches.
+
+This script requires that `elasticsearch` be installed within the
+Python environment you are running this script in (except to save
+through a sink, see sinks.py), and uses the custom modules `collector`
+and `stations`.
+
+This file can be imported as a module and contains the following
+functions:
+
+    * missing_observations - returns the observations not yet indexed
+    * bulk_create - adds observations to the index in batches
+    * backfill - fills in the missing observations for every station
+
+It can also be run from the command line:
+
+    python backfill.py [--index weather_write] [--search-index weather]
+        [--wmo 99435 ...]
+"""
+
+import argparse
+
+from collector import Collector
+from index_admin import existing_ids
+from stations import StationRegistry
+
+# the size of each batch sent to the bulk API, in documents and in bytes
+CHUNK_SIZE = 500
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+
+def missing_observations(es_object, index_name, observations):
+    # one request to find which of the document ids are already indexed
+    # (a search rather than mget so it works across every partition)
+    if not observations:
+        return []
+    found = existing_ids(es_object, [o.doc_id for o in observations], index_name)
+    return [o for o in observations if o.doc_id not in found]
+
+
+def bulk_create(es_object, index_name, observations, chunk_size=CHUNK_SIZE,
+                max_chunk_bytes=MAX_CHUNK_BYTES):
+    from elasticsearch import helpers
+
+    # 'create' never overwrites a document, so anything indexed between
+    # the check above and this request is left alone (409 is ignored)
+    actions = ({"_op_type": "create", "_index": index_name,
+                "_id": o.doc_id, "_source": o.to_dict()} for o in observations)
+    created = 0
+    failed = 0
+    for ok, item in helpers.streaming_bulk(es_object, actions, chunk_size=chunk_size,
+                                           max_chunk_bytes=max_chunk_bytes,
+                                           raise_on_error=False):
+        if ok:
+            created += 1
+        elif item.get("create", {}).get("status") != 409:
+            failed += 1
+            print('Error in indexing data: ' + str(item))
+    return created, failed
+
+
+def backfill(es_object, index_name, stations=None, ledger=None, collector=None,
+             include_latest=True, search_index=None, cadence=None, rollups=None, sink=None):
+    """
+    Fills in the observations missing from `index_name` for every
+    station in `stations` (every station in the registry, or of
+    `collector`, by default).  Returns the total number of observations
+    that were added.  If `include_latest` is False the most recent
+    observation is left for the weather app to index along with its
+    image.  `search_index` is the index (or alias) searched for
+    observations that are already indexed, if it isn't `index_name`
+    (e.g. the read alias of partitioned indices).  If `cadence` (a
+    CadenceScheduler, see cadence.py) is given it learns when each
+    station publishes from the downloaded history, and if `rollups` (a
+    RollupEngine, see rollups.py) is given the history is added to the
+    hourly and daily rollups.  If `sink` (see sinks.py) is given the
+    observations are saved through it instead of into `index_name` (the
+    sink skips observations it already has).
+    """
+
+    if collector is None:
+        collector = Collector(stations)
+    total = 0
+    # a collector that is passed in only downloads `stations` (if given)
+    for station, history in collector.collect_history(stations):
+        if cadence is not None and history:
+            cadence.learn(station, history)
+        if rollups is not None:
+            rollups.add(history)
+        if not include_latest:
+            history = history[1:]
+        if not history:
+            continue
+        try:
+            if sink is not None:
+                created, failed = sink.store_many(history)
+            else:
+                missing = missing_observations(es_object, search_index or index_name, history)
+                created, failed = bulk_create(es_object, index_name, missing)
+        except Exception as ex:
+            print('Error in backfilling station ' + str(station.wmo))
+            print(str(ex))
+            continue
+        total += created
+        print('Station ' + str(station.wmo) + ': ' + str(len(history)) +
+              ' observations, ' + str(created) + ' added')
+        if ledger is not None and include_latest and not failed:
+            ledger.record(station.wmo, history[0].doc_id)
+    if ledger is not None:
+        ledger.flush()
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in observations missing from the index")
+    parser.add_argument("--index", default="weather_write",
+                        help="index or write alias to add observations to")
+    parser.add_argument("--search-index", default="weather",
+                        help="index or read alias to look for existing observations in")
+    parser.add_argument("--wmo", type=int, nargs="*",
+                        help="WMO numbers of the stations (default: all in the registry)")
+    args = parser.parse_args()
+
+    from weather_app import connect_elasticsearch, ensure_index
+    from ledger import StoredIdLedger
+
+    registry = StationRegistry()
+    selected = [registry.get(w) for w in args.wmo] if args.wmo else list(registry)
+    es = connect_elasticsearch()
+    if ensure_index(es, args.index):
+        print(str(backfill(es, args.index, [s for s in selected if s], StoredIdLedger(),
+                           search_index=args.search_index)) +
+              ' observations added')
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""Check and Benchmark of Station Discovery
+
+This script checks discovery.py without using the BOM website, and
+measures how much faster the k-d tree (StationTree) finds the nearest
+stations than comparing a location with every station:
+
+    * parse_listing - reads the stations from the saved Queensland
+        listing page in `fixtures/qldall.shtml`
+    * Discovery - adds those stations to an empty registry, reading
+        their saved observations in `fixtures` (fixture_fetcher), then
+        runs again to check that stations with a location are skipped
+        (and updated with `refresh`)
+    * StationTree - finds the nearest stations to `--queries` random
+        locations among `--stations` random stations, for several `n`
+        and `max_km`, and compares every answer with a brute force
+        search of every station using the haversine formula
+
+For the tree it reports the queries per second of both searches.  The
+script prints every mismatch and exits with status 1 if there are any,
+so it can be run to check a change to discovery.py.
+
+This script only requires modules from the Python standard library.
+
+Usage:
+
+    python bench_discovery.py [--stations 2000] [--queries 500] [--seed 1]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+FIXTURES = os.path.join(HERE, "fixtures")
+
+import discovery
+from stations import Station, StationRegistry
+
+PRODUCT = "IDQ60801"
+
+# the stations on fixtures/qldall.shtml, and the name and location in
+# each station's saved observations
+LISTED = [(94576, "Brisbane"), (94568, "Amberley"), (94552, "Oakey"),
+          (99435, "Toowoomba Wellcamp")]
+DETAILS = {94576: ("Brisbane", -27.5, 153.0), 94568: ("Amberley", -27.6, 152.7),
+           94552: ("Oakey", -27.4, 151.7), 99435: ("Toowoomba Wellcamp Airport", -27.6, 151.8)}
+
+# (n, max_km) of each search checked against brute force
+SEARCHES = [(1, None), (5, None), (5, 50), (20, 500), (3, 0.001)]
+
+# distances that differ by less than this (km) are the same
+TOLERANCE_KM = 1e-6
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+        print("  FAIL " + message)
+
+
+def check_listing(failures):
+    with open(os.path.join(FIXTURES, "qldall.shtml"), "rb") as f:
+        page = f.read()
+    listed = discovery.parse_listing(page, PRODUCT)
+    check(failures, listed == LISTED, "parse_listing returned %r" % (listed,))
+    check(failures, discovery.parse_listing(page.decode("utf-8"), PRODUCT) == LISTED,
+          "parse_listing of a str differs from bytes")
+    other = discovery.parse_listing(page, "IDN60801")
+    check(failures, other == [], "parse_listing of another product returned %r" % (other,))
+    print("parse_listing: %d stations" % len(listed))
+
+
+def check_discovery(failures):
+    work = tempfile.mkdtemp(prefix="bench_discovery_")
+    path = os.path.join(work, "stations.json")
+    finder = discovery.Discovery(StationRegistry(path),
+                                 fetch=discovery.fixture_fetcher(FIXTURES))
+    counts = finder.discover([PRODUCT])
+    check(failures, counts["listed"] == 4 and counts["added"] == 4 and not counts["failed"],
+          "first discover counted %r" % (counts,))
+
+    # read back from the saved registry, as the weather app would
+    registry = StationRegistry(path)
+    for wmo, (name, lat, lon) in DETAILS.items():
+        station = registry.get(wmo)
+        if station is None:
+            check(failures, False, "station %d wasn't saved" % wmo)
+            continue
+        check(failures, (station.name, station.lat, station.lon) == (name, lat, lon),
+              "station %d saved as %r" % (wmo, (station.name, station.lat, station.lon)))
+        check(failures, station.data_url == discovery.data_url(PRODUCT, wmo),
+              "station %d has data_url %s" % (wmo, station.data_url))
+        check(failures, station.timezone == discovery.PRODUCTS[PRODUCT][1],
+              "station %d has timezone %s" % (wmo, station.timezone))
+
+    finder = discovery.Discovery(registry, fetch=discovery.fixture_fetcher(FIXTURES))
+    counts = finder.discover([PRODUCT])
+    check(failures, counts["skipped"] == 4 and counts["added"] == 0,
+          "second discover counted %r" % (counts,))
+    counts = finder.discover([PRODUCT], refresh=True)
+    check(failures, counts["updated"] == 4 and counts["added"] == 0,
+          "discover with refresh counted %r" % (counts,))
+    counts = finder.discover(["IDN60801"])
+    check(failures, counts["failed"] == 1 and counts["listed"] == 0,
+          "discover of a product without a saved page counted %r" % (counts,))
+    print("Discovery: %d stations in the registry" % len(registry))
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * discovery.EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def brute_force(stations, lat, lon, n, max_km):
+    found = [(haversine_km(lat, lon, s.lat, s.lon), s) for s in stations]
+    if max_km is not None:
+        found = [f for f in found if f[0] <= max_km]
+    found.sort(key=lambda f: (f[0], f[1].wmo))
+    return found[:n]
+
+
+def same(lat, lon, expected, got):
+    # the same distances, each station returned really is that far away
+    # and none is returned twice; stations the same distance away (e.g.
+    # in the same place) can come in either order, or either be left out
+    # at the n-th place
+    if len(expected) != len(got) or len({s.wmo for _, s in got}) != len(got):
+        return False
+    return all(abs(km1 - km2) <= TOLERANCE_KM and
+               abs(haversine_km(lat, lon, s.lat, s.lon) - km2) <= TOLERANCE_KM
+               for (km1, _), (km2, s) in zip(expected, got))
+
+
+def random_stations(rng, count):
+    # mostly around Australia, with some anywhere on the earth (e.g.
+    # near the poles and either side of longitude 180)
+    stations = []
+    for i in range(count):
+        if i % 4:
+            lat, lon = rng.uniform(-44, -10), rng.uniform(112, 154)
+        else:
+            lat, lon = math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180)
+        stations.append(Station(100000 + i, "", None, "", None, round(lat, 4), round(lon, 4)))
+    # stations in the same place, and one without a location
+    stations.append(Station(200000, "", None, "", None, stations[0].lat, stations[0].lon))
+    stations.append(Station(200001, "", None, "", None, None, None))
+    return stations
+
+
+def check_tree(failures, count, queries, seed):
+    rng = random.Random(seed)
+    stations = random_stations(rng, count)
+    located = [s for s in stations if s.lat is not None]
+    tree = discovery.StationTree(stations)
+    check(failures, len(tree) == len(located), "tree has %d stations" % len(tree))
+    points = [(rng.uniform(-44, -10), rng.uniform(112, 154)) for _ in range(queries // 2)]
+    points += [(math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180))
+               for _ in range(queries - len(points))]
+    # a location exactly on a station
+    points.append((located[0].lat, located[0].lon))
+
+    mismatches = 0
+    for n, max_km in SEARCHES:
+        for lat, lon in points:
+            expected = brute_force(located, lat, lon, n, max_km)
+            got = tree.nearest(lat, lon, n=n, max_km=max_km)
+            if not same(lat, lon, expected, got):
+                mismatches += 1
+                if mismatches <= 10:
+                    check(failures, False, "nearest(%r, %r, n=%d, max_km=%r): %r, expected %r" % (
+                        lat, lon, n, max_km, [(round(k, 3), s.wmo) for k, s in got],
+                        [(round(k, 3), s.wmo) for k, s in expected]))
+    if mismatches > 10:
+        check(failures, False, "%d more mismatches" % (mismatches - 10))
+    print("StationTree: %d stations, %d searches, %d mismatches with brute force"
+          % (len(tree), len(points) * len(SEARCHES), mismatches))
+
+    for name, search in (("tree", lambda lat, lon: tree.nearest(lat, lon, n=5)),
+                         ("brute force", lambda lat, lon: brute_force(located, lat, lon, 5, None))):
+        start = time.perf_counter()
+        for lat, lon in points:
+            search(lat, lon)
+        elapsed = time.perf_counter() - start
+        print("  {:<12}{:>12.0f} queries/s".format(name, len(points) / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark station discovery")
+    parser.add_argument("--stations", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    failures = []
+    check_listing(failures)
+    check_discovery(failures)
+    check_tree(failures, args.stations, args.queries, args.seed)
+    if failures:
+        print("\n%d checks failed" % len(failures))
+        return 1
+    print("\nAll checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""Check and Benchmark of Image Packs
+
+This script checks that an image pack (see image_pack.py) recovers from
+the app stopping part way through adding a frame, by writing a small
+pack and then opening copies of it with the end of its files torn off
+or damaged:
+
+    * the index cut at every byte (a part-written entry), with the whole
+        pack
+    * the pack cut at every byte (a part-written frame), with the whole
+        index
+    * `--torn` random cuts of both files at once
+    * zeros after the end of the index or the pack, and the last frame
+        filled with zeros (as a crash can leave on some file systems)
+
+Each copy must open with exactly the frames that were written
+completely, return their content unchanged, add a new frame straight
+after the last one, and open again with the same frames plus the new
+one.
+
+It then reports how long opening a pack of `--frames` frames takes, how
+many frames a second are added, and how many frames a second are found
+by time with `at`.  The script prints every failed check and exits with
+status 1 if there are any, so it can be run to check a change to
+image_pack.py.
+
+This script only requires modules from the Python standard library.
+
+Usage:
+
+    python bench_image_pack.py [--frames 10000] [--frame-bytes 50000]
+        [--torn 200] [--seed 1]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from image_pack import INDEX_FORMAT, MAGIC, ImagePack
+
+START = 1620000000000
+MINUTE = 60 * 1000
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+        print("  FAIL " + message)
+
+
+def write_pack(folder, frames):
+    pack = ImagePack(folder)
+    for timestamp, data in frames:
+        pack.append(data, timestamp)
+    pack.close()
+    with open(os.path.join(folder, "frames.idx"), "rb") as f:
+        index = f.read()
+    with open(os.path.join(folder, "frames.pack"), "rb") as f:
+        data = f.read()
+    return index, data
+
+
+def whole_frames(frames, index_size, data_size):
+    # the number of frames whose entry and content were both written
+    count = 0
+    end = 0
+    for _, data in frames:
+        end += len(data)
+        if len(MAGIC) + (count + 1) * INDEX_FORMAT.size > index_size or end > data_size:
+            break
+        count += 1
+    return count
+
+
+def check_copy(failures, folder, name, frames, index, data, expected):
+    # opens a pack made of `index` and `data`, which should recover to
+    # the first `expected` frames
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    with open(os.path.join(folder, "frames.idx"), "wb") as f:
+        f.write(index)
+    with open(os.path.join(folder, "frames.pack"), "wb") as f:
+        f.write(data)
+    pack = ImagePack(folder)
+    try:
+        if len(pack) != expected:
+            check(failures, False, "%s: %d frames, expected %d" % (name, len(pack), expected))
+            return
+        for i in range(expected):
+            frame = pack.frame(i)
+            if frame.timestamp != frames[i][0] or bytes(pack.read(frame)) != frames[i][1]:
+                check(failures, False, "%s: frame %d changed" % (name, i))
+                return
+        # the next frame goes straight after the last whole frame
+        extra = b"after " + name.encode("utf-8")
+        frame = pack.append(extra, frames[-1][0] + MINUTE)
+        end = sum(len(d) for _, d in frames[:expected])
+        check(failures, frame.offset == end,
+              "%s: new frame written at %d, expected %d" % (name, frame.offset, end))
+    finally:
+        pack.close()
+    pack = ImagePack(folder)
+    try:
+        ok = len(pack) == expected + 1 and bytes(pack.read(pack.frame(expected))) == extra
+        check(failures, ok, "%s: the new frame wasn't there when opened again" % name)
+    finally:
+        pack.close()
+
+
+def check_recovery(failures, work, torn, rng):
+    frames = [(START + i * MINUTE, bytes(rng.randrange(256) for _ in range(rng.randint(1, 64))))
+              for i in range(5)]
+    index, data = write_pack(os.path.join(work, "whole"), frames)
+    folder = os.path.join(work, "copy")
+    count = len(frames)
+    cases = 0
+
+    for size in range(len(index) + 1):
+        check_copy(failures, folder, "index cut at %d" % size, frames, index[:size], data,
+                   whole_frames(frames, size, len(data)))
+        cases += 1
+    for size in range(len(data) + 1):
+        check_copy(failures, folder, "pack cut at %d" % size, frames, index, data[:size],
+                   whole_frames(frames, len(index), size))
+        cases += 1
+    for _ in range(torn):
+        index_size = rng.randint(0, len(index))
+        data_size = rng.randint(0, len(data))
+        check_copy(failures, folder, "index cut at %d, pack at %d" % (index_size, data_size),
+                   frames, index[:index_size], data[:data_size],
+                   whole_frames(frames, index_size, data_size))
+        cases += 1
+
+    last = len(frames[-1][1])
+    damaged = [
+        ("zeros after the index", index + bytes(INDEX_FORMAT.size), data, count),
+        ("part of a zero entry", index + bytes(INDEX_FORMAT.size // 2), data, count),
+        ("zeros after the pack", index, data + bytes(100), count),
+        ("zeros after both", index + bytes(2 * INDEX_FORMAT.size), data + bytes(100), count),
+        ("last frame zeros", index, data[:-last] + bytes(last), count - 1),
+        ("last entry zeros", index[:-INDEX_FORMAT.size] + bytes(INDEX_FORMAT.size), data,
+         count - 1),
+    ]
+    for name, damaged_index, damaged_data, expected in damaged:
+        check_copy(failures, folder, name, frames, damaged_index, damaged_data, expected)
+        cases += 1
+    print("recovery: %d torn or damaged copies of a pack of %d frames" % (cases, count))
+
+
+def bench(work, count, frame_bytes, rng):
+    folder = os.path.join(work, "bench")
+    content = [os.urandom(frame_bytes) for _ in range(16)]
+    pack = ImagePack(folder)
+    start = time.perf_counter()
+    for i in range(count):
+        pack.append(content[i % len(content)], START + i * MINUTE)
+    elapsed = time.perf_counter() - start
+    pack.close()
+    print("{:<28}{:>12.0f} frames/s".format("append", count / elapsed))
+
+    start = time.perf_counter()
+    pack = ImagePack(folder)
+    elapsed = time.perf_counter() - start
+    print("{:<28}{:>12.2f} ms".format("open %d frames" % len(pack), elapsed * 1000))
+
+    times = [START + rng.randrange(count) * MINUTE + rng.randrange(MINUTE) for _ in range(10000)]
+    start = time.perf_counter()
+    for timestamp in times:
+        pack.at(timestamp)
+    elapsed = time.perf_counter() - start
+    print("{:<28}{:>12.0f} frames/s".format("at", len(times) / elapsed))
+    pack.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark image packs")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--frame-bytes", type=int, default=50000)
+    parser.add_argument("--torn", type=int, default=200, help="random cuts of both files")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    work = tempfile.mkdtemp(prefix="bench_image_pack_")
+    failures = []
+    try:
+        check_recovery(failures, work, args.torn, rng)
+        bench(work, args.frames, args.frame_bytes, rng)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if failures:
+        print("\n%d checks failed" % len(failures))
+        return 1
+    print("\nAll checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
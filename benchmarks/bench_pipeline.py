@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+"""Offline Benchmark of the Download Pipeline
+
+This script measures how fast the weather app's download pipeline is
+without using the real BOM, AirServices Australia or Elasticsearch
+servers.  It starts two local stand-ins, each in its own process:
+
+    * a fake BOM/AirServices website that serves the recorded BOM data in
+        `fixtures/IDQ60801.99435.json` (with the WMO number changed for
+        each station) and a camera image, with configurable latency and
+        error rate, and ETag support so unchanged data can return 304,
+    * a fake Elasticsearch that accepts index and bulk requests (and the
+        other requests the app makes) and counts what it receives.
+
+The same code the weather app runs every minute (`weather_app.new_download`
+followed by a drain of the spool) is then run against them for 1, 10,
+100 and 1000 stations (by default).  Before each sweep the fake website
+publishes a new observation for every station, so each sweep does the
+full amount of work.
+
+For each number of stations the script reports the p50 and p99 time of
+each stage (BOM fetch, image fetch, base64 encode, Elasticsearch bulk
+index), documents indexed per second and the number of bytes moved.  The
+results can be saved with `--save` and compared with a saved baseline
+with `--baseline`, so a change to the pipeline can be checked before it
+is deployed.
+
+This script requires the same modules as the weather app (`requests`,
+`elasticsearch` and `apscheduler`).
+
+Usage:
+
+    python bench_pipeline.py [--stations 1 10 100 1000] [--sweeps 3]
+        [--latency 0.05] [--error-rate 0.0] [--image-bytes 100000]
+        [--workers 16] [--save results.json] [--baseline results.json]
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+FIXTURE = os.path.join(HERE, "fixtures", "IDQ60801.99435.json")
+STAGES = ("bom_fetch", "image_fetch", "b64_encode", "es_index")
+
+
+def make_image(size, version=0):
+    """
+    Returns a jpg-shaped image of about `size` bytes: a jpg header with
+    the image's dimensions, padded out with comment segments.  It is
+    never decoded, only downloaded, hashed and encoded.
+    """
+    header = bytes.fromhex("ffd8ffe000104a46494600010100000100010000"
+                           "ffc0001108012c019003012200021101031101")
+    body = bytearray(header)
+    filler = ("version %d " % version).encode() * 6500
+    while len(body) + 4 < size:
+        chunk = filler[:min(65533, size - len(body) - 4)]
+        body += b"\xff\xfe" + (len(chunk) + 2).to_bytes(2, "big") + chunk
+    return bytes(body) + b"\xff\xd9"
+
+
+def _serve(handler, port_queue):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        return len(body)
+
+    def _json(self, status, obj):
+        return self._send(status, json.dumps(obj).encode("utf-8"),
+                          headers={"X-elastic-product": "Elasticsearch"})
+
+
+def upstream_handler(latency, error_rate, image_bytes):
+    """Returns the request handler class of the fake BOM/AirServices site"""
+
+    with open(FIXTURE) as f:
+        fixture = json.load(f)
+    state = {"version": 0, "bytes": 0, "requests": 0, "not_modified": 0}
+    rendered = {}
+    lock = threading.Lock()
+
+    def data_template(version):
+        # the fixture with every record moved forward 30 minutes per
+        # version and the WMO number replaced with a placeholder
+        if version not in rendered:
+            doc = json.loads(json.dumps(fixture))
+            for record in doc["observations"]["data"]:
+                record["wmo"] = "__WMO__"
+                for field in ("local_date_time_full", "aifstime_utc"):
+                    t = datetime.datetime.strptime(record[field], "%Y%m%d%H%M%S")
+                    record[field] = (t + datetime.timedelta(minutes=30 * version)).strftime("%Y%m%d%H%M%S")
+            rendered.clear()
+            rendered[version] = (json.dumps(doc).encode("utf-8"), make_image(image_bytes, version))
+        return rendered[version]
+
+    class Upstream(_Handler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/_control/advance":
+                with lock:
+                    state["version"] += 1
+                return self._json(200, {"version": state["version"]})
+            if path == "/_control/stats":
+                with lock:
+                    return self._json(200, dict(state))
+
+            time.sleep(latency * (0.5 + random.random()))
+            with lock:
+                version = state["version"]
+                template, image = data_template(version)
+                state["requests"] += 1
+            if random.random() < error_rate:
+                return self._send(500, b"error")
+
+            name = path.rsplit("/", 1)[-1]
+            wmo = name.split(".")[-2]
+            etag = '"%s-%d"' % (name, version)
+            if self.headers.get("If-None-Match") == etag:
+                with lock:
+                    state["not_modified"] += 1
+                return self._send(304, headers={"ETag": etag})
+            if name.endswith(".json"):
+                body = template.replace(b'"__WMO__"', wmo.encode())
+                sent = self._send(200, body, headers={"ETag": etag})
+            else:
+                sent = self._send(200, image, "image/jpeg", {"ETag": etag})
+            with lock:
+                state["bytes"] += sent
+
+    return Upstream
+
+
+def elasticsearch_handler():
+    """Returns the request handler class of the fake Elasticsearch"""
+
+    state = {"docs": 0, "bytes": 0, "requests": 0}
+    lock = threading.Lock()
+
+    class FakeElasticsearch(_Handler):
+        def do_HEAD(self):
+            # every index and alias "exists"
+            self._send(200)
+
+        def do_GET(self):
+            self._read_body()
+            if self.path.startswith("/_bench/stats"):
+                with lock:
+                    return self._json(200, dict(state))
+            return self._json(200, {"version": {"number": "7.17.0"},
+                                    "tagline": "You Know, for Search"})
+
+        def do_DELETE(self):
+            self._read_body()
+            self._json(200, {"acknowledged": True})
+
+        def do_PUT(self):
+            self.do_POST()
+
+        def do_POST(self):
+            body = self._read_body()
+            path = self.path.split("?")[0]
+            with lock:
+                state["requests"] += 1
+                state["bytes"] += len(body)
+            if path.endswith("/_bulk"):
+                items = []
+                lines = body.splitlines()
+                i = 0
+                while i < len(lines):
+                    op, meta = next(iter(json.loads(lines[i]).items()))
+                    i += 1 if op == "delete" else 2
+                    items.append({op: {"_id": meta.get("_id"), "status": 201}})
+                with lock:
+                    state["docs"] += len(items)
+                return self._json(200, {"took": 1, "errors": False, "items": items})
+            if path.endswith("/_search"):
+                return self._json(200, {"hits": {"total": {"value": 0}, "hits": []}})
+            if path.endswith("/_rollover"):
+                return self._json(200, {"rolled_over": False})
+            if "/_doc/" in path or "/_create/" in path:
+                with lock:
+                    state["docs"] += 1
+                return self._json(201, {"result": "created"})
+            return self._json(200, {"acknowledged": True})
+
+    return FakeElasticsearch
+
+
+def _upstream_main(latency, error_rate, image_bytes, ports):
+    _serve(upstream_handler(latency, error_rate, image_bytes), ports)
+
+
+def _elasticsearch_main(ports):
+    _serve(elasticsearch_handler(), ports)
+
+
+class StageTimer:
+    """
+    Records how long each call to a pipeline stage takes by wrapping the
+    method that does the stage's work, for as long as it is used as a
+    context manager.
+    """
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.samples[stage].append(time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+        self._patched.append((owner, name, original))
+
+    def __enter__(self):
+        import dl_data
+        import dl_img_conv_b64
+        import spool
+        self.wrap(dl_data.DownloadData, "dl_observation", "bom_fetch")
+        self.wrap(dl_img_conv_b64.DownloadConvert, "conv_img_to_b64", "image_fetch")
+        self.wrap(dl_img_conv_b64.DownloadConvert, "stream_to_b64", "b64_encode")
+        self.wrap(spool.SpoolDrainer, "_send", "es_index")
+        return self
+
+    def __exit__(self, *exc):
+        for owner, name, original in reversed(self._patched):
+            setattr(owner, name, original)
+        self._patched = []
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def _get_json(session, url):
+    return session.get(url).json()
+
+
+def run(station_counts, sweeps, workers, upstream_url, es_port, verbose=False):
+    from elasticsearch import Elasticsearch
+
+    import index_admin
+    import sessions
+    import weather_app
+    from collector import Collector
+    from sinks import ElasticsearchSink
+    from spool import Spool, SpoolDrainer
+    from stations import Station
+
+    http = sessions.get_session()
+    es = Elasticsearch([{"host": "127.0.0.1", "port": es_port}], maxsize=workers)
+    # set up as weather_app.py does
+    search_index = index_admin.READ_ALIAS if weather_app.PARTITIONED else None
+    sink = ElasticsearchSink(es, weather_app.INDEX_NAME, prepare=weather_app.ensure_index,
+                             search_index=search_index)
+    results = []
+
+    for run_number, count in enumerate(station_counts):
+        base = 100000 + run_number * 10000
+        station_list = [Station(base + i,
+                                "%s/fwo/IDQ60801/IDQ60801.%d.json" % (upstream_url, base + i),
+                                "%s/cam/%d.jpg" % (upstream_url, base + i))
+                        for i in range(count)]
+        collector = Collector(station_list, max_workers=workers, per_host=workers)
+        spool_dir = tempfile.mkdtemp(prefix="bench_spool_")
+        spool = Spool(spool_dir)
+        drainer = SpoolDrainer(spool, es, search_index=search_index)
+
+        upstream_before = _get_json(http, upstream_url + "/_control/stats")
+        es_before = _get_json(http, "http://127.0.0.1:%d/_bench/stats" % es_port)
+        sweep_times = []
+        output = io.StringIO()
+        with StageTimer() as timer:
+            for _ in range(sweeps):
+                http.get(upstream_url + "/_control/advance")
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(sys.stdout if verbose else output):
+                    weather_app.new_download(sink, collector, spool=spool)
+                    weather_app.drain_spool(es, drainer)
+                sweep_times.append(time.perf_counter() - start)
+        spool.close()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        upstream_after = _get_json(http, upstream_url + "/_control/stats")
+        es_after = _get_json(http, "http://127.0.0.1:%d/_bench/stats" % es_port)
+
+        docs = es_after["docs"] - es_before["docs"]
+        result = {
+            "stations": count,
+            "sweeps": sweeps,
+            "sweep_s_p50": percentile(sweep_times, 50),
+            "docs": docs,
+            "docs_per_s": docs / sum(sweep_times) if sum(sweep_times) else None,
+            "upstream_bytes": upstream_after["bytes"] - upstream_before["bytes"],
+            "es_bytes": es_after["bytes"] - es_before["bytes"],
+            "stages": {stage: {"count": len(timer.samples[stage]),
+                               "p50_ms": _ms(percentile(timer.samples[stage], 50)),
+                               "p99_ms": _ms(percentile(timer.samples[stage], 99))}
+                       for stage in STAGES},
+        }
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def print_result(result):
+    print("\n%d station(s), %d sweep(s): sweep p50 %.3f s, %.1f docs/s, "
+          "%d bytes from upstream, %d bytes to Elasticsearch"
+          % (result["stations"], result["sweeps"], result["sweep_s_p50"],
+             result["docs_per_s"] or 0, result["upstream_bytes"], result["es_bytes"]))
+    print("  {:<12}{:>8}{:>12}{:>12}".format("stage", "calls", "p50 ms", "p99 ms"))
+    for stage, s in result["stages"].items():
+        print("  {:<12}{:>8}{:>12}{:>12}".format(stage, s["count"], str(s["p50_ms"]), str(s["p99_ms"])))
+
+
+def compare(results, baseline):
+    """Prints the change from a saved baseline, matched by station count"""
+    previous = {r["stations"]: r for r in baseline}
+    print("\nCompared with baseline (negative is faster):")
+    for result in results:
+        old = previous.get(result["stations"])
+        if old is None:
+            continue
+        print("  %d station(s): docs/s %s" % (result["stations"],
+                                               _change(old["docs_per_s"], result["docs_per_s"], True)))
+        for stage in STAGES:
+            new_s, old_s = result["stages"][stage], old["stages"].get(stage, {})
+            print("    {:<12} p50 {:<10} p99 {}".format(
+                stage, _change(old_s.get("p50_ms"), new_s["p50_ms"]),
+                _change(old_s.get("p99_ms"), new_s["p99_ms"])))
+
+
+def _change(old, new, higher_is_better=False):
+    if not old or new is None:
+        return "n/a"
+    change = (new - old) / float(old) * 100.0
+    return "%+.1f%%%s" % (change, " (better)" if (change > 0) == higher_is_better and change else "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline offline")
+    parser.add_argument("--stations", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="average seconds the fake website takes to answer")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests the fake website answers with 500")
+    parser.add_argument("--image-bytes", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--save", help="save the results to this json file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    upstream = multiprocessing.Process(target=_upstream_main, daemon=True,
+                                       args=(args.latency, args.error_rate, args.image_bytes, port_queue))
+    upstream.start()
+    upstream_port = port_queue.get(timeout=10)
+    fake_es = multiprocessing.Process(target=_elasticsearch_main, args=(port_queue,), daemon=True)
+    fake_es.start()
+    es_port = port_queue.get(timeout=10)
+
+    try:
+        results = run(args.stations, args.sweeps, args.workers,
+                      "http://127.0.0.1:%d" % upstream_port, es_port, args.verbose)
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            with open(args.baseline) as f:
+                compare(results, json.load(f))
+    finally:
+        upstream.terminate()
+        fake_es.terminate()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""Check and Benchmark of Reading Observations
+
+This script checks query.py without an Elasticsearch cluster, using a
+fake client that answers point in time searches the way Elasticsearch
+does (sorting, `search_after`, `_source` filtering, `docvalue_fields`
+with 32 bit floats, and a point in time id that changes from one page to
+the next).  It checks that:
+
+    * iter_all reads every observation once, in time order (and in
+        reverse with order="desc"), for page sizes that do and don't
+        divide the number of observations, including observations with
+        the same time and observations without one
+    * time_range only reads the station's observations from `start` up
+        to (not including) `end`, given as datetimes or milliseconds
+    * the fields asked for are read from the column store or the saved
+        document, floats come back as they were saved, and the image is
+        only read with include_images
+    * the point in time is always closed, including when the reader
+        stops part way through
+    * latest returns the most recent observation
+
+It then reports how many observations a second iter_all reads from the
+fake client (mostly the time spent in query.py, as the fake client only
+sorts each search once).  The script prints every failed check and
+exits with status 1 if there are any, so it can be run to check a change
+to query.py.
+
+This script only requires modules from the Python standard library.
+
+Usage:
+
+    python bench_query.py [--observations 20000] [--page-size 500]
+"""
+
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import query
+from index_mapping import PROPERTIES
+
+START = 1620000000000
+HALF_HOUR = 30 * 60 * 1000
+
+
+def _float32(value):
+    # Elasticsearch keeps float fields as 32 bit floats
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+def _matches(query_, doc):
+    if not query_ or "match_all" in query_:
+        return True
+    if "term" in query_:
+        (name, value), = query_["term"].items()
+        return doc.get(name) == value
+    if "range" in query_:
+        (name, limits), = query_["range"].items()
+        value = doc.get(name)
+        if value is None:
+            return False
+        return all({"gte": value >= limit, "gt": value > limit,
+                    "lte": value <= limit, "lt": value < limit}[op]
+                   for op, limit in limits.items())
+    if "bool" in query_:
+        return all(_matches(q, doc) for q in query_["bool"].get("filter", []))
+    raise ValueError("query not supported by the fake client: %r" % (query_,))
+
+
+class FakeElasticsearch:
+    """
+    Answers the searches made by query.py from a list of documents, as
+    a single shard index (the _shard_doc of a document is its place in
+    the list).  Counts the requests and the points in time left open.
+    """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.open = set()
+        self.searches = 0
+        self._ids = itertools.count()
+        # (query, sort) -> the sort keys and matching documents in order,
+        # so each page costs about as much as in Elasticsearch
+        self._sorted = {}
+
+    def open_point_in_time(self, index, keep_alive):
+        pit_id = "pit-%d" % next(self._ids)
+        self.open.add(pit_id)
+        return {"id": pit_id}
+
+    def close_point_in_time(self, body):
+        self.open.discard(body["id"])
+        return {"succeeded": True}
+
+    def _hit(self, position, doc, body, sort):
+        hit = {"sort": sort}
+        source = body.get("_source", True)
+        if source is not False:
+            if isinstance(source, dict) and "includes" in source:
+                hit["_source"] = {k: doc[k] for k in source["includes"] if k in doc}
+            else:
+                excludes = source.get("excludes", []) if isinstance(source, dict) else []
+                hit["_source"] = {k: v for k, v in doc.items() if k not in excludes}
+        fields = {}
+        for spec in body.get("docvalue_fields", []):
+            value = doc.get(spec["field"])
+            if value is None:
+                continue
+            if PROPERTIES[spec["field"]]["type"] == "float":
+                value = _float32(value)
+            elif spec.get("format") == "epoch_millis":
+                # dates come back as strings in this format
+                value = str(value)
+            fields[spec["field"]] = [value]
+        if fields:
+            hit["fields"] = fields
+        return hit
+
+    def search(self, body, filter_path=None, index=None):
+        self.searches += 1
+        if "pit" in body:
+            if body["pit"]["id"] not in self.open:
+                raise ValueError("search with a closed or old point in time")
+            # a new id for every page, as Elasticsearch can
+            old = body["pit"]["id"]
+            pit_id = "pit-%d" % next(self._ids)
+            self.open.discard(old)
+            self.open.add(pit_id)
+        else:
+            pit_id = None
+        sorts = []
+        for sort in body["sort"]:
+            (name, spec), = sort.items()
+            sorts.append((name, spec["order"] if isinstance(spec, dict) else spec))
+
+        def sort_values(position, doc):
+            values = []
+            for name, order in sorts:
+                value = position if name == "_shard_doc" else doc.get(name)
+                if value is None:
+                    # missing values are sorted last
+                    value = 2 ** 63 - 1 if order == "asc" else -2 ** 63
+                values.append(value)
+            return values
+
+        def key(values):
+            return tuple(v if order == "asc" else -v for v, (_, order) in zip(values, sorts))
+
+        cache_key = json.dumps([body.get("query"), body["sort"]], sort_keys=True)
+        if cache_key not in self._sorted:
+            found = sorted((key(sort_values(p, d)), p, d) for p, d in enumerate(self.docs)
+                           if _matches(body.get("query"), d))
+            self._sorted[cache_key] = ([f[0] for f in found], found)
+        keys, found = self._sorted[cache_key]
+        first = 0
+        if "search_after" in body:
+            first = bisect.bisect_right(keys, key(body["search_after"]))
+        hits = [self._hit(p, d, body, sort_values(p, d))
+                for _, p, d in found[first:first + body["size"]]]
+        res = {"hits": {"hits": hits}}
+        if pit_id is not None:
+            res["pit_id"] = pit_id
+        return res
+
+
+def make_docs(count, stations=3):
+    # every station every half hour, with some observations at the same
+    # time and one without a time
+    docs = []
+    for i in range(count):
+        wmo = 94000 + i % stations
+        epoch = START + (i // stations) * HALF_HOUR
+        if i % 17 == 0:
+            epoch -= HALF_HOUR
+        docs.append({"wmo": wmo, "epoch_date": epoch, "air_temp": round(10 + (i % 97) / 10, 1),
+                     "rel_hum": i % 100, "name": "Station %d" % (wmo % 100),
+                     "local_image_b64": "image-%d" % i})
+    docs[len(docs) // 2]["epoch_date"] = None
+    return docs
+
+
+def check(failures, ok, message):
+    if not ok:
+        failures.append(message)
+        print("  FAIL " + message)
+
+
+def expected(docs, wmo=None, start=None, end=None, order="asc"):
+    chosen = [(p, d) for p, d in enumerate(docs)
+              if (wmo is None or d["wmo"] == wmo) and
+              (start is None or (d["epoch_date"] is not None and d["epoch_date"] >= start)) and
+              (end is None or (d["epoch_date"] is not None and d["epoch_date"] < end))]
+    dated = [c for c in chosen if c[1]["epoch_date"] is not None]
+    dated.sort(key=lambda c: (c[1]["epoch_date"] if order == "asc" else -c[1]["epoch_date"], c[0]))
+    return [d for _, d in dated] + [d for _, d in chosen if d["epoch_date"] is None]
+
+
+def check_paging(failures, docs):
+    for page_size in (1, 7, 100, len(docs), len(docs) + 1):
+        for order in ("asc", "desc"):
+            es = FakeElasticsearch(docs)
+            read = list(query.iter_all(es, page_size=page_size, order=order))
+            want = [{k: v for k, v in d.items() if k != "local_image_b64"}
+                    for d in expected(docs, order=order)]
+            check(failures, read == want,
+                  "iter_all(page_size=%d, order=%s) read %d observations, expected %d in order"
+                  % (page_size, order, len(read), len(want)))
+            check(failures, not es.open, "iter_all(page_size=%d) left a point in time open"
+                  % page_size)
+    # a page size that divides the number of observations reads one
+    # more (empty) page; others stop at the first short page
+    es = FakeElasticsearch(docs[:100])
+    list(query.iter_all(es, page_size=10))
+    check(failures, es.searches == 11, "100 observations in pages of 10 took %d searches"
+          % es.searches)
+    print("iter_all: %d observations, every page size and order read in order" % len(docs))
+
+
+def check_fields(failures, docs):
+    es = FakeElasticsearch(docs)
+    fields = ["epoch_date", "air_temp", "name"]
+    read = list(query.iter_all(es, fields=fields, page_size=50))
+    want = [{k: d.get(k) for k in fields} for d in expected(docs)]
+    check(failures, read == want, "iter_all(fields=%r) doesn't match the documents" % fields)
+    check(failures, all(list(r) == fields for r in read),
+          "iter_all(fields=%r) returned other fields or another order" % fields)
+    with_images = list(query.iter_all(FakeElasticsearch(docs), include_images=True))
+    check(failures, with_images == expected(docs), "include_images didn't return the images")
+    body = query._search_body(None, ["epoch_date", "air_temp"], False, 10)
+    check(failures, body["_source"] is False,
+          "the saved document is read when every field is in the column store")
+    print("fields: column store, saved document and images read as expected")
+
+
+def check_time_range(failures, docs):
+    wmo = docs[0]["wmo"]
+    start = START + 10 * HALF_HOUR
+    end = START + 40 * HALF_HOUR
+    cases = [(start, end), (None, end), (start, None), (None, None),
+             (datetime.datetime.fromtimestamp(start / 1000, datetime.timezone.utc),
+              datetime.datetime.fromtimestamp(end / 1000, datetime.timezone.utc).replace(tzinfo=None))]
+    for first, last in cases:
+        es = FakeElasticsearch(docs)
+        read = list(query.time_range(es, wmo, first, last, fields=["epoch_date"], page_size=9))
+        limits = [None if t is None else query._millis(t) for t in (first, last)]
+        want = [{"epoch_date": d["epoch_date"]} for d in expected(docs, wmo, *limits)]
+        check(failures, read == want, "time_range(%r, %r) read %d observations, expected %d"
+              % (first, last, len(read), len(want)))
+    print("time_range: start is included, end isn't")
+
+
+def check_close(failures, docs):
+    es = FakeElasticsearch(docs)
+    records = query.iter_all(es, page_size=10)
+    for _ in itertools.islice(records, 25):
+        pass
+    records.close()
+    check(failures, not es.open, "stopping part way through left a point in time open")
+    es = FakeElasticsearch(docs)
+    record = query.latest(es, docs[1]["wmo"], fields=["epoch_date", "wmo"])
+    newest = max(d["epoch_date"] for d in docs
+                 if d["wmo"] == docs[1]["wmo"] and d["epoch_date"] is not None)
+    check(failures, record == {"epoch_date": newest, "wmo": docs[1]["wmo"]},
+          "latest returned %r" % (record,))
+    check(failures, query.latest(es, 1) is None, "latest of an unknown station isn't None")
+    print("points in time closed, latest read")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark reading observations")
+    parser.add_argument("--observations", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=query.PAGE_SIZE)
+    args = parser.parse_args()
+
+    failures = []
+    docs = make_docs(1000)
+    check_paging(failures, docs)
+    check_fields(failures, docs)
+    check_time_range(failures, docs)
+    check_close(failures, docs)
+
+    docs = make_docs(args.observations)
+    for fields in (None, ["epoch_date", "air_temp"]):
+        es = FakeElasticsearch(docs)
+        start = time.perf_counter()
+        count = sum(1 for _ in query.iter_all(es, fields=fields, page_size=args.page_size))
+        elapsed = time.perf_counter() - start
+        print("{:<32}{:>10} observations{:>12.0f} /s".format(
+            "iter_all fields=%s" % (",".join(fields) if fields else "all"), count,
+            count / elapsed))
+
+    if failures:
+        print("\n%d checks failed" % len(failures))
+        return 1
+    print("\nAll checks passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
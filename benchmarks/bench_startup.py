@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""Benchmark of how Long the Weather App Takes to Start
+
+run_once.py is started by cron or a systemd timer for every run, so the
+time it takes to start (mostly importing modules) is paid on every run
+rather than once.  This script measures it by starting each of these
+commands `--repeat` times in a new Python process:
+
+    * python -c pass - the Python interpreter alone, for comparison
+    * python run_once.py --help - reading the arguments, nothing else
+    * python -c "import weather_app" - importing the scheduled app
+    * run_once.py with the stdout sink, the sqlite sink and the
+        elasticsearch sink - a whole run of `--stations` stations
+        against a fake BOM/AirServices website and a fake Elasticsearch
+        (see bench_pipeline.py) that answer straight away, so the time
+        is startup plus the (local) network time
+
+For each command it reports the median and fastest wall time, and the
+time over the bare interpreter.  It then runs the stdout sink once with
+`python -X importtime` and lists the modules that took the longest to
+import, to show where the startup time goes.
+
+The script exits with status 1 if a run of run_once.py with the stdout
+sink takes longer than `--max-ms` milliseconds over the bare interpreter
+(median), so it can be used to check that startup hasn't become slower.
+The default (MAX_MS) is the budget of a stdout run: about 170 ms of it
+is importing `requests` (and urllib3, certifi, ...), which every run
+needs, and about 100 ms is the run itself; the weather app's own modules
+take under 30 ms, as http.server, cadence.py, rollups.py and
+`elasticsearch` aren't imported by a stdout run.
+
+This script requires the same modules as run_once.py (`requests`, and
+`elasticsearch` for the elasticsearch sink).
+
+Usage:
+
+    python bench_startup.py [--repeat 10] [--stations 3] [--top 15]
+        [--image-bytes 100000] [--max-ms 400]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+RUN_ONCE = os.path.join(ROOT, "run_once.py")
+
+from bench_pipeline import elasticsearch_handler, upstream_handler
+
+# the most milliseconds a stdout run can take over the interpreter
+MAX_MS = 400
+
+
+def serve(handler):
+    """Serves `handler` on a local port in a thread, returns the URL"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:%d" % server.server_port
+
+
+def write_registry(path, upstream_url, count):
+    stations = [{"wmo": 100000 + i, "name": "Station %d" % i,
+                 "data_url": "%s/fwo/IDQ60801/IDQ60801.%d.json" % (upstream_url, 100000 + i),
+                 "image_url": "%s/cam/%d.jpg" % (upstream_url, 100000 + i)}
+                for i in range(count)]
+    with open(path, "w") as f:
+        json.dump(stations, f)
+
+
+def time_command(command, repeat, cwd):
+    """Runs `command` `repeat` times, returns the wall times (seconds)
+    and the exit status of the last run"""
+    times = []
+    status = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        done = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        status = done.returncode
+    return times, status
+
+
+def import_times(command, cwd):
+    """Returns {module: cumulative seconds} for the modules imported by
+    `command` directly (not the modules they import)"""
+    done = subprocess.run([command[0], "-X", "importtime"] + command[1:], cwd=cwd,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    modules = {}
+    for line in done.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit() or name.startswith("  "):
+            continue
+        modules[name.strip()] = int(cumulative) / 1e6
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark how long the weather app takes to start")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--stations", type=int, default=3)
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports listed")
+    parser.add_argument("--image-bytes", type=int, default=100000)
+    parser.add_argument("--max-ms", type=float, default=MAX_MS,
+                        help="fail if a stdout run takes longer than this over the "
+                             "interpreter (default: %(default)s)")
+    args = parser.parse_args()
+
+    python = sys.executable
+    upstream_url = serve(upstream_handler(0, 0, args.image_bytes))
+    es_url = serve(elasticsearch_handler())
+    work = tempfile.mkdtemp(prefix="bench_startup_")
+    registry = os.path.join(work, "stations.json")
+    write_registry(registry, upstream_url, args.stations)
+
+    run = [python, RUN_ONCE, "--registry", registry, "--quiet"]
+    commands = [
+        ("python -c pass", [python, "-c", "pass"]),
+        ("run_once.py --help", [python, RUN_ONCE, "--help"]),
+        ("import weather_app", [python, "-c", "import weather_app"]),
+        ("run_once.py stdout sink", run + ["--sink", "stdout"]),
+        ("run_once.py sqlite sink", run + ["--sink", "sqlite",
+                                           "--sqlite-path", os.path.join(work, "weather.db")]),
+        ("run_once.py elasticsearch sink", run + ["--sink", "elasticsearch", "--es-url", es_url,
+                                                  "--index", "bench"]),
+    ]
+
+    # the first start reads every module from disk, later starts use
+    # the operating system's file cache (as cron runs would)
+    time_command([python, RUN_ONCE, "--help"], 1, ROOT)
+
+    print("{:<32}{:>10}{:>10}{:>14}{:>8}".format("command", "p50 ms", "min ms",
+                                                 "over python", "status"))
+    baseline = None
+    medians = {}
+    # the ledger of saved observations is written next to run_once.py,
+    # so it is put back afterwards
+    ledger = os.path.join(ROOT, "stored_ids.json")
+    saved_ledger = open(ledger, "rb").read() if os.path.exists(ledger) else None
+    try:
+        for name, command in commands:
+            times, status = time_command(command, args.repeat, ROOT)
+            median = statistics.median(times)
+            medians[name] = median
+            if baseline is None:
+                baseline = median
+            print("{:<32}{:>10.1f}{:>10.1f}{:>14.1f}{:>8}".format(
+                name, median * 1000, min(times) * 1000, (median - baseline) * 1000, status))
+    finally:
+        if saved_ledger is None:
+            if os.path.exists(ledger):
+                os.remove(ledger)
+        else:
+            with open(ledger, "wb") as f:
+                f.write(saved_ledger)
+
+    modules = import_times(run + ["--sink", "stdout"], ROOT)
+    print("\nSlowest imports of a stdout run (ms, including the modules they import):")
+    for name, seconds in sorted(modules.items(), key=lambda m: -m[1])[:args.top]:
+        print("  {:<30}{:>8.1f}".format(name, seconds * 1000))
+
+    over = (medians["run_once.py stdout sink"] - baseline) * 1000
+    if over > args.max_ms:
+        print("\nA stdout run took %.1f ms over the interpreter, more than %.1f ms"
+              % (over, args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""Content-Addressed Image Store
+
+This script saves camera images to a local folder instead of putting the
+base64 encoded image into every Elasticsearch document.  Each image is
+saved once, under the sha256 hash of its content, so the same image
+downloaded many times only takes up space once.  Observation documents
+then only need to hold the hash, size and dimensions of the image.
+
+Images are saved in sub-folders named after the first characters of the
+hash so that no single folder holds too many files, e.g.
+
+    image_store/3f/a2/3fa2...e9
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following:
+
+    * image_dimensions - returns the width and height of a jpg or png
+    * BlobStore - saves and loads images by their sha256 hash
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+
+
+def image_dimensions(data):
+    """
+    Returns the (width, height) of a jpg or png image from its header,
+    without decoding the image.  Returns (None, None) if the size can't
+    be found.
+    """
+
+    # png: the IHDR chunk straight after the signature
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+
+    # jpg: look for the "start of frame" marker that holds the size
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                i += 1 if marker == 0xFF else 2
+                continue
+            length = struct.unpack(">H", data[i + 2:i + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5:i + 9])
+                return width, height
+            i += 2 + length
+
+    return None, None
+
+
+class BlobStore:
+    """
+    A class to save images in a folder, named by the sha256 hash of
+    their content.
+
+    ...
+
+    Attributes
+    ----------
+    'root' : str
+        The folder the images are saved in.
+
+    Methods
+    -------
+    'put(data, source=None, timestamp=None)'
+        Saves an image (if it isn't already saved) and returns a
+        dictionary of the image's hash, size and dimensions, using the
+        same field names as the observation documents.  `source` (the
+        camera) and `timestamp` aren't needed as images are saved by
+        their hash; they are used by a PackStore (see image_pack.py).
+    'get(sha256)'
+        Returns the content of the image with the given hash.
+    'path(sha256)'
+        Returns the file the image with the given hash is saved in.
+    'exists(sha256)'
+        Returns True if the image with the given hash is saved.
+    'close()'
+        Does nothing (there is nothing to close), as PackStore.close.
+    """
+
+    def __init__(self, root="image_store"):
+        self.root = root
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def put(self, data, source=None, timestamp=None):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            folder = os.path.dirname(path)
+            os.makedirs(folder, exist_ok=True)
+            # written to a temporary file in the same folder and then
+            # renamed, so other workers never see half an image
+            fd, tmp = tempfile.mkstemp(dir=folder)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        width, height = image_dimensions(data)
+        return {"image_sha256": sha256, "image_bytes": len(data),
+                "image_width": width, "image_height": height}
+
+    def get(self, sha256):
+        with open(self.path(sha256), "rb") as f:
+            return f.read()
+
+    def close(self):
+        pass
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""Publish Cadence Aware Polling
+
+BOM publishes a new observation for each station about every half hour,
+a few minutes after the time of the observation.  Downloading every
+station every 60 seconds means most downloads find nothing new, and a
+new observation can still wait up to a minute to be found.
+
+This script learns when each station's observations are published and
+only downloads a station when a new observation is due:
+
+    * the time between observations (the period, normally 30 minutes) is
+        learnt from the observation times (`aifstime_utc`) in the
+        station's history
+    * the delay between the time of an observation and it appearing on
+        the BOM website is learnt from when new observations are first
+        found
+    * the station is downloaded every `WINDOW_INTERVAL` seconds in a
+        window starting just before the next observation is expected,
+        until it is found
+    * if the observation still hasn't appeared by the end of the window,
+        the station is downloaded less often (every `BACKOFF` seconds)
+        until it does
+    * a random delay of up to `JITTER` seconds is added to each download
+        so that stations due at the same time aren't all downloaded at
+        once
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following
+classes:
+
+    * StationCadence - what has been learnt about one station
+    * CadenceScheduler - decides which stations are due to be downloaded
+"""
+
+import calendar
+import random
+import threading
+import time
+from collections import deque
+from statistics import median
+
+# BOM's normal half-hourly period, and the usual delay (in seconds)
+# between the time of an observation and it being published; used until
+# enough has been learnt about a station
+DEFAULT_PERIOD = 1800
+DEFAULT_DELAY = 120
+
+# how early (seconds) to start downloading before an observation is
+# expected, how long the window of frequent downloads lasts, how often a
+# station is downloaded in the window, and afterwards
+EARLY = 30
+WINDOW = 600
+WINDOW_INTERVAL = 20
+BACKOFF = 300
+JITTER = 15
+
+# the number of observation times and publish delays remembered
+HISTORY = 48
+
+
+def observation_time(record):
+    """Returns the UTC time of an observation in seconds since 1970."""
+    if record.get("epoch_date") is not None:
+        return record["epoch_date"] / 1000
+    return calendar.timegm(time.strptime(str(record["aifstime_utc"]), "%Y%m%d%H%M%S"))
+
+
+class StationCadence:
+    """
+    What has been learnt about when one station's observations are
+    published.
+
+    ...
+
+    Attributes
+    ----------
+    'times' : deque of float
+        The times of the station's most recent observations.
+    'delays' : deque of float
+        How long after the time of each observation it was first found.
+    'next_poll' : float
+        When the station should next be downloaded.
+    """
+
+    def __init__(self):
+        self.times = deque(maxlen=HISTORY)
+        self.delays = deque(maxlen=HISTORY)
+        self.next_poll = 0.0
+
+    @property
+    def last(self):
+        return self.times[-1] if self.times else None
+
+    @property
+    def period(self):
+        gaps = [b - a for a, b in zip(self.times, list(self.times)[1:]) if b > a]
+        return median(gaps) if gaps else DEFAULT_PERIOD
+
+    @property
+    def delay(self):
+        return median(self.delays) if self.delays else DEFAULT_DELAY
+
+    def expected_release(self):
+        if self.last is None:
+            return None
+        return self.last + self.period + self.delay
+
+    def learn(self, times):
+        # observation times from the station's history (any order)
+        for t in sorted(set(times) | set(self.times)):
+            if self.last is None or t > self.last:
+                self.times.append(t)
+
+    def saw(self, obs_time, now):
+        # returns True if this is a new observation; the delay is only
+        # learnt for the observation that was being waited for (not one
+        # found when the app has just started)
+        if self.last is not None and obs_time <= self.last:
+            return False
+        if self.last is not None and 0 <= now - obs_time < self.period:
+            self.delays.append(now - obs_time)
+        self.times.append(obs_time)
+        return True
+
+    def plan(self, now, rng):
+        # when to download the station next, after downloading it at `now`
+        expected = self.expected_release()
+        if expected is None:
+            # nothing known yet, keep checking every WINDOW_INTERVAL
+            wait = WINDOW_INTERVAL
+        elif now < expected - EARLY:
+            wait = expected - EARLY - now
+        elif now < expected + WINDOW:
+            wait = WINDOW_INTERVAL
+        else:
+            # late (or skipped), check less often until it appears
+            wait = BACKOFF
+        self.next_poll = now + wait + rng.uniform(0, JITTER)
+        return self.next_poll
+
+
+class CadenceScheduler:
+    """
+    A class to decide which stations are due to be downloaded.
+
+    ...
+
+    Attributes
+    ----------
+    'clock' : function
+        Returns the current time in seconds since 1970 (time.time).
+    'rng' : random.Random
+        Used to add the random delay (jitter) to each download.
+
+    Methods
+    -------
+    'learn(station, history)'
+        Learns the times of a station's observations from its history
+        (a list of Observations, see DownloadData.dl_history).
+    'due(stations)'
+        Returns the stations that are due to be downloaded now.
+    'update(station, result)'
+        Records the result of downloading a station (an Observation,
+        NOT_MODIFIED or None) and plans its next download.
+    'expected_release(station)'
+        Returns when the station's next observation is expected to be
+        published (seconds since 1970), or None if nothing is known.
+    'retry(station)'
+        Downloads a station again soon, e.g. if its last observation
+        couldn't be stored.
+    'next_poll()'
+        Returns the time the next station is due to be downloaded.
+    """
+
+    def __init__(self, clock=time.time, rng=None):
+        self.clock = clock
+        self.rng = rng if rng is not None else random.Random()
+        self._lock = threading.Lock()
+        self._stations = {}
+
+    def _cadence(self, wmo):
+        if wmo not in self._stations:
+            self._stations[wmo] = StationCadence()
+        return self._stations[wmo]
+
+    def learn(self, station, history):
+        with self._lock:
+            cadence = self._cadence(station.wmo)
+            cadence.learn(observation_time(r) for r in history)
+            cadence.plan(self.clock(), self.rng)
+
+    def due(self, stations):
+        now = self.clock()
+        with self._lock:
+            return [s for s in stations if self._cadence(s.wmo).next_poll <= now]
+
+    def update(self, station, result):
+        now = self.clock()
+        with self._lock:
+            cadence = self._cadence(station.wmo)
+            if result:
+                cadence.saw(observation_time(result), now)
+            return cadence.plan(now, self.rng)
+
+    def expected_release(self, station):
+        with self._lock:
+            return self._cadence(station.wmo).expected_release()
+
+    def retry(self, station):
+        # the last observation wasn't stored, so it is downloaded again
+        # soon and treated as new
+        with self._lock:
+            cadence = self._cadence(station.wmo)
+            if cadence.times:
+                cadence.times.pop()
+            cadence.next_poll = self.clock() + WINDOW_INTERVAL
+
+    def next_poll(self):
+        with self._lock:
+            return min((c.next_poll for c in self._stations.values()), default=None)
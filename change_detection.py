@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""Detect Unchanged Downloads
+
+The BOM only publishes new observations about every 30 minutes, and the
+camera images are updated on their own schedule, but the weather app
+checks for new data much more often than that.  This script remembers
+what was downloaded from each URL last time so that unchanged data
+doesn't have to be downloaded, encoded or indexed again.
+
+Each URL's `ETag` and `Last-Modified` headers are saved and sent back
+with the next request as `If-None-Match` and `If-Modified-Since`, so the
+website can answer "304 Not Modified" without sending the data again.
+If the website doesn't support these headers, a hash of the content is
+compared with the hash of the content downloaded last time instead.
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following:
+
+    * NOT_MODIFIED - returned by downloads when nothing has changed
+    * ChangeTracker - remembers validators and hashes for each URL
+    * default_tracker - the ChangeTracker shared by the whole app
+"""
+
+import hashlib
+import threading
+
+
+class _NotModified:
+    """
+    The type of NOT_MODIFIED.  It is "falsy" (like None) so code that
+    skips missing data with `if result:` also skips unchanged data.
+    """
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "NOT_MODIFIED"
+
+
+NOT_MODIFIED = _NotModified()
+
+
+class ChangeTracker:
+    """
+    A class to remember what was last downloaded from each URL.
+
+    ...
+
+    Attributes
+    ----------
+    'hits' : int
+        The number of downloads that were found to be unchanged.
+    'misses' : int
+        The number of downloads that contained new content.
+
+    Methods
+    -------
+    'request_headers(url)'
+        Returns the conditional request headers to send for `url`.
+    'is_unchanged(url, response, content=None, digest=None)'
+        Checks a response (and its content, or the sha1 `digest` of its
+        content, if the website doesn't support conditional requests)
+        against the last download from `url`, counting a hit or a miss.
+        Returns True if unchanged.
+    'remember(url, value)' / 'recall(url)'
+        Saves/returns a value made from the last content downloaded
+        from `url` (e.g. the base64 encoded image) so it can be reused
+        when the content hasn't changed.
+    'forget(url)'
+        Forgets everything about `url` so the next download is treated
+        as new (e.g. if the last download couldn't be saved).
+    'stats()'
+        Returns the hit and miss counts as a dictionary.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # url -> {"etag", "last_modified", "digest", "value"}
+        self._entries = {}
+
+    def request_headers(self, url):
+        headers = {}
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def is_unchanged(self, url, response, content=None, digest=None):
+        # 304 means the website has confirmed nothing has changed
+        if response.status_code == 304:
+            unchanged = True
+            digest = None
+        else:
+            if digest is None and content is not None:
+                digest = hashlib.sha1(content).hexdigest()
+            with self._lock:
+                previous = self._entries.get(url, {}).get("digest")
+            unchanged = digest is not None and digest == previous
+
+        with self._lock:
+            entry = self._entries.setdefault(url, {})
+            if response.status_code != 304:
+                entry["etag"] = response.headers.get("ETag")
+                entry["last_modified"] = response.headers.get("Last-Modified")
+                entry["digest"] = digest
+            if unchanged:
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry.pop("value", None)
+        return unchanged
+
+    def remember(self, url, value):
+        with self._lock:
+            self._entries.setdefault(url, {})["value"] = value
+
+    def recall(self, url):
+        with self._lock:
+            return self._entries.get(url, {}).get("value")
+
+    def forget(self, url):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+# shared by every download made by the app (see also sessions.py)
+default_tracker = ChangeTracker()
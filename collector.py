@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""Collect Weather Data from Many Stations at Once
+
+This script downloads the most recent weather conditions (and camera
+image) for every station in the station registry.  The stations are
+downloaded concurrently using a pool of worker threads, so a full sweep
+of all stations takes about as long as the slowest station rather than
+the sum of all of them.  The worker threads are started once and
+reused by every sweep.
+
+So that the BOM and AirServices Australia websites aren't flooded with
+requests, the number of requests that can be made to any one website
+(host) at the same time is limited (PER_HOST).  Every station's data is
+on www.bom.gov.au, so this limit, not the number of worker threads, is
+what sets how long a sweep of every station takes.
+
+Each station has a time budget for downloading its data and image, so a
+slow camera can't hold up a sweep; if the image can't be downloaded (in
+time, or because the camera is down, see upstream.py) the weather data
+is kept without it.  The time each station took to download is recorded
+by the custom module `metrics`.
+
+This script requires the custom modules `dl_data`, `dl_img_conv_b64`,
+`metrics` and `stations`.  All other modules used are from the Python standard
+library.
+
+This file can be imported as a module and contains the following
+classes:
+
+    * HostLimiter - limits the number of concurrent requests per host
+    * Collector - downloads the data for a list of stations
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import dl_img_conv_b64
+from dl_data import DownloadData
+from stations import StationRegistry
+import metrics
+
+# the longest (seconds) a station's data and image can take to download
+STATION_BUDGET = 20
+
+# the number of requests made to one host at the same time.  Every
+# station's data is downloaded from www.bom.gov.au, so a sweep of N
+# stations takes about N / PER_HOST times as long as one station.  4 is
+# the number of connections a browser would open to a website, so the
+# BOM doesn't see the app as abusive; that is fine when only the
+# stations due a new observation are downloaded (see cadence.py), as
+# only a few are due at once, but a sweep of hundreds of stations (e.g.
+# run_once.py, or ADAPTIVE = False) is faster with a higher limit, at
+# the cost of more load on the BOM website.  Raising it above
+# sessions.POOL_MAXSIZE also opens new connections instead of reusing
+# them.
+PER_HOST = 4
+
+
+class HostLimiter:
+    """
+    A class to limit how many requests can be made to the same host at
+    the same time.
+
+    ...
+
+    Attributes
+    ----------
+    'per_host' : int
+        The maximum number of requests allowed to a single host at once.
+
+    Methods
+    -------
+    'limit(url)'
+        A context manager that waits until a request to the host of
+        `url` is allowed, and releases it again afterwards.
+    'try_acquire(url)'
+        Takes a request to the host of `url` without waiting.  Returns
+        False if the host already has `per_host` requests (used for
+        hedged requests, see upstream.py).
+    'release(url)'
+        Gives back a request taken by try_acquire.
+    """
+
+    def __init__(self, per_host=PER_HOST):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+    @contextmanager
+    def limit(self, url):
+        semaphore = self._semaphore(url)
+        with semaphore:
+            yield
+
+    def try_acquire(self, url):
+        return self._semaphore(url).acquire(blocking=False)
+
+    def release(self, url):
+        self._semaphore(url).release()
+
+
+class Collector:
+    """
+    A class to download the most recent weather conditions for many
+    stations concurrently.
+
+    ...
+
+    Attributes
+    ----------
+    'stations' : iterable of Station
+        The stations to download data for.  Defaults to every station
+        in the station registry.
+    'max_workers' : int
+        The number of stations that can be downloaded at the same time.
+    'per_host' : int
+        The maximum number of requests made to a single host at once.
+    'image_store' : BlobStore, PackStore or None
+        If set, images are saved in this store and observations only
+        refer to them by hash (see blob_store.py and image_pack.py),
+        rather than holding the whole base64 encoded image.
+    'station_budget' : float or None
+        The longest (seconds) a station's data and image can take to
+        download.  If the image can't be downloaded in time, the data is
+        kept without the image.
+
+    Methods
+    -------
+    'fetch_station(station)'
+        Downloads the data and image for a single station.  Returns an
+        Observation, NOT_MODIFIED if the station's data hasn't changed
+        since the last sweep (the image isn't downloaded either), or
+        None if the data couldn't be downloaded.
+    'collect(stations=None)'
+        Downloads the data for every station (or only `stations`).
+        Returns a list of (station, observation) pairs in the same order
+        as the stations.
+    'collect_history(stations=None)'
+        Downloads every observation BOM has for every station (or only
+        `stations`, see DownloadData.dl_history).  Returns a list of
+        (station, list of observations) pairs in the same order as the
+        stations.
+    'close()'
+        Stops the worker threads, which are otherwise kept and reused
+        by every sweep.
+    """
+
+    def __init__(self, stations=None, max_workers=16, per_host=PER_HOST, image_store=None,
+                 station_budget=STATION_BUDGET):
+        self.stations = list(stations if stations is not None else StationRegistry())
+        self.max_workers = max_workers
+        self.limiter = HostLimiter(per_host)
+        self.image_store = image_store
+        self.station_budget = station_budget
+        self._pool_lock = threading.Lock()
+        self._pool = None
+
+    def fetch_station(self, station):
+        result = None
+        start = time.perf_counter()
+        # the data and the image must both be downloaded within the budget
+        deadline = time.monotonic() + self.station_budget if self.station_budget else None
+        try:
+            with self.limiter.limit(station.data_url):
+                result = DownloadData(deadline=deadline, limiter=self.limiter).dl_observation(station.data_url)
+
+        except Exception as ex:
+            print('Exception while getting data for station ' + str(station.wmo))
+            print(str(ex))
+            result = None
+
+        if result and station.image_url:
+            # the weather data is still kept if the image can't be
+            # downloaded (a dead camera is skipped by its circuit breaker)
+            try:
+                with self.limiter.limit(station.image_url):
+                    convert = dl_img_conv_b64.DownloadConvert(deadline=deadline,
+                                                               limiter=self.limiter)
+                    if self.image_store is not None:
+                        result.update(convert.store_image(station.image_url, self.image_store))
+                    else:
+                        image = convert.conv_img_to_b64(station.image_url)
+                        if image:
+                            result.update(local_image_b64=image)
+
+            except Exception as ex:
+                print('Exception while getting image for station ' + str(station.wmo))
+                print(str(ex))
+
+        # so a station that is slow to download can be found
+        metrics.STATION_FETCH_SECONDS.set(time.perf_counter() - start, wmo=station.wmo)
+        return result
+
+    def fetch_history(self, station):
+        result = []
+        try:
+            with self.limiter.limit(station.data_url):
+                result = DownloadData(limiter=self.limiter).dl_history(station.data_url)
+
+        except Exception as ex:
+            print('Exception while getting history for station ' + str(station.wmo))
+            print(str(ex))
+
+        return result
+
+    def _executor(self):
+        # the worker threads are started once and reused by every sweep
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='collector')
+            return self._pool
+
+    def _map(self, fetch, stations=None):
+        stations = self.stations if stations is None else list(stations)
+        if not stations:
+            return []
+        results = list(self._executor().map(fetch, stations))
+        return list(zip(stations, results))
+
+    def collect(self, stations=None):
+        return self._map(self.fetch_station, stations)
+
+    def collect_history(self, stations=None):
+        return self._map(self.fetch_history, stations)
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+if __name__ == "__main__":
+    # downloads every station in the registry and prints what was found
+    for s, observation in Collector().collect():
+        if observation is None:
+            print("{:<8}no data".format(s.wmo))
+        elif not observation:
+            print("{:<8}unchanged".format(s.wmo))
+        else:
+            print("{:<8}{}".format(s.wmo, observation.doc_id))
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+"""Find BOM Weather Stations
+
+This script finds the weather stations the BOM publishes observations
+for, so a location can be added to the station registry (stations.json)
+without looking up its URLs by hand.  For each state's product (IDN
+NSW/ACT, IDV Victoria, IDQ Queensland, IDS South Australia, IDW Western
+Australia, IDT Tasmania and IDD Northern Territory) it:
+
+    * reads the state's list of observation stations (e.g.
+        http://www.bom.gov.au/qld/observations/qldall.shtml) for the WMO
+        number and name of each station
+    * downloads each new station's observations (the JSON the weather
+        app downloads) for its name and location (lat/lon)
+    * adds the station to the registry, or updates its name and location
+        if it is already there (its image URL and timezone are kept)
+
+Every page downloaded is saved in a cache folder, so running it again
+(e.g. after it was stopped part way through) doesn't download the same
+pages again, and stations that already have a location in the registry
+are skipped.  The registry is saved every `save_every` stations.  Only
+one request is made to the BOM website every `interval` seconds.
+
+Stations with a location can be searched by distance (a k-d tree of the
+stations, see StationTree), e.g. to find the nearest stations to a place
+or to give each camera the image URL of its nearest station.
+
+This script requires that `requests` be installed within the Python
+environment you are running this script in (not needed when reading
+saved pages with `--fixtures`).
+
+This file can be imported as a module and contains the following:
+
+    * PRODUCTS - the product of each state, with its listing page and
+        timezone
+    * parse_listing - reads the stations from a state's listing page
+    * parse_station - reads the name and location from a station's JSON
+    * PageCache - saves downloaded pages in a folder
+    * RateLimiter - spaces out requests to the BOM website
+    * http_fetch - downloads a page from the BOM website
+    * fixture_fetcher - reads pages saved in a folder instead
+    * Discovery - finds stations and adds them to a registry
+    * StationTree - finds the nearest stations to a location
+    * pair_cameras - gives cameras' image URLs to their nearest stations
+
+It can also be run from the command line:
+
+    python discovery.py discover [--products IDQ IDN] [--fixtures DIR]
+    python discovery.py nearest -27.56 151.79 [-n 5]
+    python discovery.py pair cameras.json [--max-km 20]
+
+where cameras.json is a list of {"image_url": ..., "lat": ..., "lon":
+...} entries.
+"""
+
+import argparse
+import heapq
+import html
+import json
+import math
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from stations import Station, StationRegistry
+
+BOM_URL = "http://www.bom.gov.au"
+
+# product -> (state folder of its listing page, timezone of its stations)
+PRODUCTS = {
+    "IDN60801": ("nsw", "Australia/Sydney"),
+    "IDV60801": ("vic", "Australia/Melbourne"),
+    "IDQ60801": ("qld", "Australia/Brisbane"),
+    "IDS60801": ("sa", "Australia/Adelaide"),
+    "IDW60801": ("wa", "Australia/Perth"),
+    "IDT60801": ("tas", "Australia/Hobart"),
+    "IDD60801": ("nt", "Australia/Darwin"),
+}
+
+# the BOM website refuses requests without a browser-like User-Agent
+USER_AGENT = "Mozilla/5.0 (compatible; Weather-App station discovery)"
+
+# seconds between requests, and how long (seconds) saved pages are used
+INTERVAL = 1.0
+MAX_AGE = 86400
+CACHE_DIR = "bom_cache"
+
+# the furthest (km) a camera can be from the station it is given to
+PAIR_KM = 20
+EARTH_RADIUS_KM = 6371.0
+
+# e.g. <a href="/products/IDQ60801/IDQ60801.99435.shtml">Toowoomba Wellcamp</a>
+_STATION_LINK = re.compile(r'<a href="/products/(ID[A-Z]\d{5})/\1\.(\d{5})\.shtml"[^>]*>([^<]*)</a>')
+
+
+def listing_url(product):
+    state = PRODUCTS[product][0]
+    return BOM_URL + "/" + state + "/observations/" + state + "all.shtml"
+
+
+def data_url(product, wmo):
+    return "%s/fwo/%s/%s.%d.json" % (BOM_URL, product, product, wmo)
+
+
+def parse_listing(page, product):
+    """
+    Returns the (wmo, name) of every station on a state's listing page
+    (html, str or bytes), in the order they are listed.
+    """
+
+    if isinstance(page, bytes):
+        page = page.decode("utf-8", "replace")
+    found = {}
+    for link_product, wmo, name in _STATION_LINK.findall(page):
+        if link_product == product and int(wmo) not in found:
+            found[int(wmo)] = html.unescape(name).strip()
+    return list(found.items())
+
+
+def parse_station(payload):
+    """
+    Returns the name, lat and lon of a station from its observations
+    JSON (str or bytes); lat and lon are None if the station has no
+    recent observations.
+    """
+
+    observations = json.loads(payload)["observations"]
+    header = (observations.get("header") or [{}])[0]
+    data = observations.get("data") or [{}]
+    latest = data[0]
+    return {"name": latest.get("name") or header.get("name", ""),
+            "lat": latest.get("lat"), "lon": latest.get("lon")}
+
+
+class PageCache:
+    """
+    A class to save downloaded pages in a folder, one file per URL.
+
+    ...
+
+    Attributes
+    ----------
+    'root' : str
+        The folder the pages are saved in.
+    'max_age' : float
+        How long (seconds) a saved page is used before it is downloaded
+        again.
+
+    Methods
+    -------
+    'get(url)'
+        Returns the saved page (bytes), or None if it isn't saved or is
+        too old.
+    'put(url, content)'
+        Saves a page.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_age=MAX_AGE, clock=time.time):
+        self.root = root
+        self.max_age = max_age
+        self.clock = clock
+
+    def path(self, url):
+        parts = urlsplit(url)
+        names = [parts.netloc] + [p for p in parts.path.split("/") if p not in ("", ".", "..")]
+        return os.path.join(self.root, *names)
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            if self.clock() - os.path.getmtime(path) > self.max_age:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, url, content):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temporary file first so a crash can't leave a
+        # half written page behind
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+
+
+class RateLimiter:
+    """A class to make sure requests are at least `interval` seconds apart"""
+
+    def __init__(self, interval=INTERVAL, clock=time.monotonic, sleep=time.sleep):
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._last = None
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            if self._last is not None and now - self._last < self.interval:
+                self.sleep(self.interval - (now - self._last))
+                now = self.clock()
+            self._last = now
+
+
+def http_fetch(url):
+    """Downloads a page from the BOM website, returns its content (bytes)"""
+
+    import sessions
+    import upstream
+
+    response = upstream.get(sessions.get_session(), url, headers={"User-Agent": USER_AGENT})
+    response.raise_for_status()
+    return response.content
+
+
+def fixture_fetcher(root):
+    """
+    Returns a function that reads pages from a folder instead of the
+    BOM website: the page for http://www.bom.gov.au/qld/observations/
+    qldall.shtml is read from <root>/qld/observations/qldall.shtml, or
+    from <root>/qldall.shtml.
+    """
+
+    def fetch(url):
+        names = [p for p in urlsplit(url).path.split("/") if p not in ("", ".", "..")]
+        for path in (os.path.join(root, *names), os.path.join(root, names[-1])):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    return f.read()
+        raise FileNotFoundError("No saved page for " + url)
+
+    return fetch
+
+
+class Discovery:
+    """
+    A class to find BOM weather stations and add them to a station
+    registry.
+
+    ...
+
+    Attributes
+    ----------
+    'registry' : StationRegistry
+        The registry the stations are added to.
+    'fetch' : function
+        Called with a URL, returns the page's content (bytes).  Defaults
+        to http_fetch; fixture_fetcher(folder) reads saved pages.
+    'cache' : PageCache or None
+        Where downloaded pages are saved, None to not save them.
+    'limiter' : RateLimiter or None
+        Spaces out the requests made by `fetch` (pages read from the
+        cache aren't limited).
+    'save_every' : int
+        The registry is saved after this many stations are added or
+        updated.
+
+    Methods
+    -------
+    'get(url)'
+        Returns a page from the cache, or downloads (and caches) it.
+    'stations(product)'
+        Returns the (wmo, name) of every station in a product's listing.
+    'discover(products=None, refresh=False, limit=None)'
+        Adds every station of the products (default: every state) to
+        the registry.  Stations that already have a location are
+        skipped unless `refresh` is True.  `limit` stops after that
+        many stations have been downloaded.  Returns the number of
+        stations listed, added, updated, skipped and failed.
+    """
+
+    def __init__(self, registry, fetch=None, cache=None, limiter=None, save_every=25):
+        self.registry = registry
+        self.fetch = fetch if fetch is not None else http_fetch
+        self.cache = cache
+        self.limiter = limiter
+        self.save_every = save_every
+
+    def get(self, url):
+        if self.cache is not None:
+            content = self.cache.get(url)
+            if content is not None:
+                return content
+        if self.limiter is not None:
+            self.limiter.wait()
+        content = self.fetch(url)
+        if self.cache is not None:
+            self.cache.put(url, content)
+        return content
+
+    def stations(self, product):
+        return parse_listing(self.get(listing_url(product)), product)
+
+    def _update(self, product, wmo, name):
+        # returns "added" or "updated"; everything set by hand (image,
+        # timezone) is kept for stations already in the registry
+        url = data_url(product, wmo)
+        details = parse_station(self.get(url))
+        existing = self.registry.get(wmo)
+        if existing is None:
+            self.registry.add(Station(wmo, url, None, details["name"] or name,
+                                      PRODUCTS[product][1], details["lat"], details["lon"]))
+            return "added"
+        existing.name = existing.name or details["name"] or name
+        if details["lat"] is not None:
+            existing.lat, existing.lon = details["lat"], details["lon"]
+        return "updated"
+
+    def discover(self, products=None, refresh=False, limit=None):
+        counts = {"listed": 0, "added": 0, "updated": 0, "skipped": 0, "failed": 0}
+        changed = 0
+        downloaded = 0
+        try:
+            for product in products or PRODUCTS:
+                try:
+                    listed = self.stations(product)
+                except Exception as ex:
+                    print('Error in reading the station list of ' + product)
+                    print(str(ex))
+                    counts["failed"] += 1
+                    continue
+                counts["listed"] += len(listed)
+                for wmo, name in listed:
+                    existing = self.registry.get(wmo)
+                    if not refresh and existing is not None and existing.lat is not None:
+                        counts["skipped"] += 1
+                        continue
+                    if limit is not None and downloaded >= limit:
+                        return counts
+                    downloaded += 1
+                    try:
+                        counts[self._update(product, wmo, name)] += 1
+                    except Exception as ex:
+                        print('Error in reading station ' + str(wmo))
+                        print(str(ex))
+                        counts["failed"] += 1
+                        continue
+                    changed += 1
+                    if changed % self.save_every == 0:
+                        self.registry.save()
+            return counts
+        finally:
+            if changed:
+                self.registry.save()
+
+
+def _point(lat, lon):
+    # the location as a point on a sphere of radius 1, so the straight
+    # line distance between points orders them the same way as the
+    # distance along the earth's surface
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def _km(chord_squared):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord_squared) / 2))
+
+
+class StationTree:
+    """
+    A class to find the stations nearest to a location, using a k-d
+    tree of the stations that have a location.
+
+    ...
+
+    Methods
+    -------
+    'nearest(lat, lon, n=1, max_km=None)'
+        Returns up to `n` (distance in km, station) pairs, nearest
+        first, only including stations within `max_km`.
+    """
+
+    def __init__(self, stations):
+        points = [(_point(s.lat, s.lon), s) for s in stations
+                  if s.lat is not None and s.lon is not None]
+        self._root = self._build(points, 0)
+        self._size = len(points)
+
+    def _build(self, points, axis):
+        # each node is (point, station, axis, left, right)
+        if not points:
+            return None
+        points.sort(key=lambda p: p[0][axis])
+        middle = len(points) // 2
+        following = (axis + 1) % 3
+        return (points[middle][0], points[middle][1], axis,
+                self._build(points[:middle], following),
+                self._build(points[middle + 1:], following))
+
+    def nearest(self, lat, lon, n=1, max_km=None):
+        target = _point(lat, lon)
+        # the chord length of max_km (squared), so nodes further away
+        # than it are never visited
+        limit = float("inf") if max_km is None else \
+            (2 * math.sin(min(math.pi, max_km / EARTH_RADIUS_KM) / 2)) ** 2
+        best = []  # heap of (-distance squared, order, station)
+        # (node, the least distance squared of anything under it)
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, least = stack.pop()
+            if node is None or least > limit:
+                continue
+            point, station, axis, left, right = node
+            d2 = sum((a - b) ** 2 for a, b in zip(point, target))
+            if d2 <= limit:
+                heapq.heappush(best, (-d2, station.wmo, station))
+                if len(best) > n:
+                    heapq.heappop(best)
+                if len(best) == n:
+                    limit = min(limit, -best[0][0])
+            difference = target[axis] - point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            # the near side is searched first, the far side only if it
+            # could still be close enough by then
+            stack.append((far, max(least, difference ** 2)))
+            stack.append((near, least))
+        return [(_km(-d2), station) for d2, _, station in sorted(best, reverse=True)]
+
+    def __len__(self):
+        return self._size
+
+
+def pair_cameras(registry, cameras, max_km=PAIR_KM):
+    """
+    Gives each camera's image URL to the nearest station (within
+    `max_km`) that doesn't have a camera, closest pairs first, so each
+    station gets at most one camera.  `cameras` is a list of dictionaries
+    with "image_url", "lat" and "lon".  Returns a list of (camera,
+    station, distance in km) for the cameras that were paired; the
+    registry isn't saved.
+    """
+
+    tree = StationTree(s for s in registry if not s.image_url)
+    candidates = []
+    for i, camera in enumerate(cameras):
+        for km, station in tree.nearest(camera["lat"], camera["lon"], n=3, max_km=max_km):
+            candidates.append((km, i, station))
+    candidates.sort(key=lambda c: (c[0], c[1]))
+    paired = []
+    used = set()
+    for km, i, station in candidates:
+        if i in used or station.image_url:
+            continue
+        station.image_url = cameras[i]["image_url"]
+        used.add(i)
+        paired.append((cameras[i], station, km))
+    return paired
+
+
+def _product(name):
+    # "IDQ" or "IDQ60801" -> "IDQ60801"
+    name = name.upper()
+    return name if name in PRODUCTS else name + "60801"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find BOM weather stations")
+    parser.add_argument("--registry", default=None, help="station registry file (default: stations.json)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("discover", help="add the BOM's stations to the registry")
+    p.add_argument("--products", nargs="+", type=_product, choices=list(PRODUCTS), metavar="PRODUCT",
+                   help="state products to read, e.g. IDQ IDN (default: every state)")
+    p.add_argument("--cache-dir", default=CACHE_DIR, help="folder downloaded pages are saved in")
+    p.add_argument("--max-age", type=float, default=MAX_AGE, help="seconds saved pages are used for")
+    p.add_argument("--interval", type=float, default=INTERVAL, help="seconds between requests")
+    p.add_argument("--fixtures", help="read saved pages from this folder instead of the BOM website")
+    p.add_argument("--refresh", action="store_true", help="update stations that have a location")
+    p.add_argument("--limit", type=int, help="stop after downloading this many stations")
+
+    p = sub.add_parser("nearest", help="list the stations nearest to a location")
+    p.add_argument("lat", type=float)
+    p.add_argument("lon", type=float)
+    p.add_argument("-n", type=int, default=5)
+
+    p = sub.add_parser("pair", help="give cameras' image URLs to their nearest stations")
+    p.add_argument("cameras", help='json list of {"image_url", "lat", "lon"}')
+    p.add_argument("--max-km", type=float, default=PAIR_KM)
+    args = parser.parse_args()
+
+    registry = StationRegistry(args.registry) if args.registry else StationRegistry()
+    if args.command == "discover":
+        if args.fixtures:
+            discovery = Discovery(registry, fixture_fetcher(args.fixtures))
+        else:
+            discovery = Discovery(registry, cache=PageCache(args.cache_dir, args.max_age),
+                                  limiter=RateLimiter(args.interval))
+        print(discovery.discover(args.products, args.refresh, args.limit))
+    elif args.command == "nearest":
+        for km, station in StationTree(registry).nearest(args.lat, args.lon, args.n):
+            print("%6.1f km  %d  %s" % (km, station.wmo, station.name))
+    else:
+        with open(args.cameras) as f:
+            cameras = json.load(f)
+        paired = pair_cameras(registry, cameras, args.max_km)
+        for camera, station, km in paired:
+            print("%6.1f km  %d  %s  %s" % (km, station.wmo, station.name, camera["image_url"]))
+        if paired:
+            registry.save()
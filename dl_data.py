@@ -5,8 +5,9 @@
 This script allows the user to download the most recently available
 weather conditions for a specific location from the Bureau of
 Meteorology (BOM) website, manipulate that data including adding
-a base64 encoded image of the location at that time, and then converts
-that data back into json format.
+a base64 encoded image of the location at that time and the derived
+fields from the custom module `enrichers` (wind angle, epoch date and
+numeric values), and then converts that data back into json format.
 
 Currently being tested on data from Toowoomba Wellcamp Airport.
 `http://www.bom.gov.au/fwo/IDQ60801/IDQ60801.99435.json`
@@ -14,27 +15,44 @@ Currently being tested on data from Toowoomba Wellcamp Airport.
 This script requires that several pypi modules be installed within the
 Python environment you are running this script in.  These modules are
 `requests` to access online content, `json` to convert data to and from
-json format, and `datetime` to change how dates & times are displayed.
-
-This script also requires two accompanying custom modules be installed.
-These modules are: `dl_img_conv_b64` (to download an image and convert
-to base64) and `wellcamp_urls` (containing the links to the most recent
-data and image from the target location, Wellcamp Airport).
+json format (dates & times are formatted for display by `latest_cache`).
+Downloads are made through the shared session from `sessions` so that
+connections to the BOM website are kept open and reused, and data that
+hasn't changed since the last download is detected using the custom
+module `change_detection`.  Every download has a timeout and goes
+through the custom module `upstream` (hedged requests and circuit
+breakers).
+
+This script also requires the accompanying custom module
+`dl_img_conv_b64` (to download an image and convert to base64) be
+installed.  The time each download takes and its size are recorded by
+the custom module `metrics`.  The URLs of the data and image for each location are kept in
+the station registry (see `stations.py`) rather than in this module.
 
 The dl_data python file can be imported as a module and contains the
 following functions:
 
     * __init__ - to construct the main function
-    * dl_weather - returns the data as a dictionary in JSON format
+    * dl_observation - returns the data as an `Observation` (see
+        observation.py; it behaves like a dictionary of the JSON data and
+        also knows its own document id)
+    * dl_weather - as dl_observation, with the base64 encoded image of
+        the location added to the data
+    * dl_history - returns every observation in the BOM data (about the
+        last three days, half-hourly) as a list of `Observation`s
     * dl_time - extracts a human-readable version of the local time
         from the BOM data
 """
 
-import requests
 import json
-import datetime
 import dl_img_conv_b64
-from wellcamp_urls import image_url, data_url
+import sessions
+import enrichers
+import metrics
+import upstream
+from observation import Observation, loads
+from change_detection import NOT_MODIFIED, default_tracker
+from latest_cache import default_cache, format_local_time
 
 
 class DownloadData:
@@ -52,25 +70,125 @@ class DownloadData:
     'image_url' : str
         The URL of the image to be downloaded from AirServiceAus site
         Defined outside of the scope of the class.
+    'session' : requests.Session
+        The session used to make the downloads.  Defaults to the shared
+        session from the `sessions` module.
+    'tracker' : ChangeTracker
+        Remembers what was last downloaded from each URL.  Defaults to
+        the shared tracker from the `change_detection` module.
+    'cache' : LatestCache
+        The latest observation of each station, used by dl_time instead
+        of downloading the data again.  Defaults to the shared cache
+        from the `latest_cache` module.
+    'deadline' : float or None
+        The time (time.monotonic) downloads must finish by; None only
+        uses the usual timeouts (see upstream.py).
+    'limiter' : HostLimiter or None
+        The per host limit the downloads are made under (see
+        collector.py); a hedged request is only sent if it leaves a
+        request free for the host.  None hedges without a limit.
 
     Methods
     -------
+    'dl_observation(data_url)'
+        Downloads the most recent weather conditions at a set location
+        as an Observation, without an image.
+    'dl_history(data_url)'
+        Downloads all of the weather conditions BOM has for a set location
+        (about the last 72 hours) as a list of Observations.
     'dl_weather(data_url, image_url)'
         Downloads the most recent weather conditions at a set location
-        as a dictionary, adds to that data the base64 representation of
+        as an Observation, adds to that data the base64 representation of
         an image that is the current view of that location.
      'dl_time(data_url)'
         Extracts the time that the most recent weather conditions data
         was uploaded and returns it in a neat, human readable format.
+        Uses the latest observation in the cache if there is one.
     """
 
-    def __init__(self):
+    def __init__(self, session=None, tracker=None, cache=None, deadline=None, limiter=None):
         """
         The constructor for DownloadData class.
-        Only used to construct the class currently.
+        Sets the session, change tracker and latest conditions cache
+        used to make the downloads, the time (time.monotonic) the
+        downloads must finish by, and the per host limit they are made
+        under.
+        """
+
+        self.session = session if session is not None else sessions.get_session()
+        self.tracker = tracker if tracker is not None else default_tracker
+        self.cache = cache if cache is not None else default_cache
+        self.deadline = deadline
+        self.limiter = limiter
+
+    def dl_observation(self, data_url):
+        """
+        Method called upon to download the most recent weather conditions
+        at a specific location from the BOM website, without adding an
+        image.  Returns an Observation, NOT_MODIFIED if the data hasn't
+        changed since it was last downloaded, or None if the data
+        couldn't be retrieved (HTTP status code not 200 or 304).
+        """
+
+        with metrics.timed('bom_fetch'):
+            x = upstream.get(self.session, data_url, headers=self.tracker.request_headers(data_url),
+                             deadline=self.deadline, limiter=self.limiter)
+        metrics.BYTES.inc(len(x.content), source='bom')
+        metrics.PAYLOAD_BYTES.observe(len(x.content), kind='bom')
+
+        # Gets information from website and turns it into a usable format
+        # [0] is the position of the most recent dataset inserted into the list of datasets ["data"]
+
+        if x.status_code in (200, 304) and self.tracker.is_unchanged(data_url, x, x.content):
+            result = NOT_MODIFIED
+
+        elif x.status_code == 200:
+            try:
+                # Converts BOM's strings into numbers and leaves out the
+                # unnecessary "sort order" value (see observation.py)
+                result = Observation.from_bom(loads(x.content)["observations"]["data"][0])
+                # Adds the derived fields (wind angle, epoch date)
+                enrichers.enrich(result)
+            except Exception:
+                # the data was remembered as seen by is_unchanged, so it
+                # is forgotten again or it would be NOT_MODIFIED until
+                # BOM publishes the next observation
+                self.tracker.forget(data_url)
+                raise
+
+        else:
+            print('Data Couldn\'t be retrieved')
+            result = None
+
+        return result
+
+    def dl_history(self, data_url):
         """
+        Method called upon to download every observation BOM has for a
+        specific location, most recent first.  BOM keeps about the last
+        72 hours of half-hourly observations in the same data that the
+        most recent observation comes from, so one download is enough to
+        fill in up to three days of missing data.  Always downloads the
+        data (does not check if it has changed).  Returns a list of
+        Observations (without images), or an empty list if the data
+        couldn't be retrieved (HTTP status code != 200).
+        """
+
+        with metrics.timed('bom_fetch'):
+            x = upstream.get(self.session, data_url, deadline=self.deadline, limiter=self.limiter)
+        metrics.BYTES.inc(len(x.content), source='bom')
+        result = []
 
-        pass
+        if x.status_code == 200:
+            for record in loads(x.content)["observations"]["data"]:
+                y = Observation.from_bom(record)
+                enrichers.enrich(y)
+                result.append(y)
+
+        else:
+            print('Data Couldn\'t be retrieved')
+
+        return result
 
     def dl_weather(self, data_url, image_url):
         """
@@ -103,46 +221,38 @@ class DownloadData:
             of the object being downloaded. Setting decode_content=True
             forces the decompression of the response.raw file-like object.
 
-        `result` : str [in utf-8 format]
-            The string representation of the base64 encoded image.
-            Encoded into utf-8 format to return string without the [b' '].
+        `result` : Observation
+            The most recent weather conditions, including the base64
+            encoded image under the key `local_image_b64`.
 
         Raises
         ------
         status.code if/else statement:
-            Checks if image was retrieved successfully (HTTP Status = 200).
-            If image download fails, (HTTP status code != 200), an error
-            message is printed in the console.
+            Checks if data was retrieved successfully (HTTP Status = 200).
+            If the data download fails, (HTTP status code != 200), an
+            error message is printed in the console and None is returned.
         """
 
-        x = requests.get(data_url)
+        result = self.dl_observation(data_url)
 
-        # Gets information from website and turns it into a usable format
-        # [0] is the position of the most recent dataset inserted into the list of datasets ["data"]
-
-        if x.status_code == 200:
-
-            y = json.loads(x.text)["observations"]["data"][0]
+        if result:
             # adds base64 image to data
-            y.update(local_image_b64=dl_img_conv_b64.DownloadConvert().conv_img_to_b64(image_url))
-            # Removes the unnecessary "sort order" value;
-            y.pop("sort_order", None)
-
-            result = str(y)
-
-        else:
-            result = str('Data Couldn\'t be retrieved')
+            result.update(local_image_b64=dl_img_conv_b64.DownloadConvert(self.session, self.tracker).conv_img_to_b64(image_url))
 
         return result
 
     def dl_time(self, data_url):
-        # defined in previous function
-        x = requests.get(data_url)
-        y = json.loads(x.text)["observations"]["data"][0]["local_date_time_full"]
+        # uses the latest observation in the cache (see latest_cache.py)
+        # and only downloads the data if it isn't there or has expired
+        cached = self.cache.get_url(data_url) if self.cache is not None else None
+        if cached is not None:
+            y = cached["local_date_time_full"]
+        else:
+            x = upstream.get(self.session, data_url, deadline=self.deadline, limiter=self.limiter)
+            y = json.loads(x.text)["observations"]["data"][0]["local_date_time_full"]
 
         # Creates a heading for displaying the current dataset with it's time as part of the heading
-        t1 = datetime.datetime.strptime(y, "%Y%m%d%H%M%S")
-        t2 = datetime.datetime.strftime(t1, '%A, %d %B %Y %H:%M:%S')
+        t2 = format_local_time(y)
 
         # prints the local time that the data was uploaded to the BOM website
         return t2
@@ -174,6 +284,9 @@ if __name__ == "__main__":
         returns the result.
     """
 
-    output_weather = DownloadData().dl_weather(data_url, image_url)
-    output_time = DownloadData().dl_time(data_url)
-    print(output_time + "\n" + output_weather)
+    from stations import StationRegistry
+
+    station = next(iter(StationRegistry()))
+    output_weather = DownloadData().dl_weather(station.data_url, station.image_url)
+    output_time = DownloadData().dl_time(station.data_url)
+    print(output_time + "\n" + str(output_weather))
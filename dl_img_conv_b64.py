@@ -9,21 +9,40 @@ This tool is currently confirmed to work on jpg and png files.
 
 This script requires that several pypi modules be installed within the 
 Python environment you are running this script in.  These modules are
-`requests` to access online content, `shutil` to save the image locally
-on your device, and `base64` to do the encoding of the binary data of 
-the image into base64.
+`requests` to access online content (through the shared session from
+the custom module `sessions`, with timeouts and circuit breakers from
+the custom module `upstream`), and `base64` to do the encoding of the
+binary data of the image into base64.  The time taken to download and
+encode each image, and its size, are recorded by the custom module
+`metrics`.
+
+The image is never saved to a file: it is read from the website in
+chunks and each chunk is encoded into base64 as it arrives, so several
+images can be downloaded at the same time without using the disk.
 
 This file can also be imported as a module and contains the following
 functions:
 
     * __init__ - to construct the main function
     * conv_img_to_b64 - returns the image converted into base64 format.
+    * store_image - saves the image in an image store (see blob_store)
+        and returns its hash, size and dimensions.
 """
 
 
-import requests  
-import shutil  
 import base64  
+import hashlib
+import time
+
+import sessions
+import metrics
+import upstream
+from change_detection import default_tracker
+
+# the size of the chunks the image is read and encoded in, and the
+# largest image (in bytes) that will be downloaded
+CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
 
 
 class DownloadConvert:      
@@ -38,21 +57,125 @@ class DownloadConvert:
     'image_url' : str
         The URL of the image to be downloaded.
         Defined outside of the scope of the class.
+    'session' : requests.Session
+        The session used to download the image.  Defaults to the shared
+        session from the `sessions` module.
+    'tracker' : ChangeTracker
+        Remembers the last image downloaded from each URL so an
+        unchanged image isn't encoded again.  Defaults to the shared
+        tracker from the `change_detection` module.
+    'max_bytes' : int
+        The largest image (in bytes) that will be downloaded.
+    'deadline' : float or None
+        The time (time.monotonic) the download must finish by, including
+        reading the image; None only uses the usual timeouts (see
+        upstream.py).
+    'limiter' : HostLimiter or None
+        The per host limit the download is made under (see
+        collector.py); a hedged request is only sent if it leaves a
+        request free for the host.  None hedges without a limit.
 
     Methods
     -------
     'conv_img_to_b64(image_url)'
         Downloads an online image, then converts it to Base64 and then 
         returns the result.
+    'store_image(image_url, store)'
+        Downloads an online image, saves it in `store` (a BlobStore, or a
+        PackStore, see image_pack.py) and returns the fields that refer to
+        it from an observation.
     """
 
-    def __init__(self):    
+    def __init__(self, session=None, tracker=None, max_bytes=MAX_IMAGE_BYTES, deadline=None,
+                 limiter=None):
         """
         The constructor for DownloadConvert class.
-        Only used to construct the class currently.
+        Sets the session and change tracker used to download the image,
+        the largest image that will be downloaded, the time
+        (time.monotonic) the download must finish by, and the per host
+        limit it is made under.
         """
-    
-        pass 
+
+        self.session = session if session is not None else sessions.get_session()
+        self.tracker = tracker if tracker is not None else default_tracker
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self.limiter = limiter
+
+    def _chunks(self, response):
+        # the image's chunks, stopping if the image is too large
+        length = int(response.headers.get('Content-Length') or 0)
+        if length > self.max_bytes:
+            raise ValueError('Image is larger than ' + str(self.max_bytes) + ' bytes')
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > self.max_bytes:
+                raise ValueError('Image is larger than ' + str(self.max_bytes) + ' bytes')
+            # a camera sending the image very slowly can't take longer
+            # than the deadline, even though each read is within the timeout
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise ValueError('Image took too long to download')
+            yield chunk
+        metrics.BYTES.inc(size, source='image')
+        metrics.PAYLOAD_BYTES.observe(size, kind='image')
+
+    def stream_to_bytes(self, response):
+        """
+        Reads the body of `response` in chunks into a buffer allocated up
+        front from the Content-Length header.  Returns the image (bytes),
+        or raises ValueError if the image is larger than `max_bytes`.
+        """
+
+        content = bytearray(int(response.headers.get('Content-Length') or 0))
+        position = 0
+        for chunk in self._chunks(response):
+            content[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        del content[position:]
+        return bytes(content)
+
+    def stream_to_b64(self, response):
+        """
+        Reads the body of `response` in chunks and encodes it into base64
+        as it arrives.  Each chunk is split on a multiple of 3 bytes (the
+        leftover bytes are carried into the next chunk) so the encoded
+        chunks join up into exactly the same string as encoding the
+        whole image at once.  The output buffer is allocated up front
+        from the Content-Length header when the website sends one.
+        Returns the encoded image (bytes) and the sha1 hex digest of the
+        image, or raises ValueError if the image is larger than
+        `max_bytes`.
+        """
+
+        length = int(response.headers.get('Content-Length') or 0)
+        encoded = bytearray(4 * ((length + 2) // 3))
+        position = 0
+        carry = b''
+        digest = hashlib.sha1()
+        # the time spent encoding (not waiting for the website)
+        encoding = 0.0
+
+        for chunk in self._chunks(response):
+            digest.update(chunk)
+            data = carry + chunk
+            cut = len(data) - len(data) % 3
+            carry = data[cut:]
+            start = time.perf_counter()
+            part = base64.b64encode(data[:cut])
+            encoding += time.perf_counter() - start
+            # fills the preallocated buffer (and grows it if the
+            # Content-Length header was too small)
+            encoded[position:position + len(part)] = part
+            position += len(part)
+
+        part = base64.b64encode(carry)
+        encoded[position:position + len(part)] = part
+        position += len(part)
+        del encoded[position:]
+        metrics.STAGE_SECONDS.observe(encoding, stage='b64_encode')
+
+        return bytes(encoded), digest.hexdigest()
 
     def conv_img_to_b64(self, image_url):     
         """
@@ -65,24 +188,17 @@ class DownloadConvert:
         `image_url` : str
             The URL of the image to be downloaded.
             Defined outside of the scope of the method.
-        `returned_object` : file-like object
+        `returned_object` : requests.Response
             Object containing the image URL server's response to the HTTP
-            GET request.  `raw` is used to create a file-like object
-            representation of the response. Use of raw requires that
-            stream=True be set on the request. stream=True guarantees no
-            interruptions while downloading the image, avoiding corruption
-            of the object being downloaded. Setting decode_content=True
-            forces the decompression of the response.raw file-like object.
-        `filename` : file object (in binary)
-            The shutil.copyfileobj() sends the data from returned_object to
-            a local file object with the name `filename'.  A new file is
-            created if a file named `filename` doesn't exist.  Any local
-            file with the same name will be overwrriten.  The name of the
-            file object `filename` is created using slice notation to
-            separate the name from the image URL.
+            GET request.  stream=True is set on the request so the image
+            is read in chunks (see stream_to_b64) rather than all at once,
+            and is never written to a file.
         `result` : str [in utf-8 format]
             The string representation of the base64 encoded image.
             Encoded into utf-8 format to return string without the [b' '].
+            If the image hasn't changed since it was last downloaded
+            (HTTP status 304, or the same content hash) the result from
+            last time is returned without encoding the image again.
 
         Raises
         ------
@@ -91,27 +207,88 @@ class DownloadConvert:
             If image download fails, (HTTP status code != 200), an error
             message is printed in the console.
         """
-    
-        returned_object = requests.get(image_url, stream=True)
-        filename = image_url.split("/")[-1]
-        result = ""         
 
-        if returned_object.status_code == 200:   
-            returned_object.raw.decode_content = True
+        # only ask "has it changed?" if the last result is still saved
+        previous = self.tracker.recall(image_url)
+        headers = self.tracker.request_headers(image_url) if previous is not None else {}
+
+        # times the whole download, including reading the image in chunks
+        start = time.perf_counter()
+        # each camera has its own circuit breaker (they share a host)
+        returned_object = upstream.get(self.session, image_url, stream=True, headers=headers,
+                                       deadline=self.deadline, breaker_key=image_url,
+                                       limiter=self.limiter)
+        result = ""         
 
-            with open(filename, 'wb') as f:     
-                shutil.copyfileobj(returned_object.raw, f)   
-            f.close()                           
+        if returned_object.status_code == 304 and previous is not None:
+            self.tracker.is_unchanged(image_url, returned_object)
+            result = previous
 
-            with open(filename, "rb") as f:      
-                result = base64.b64encode(f.read()).decode('utf-8')  
-            f.close()                        
+        elif returned_object.status_code == 200:   
+            try:
+                encoded, digest = self.stream_to_b64(returned_object)
+            except ValueError as ex:
+                print('Image Couldn\'t be retrieved: ' + str(ex))
+            else:
+                if self.tracker.is_unchanged(image_url, returned_object, digest=digest) and previous is not None:
+                    result = previous
+                else:
+                    result = encoded.decode('utf-8')  
+                    self.tracker.remember(image_url, result)
 
         else:       
             print('Image Couldn\'t be retrieved')
 
+        returned_object.close()
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage='image_fetch')
         return result       
 
+    def store_image(self, image_url, store):
+        """
+        Method called upon to download the image and save it in an image
+        store rather than converting it to base64.  Returns a dictionary
+        of the image's sha256 hash, size and dimensions (the fields an
+        observation uses to refer to the image), or an empty dictionary
+        if the image couldn't be retrieved.  If the image hasn't changed
+        since it was last downloaded, the fields from last time are
+        returned and nothing is saved.
+        """
+
+        previous = self.tracker.recall(image_url)
+        headers = self.tracker.request_headers(image_url) if previous is not None else {}
+
+        # times the whole download, including reading the image in chunks
+        start = time.perf_counter()
+        # each camera has its own circuit breaker (they share a host)
+        returned_object = upstream.get(self.session, image_url, stream=True, headers=headers,
+                                       deadline=self.deadline, breaker_key=image_url,
+                                       limiter=self.limiter)
+        result = {}
+
+        if returned_object.status_code == 304 and previous is not None:
+            self.tracker.is_unchanged(image_url, returned_object)
+            result = previous
+
+        elif returned_object.status_code == 200:
+            try:
+                content = self.stream_to_bytes(returned_object)
+            except ValueError as ex:
+                print('Image Couldn\'t be retrieved: ' + str(ex))
+            else:
+                digest = hashlib.sha256(content).hexdigest()
+                if self.tracker.is_unchanged(image_url, returned_object, digest=digest) and previous is not None:
+                    result = previous
+                else:
+                    result = store.put(content, source=image_url)
+                    self.tracker.remember(image_url, result)
+
+        else:
+            print('Image Couldn\'t be retrieved')
+
+        returned_object.close()
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage='image_fetch')
+        return dict(result)
+
 
 if __name__ == "__main__":      # an internal test; when module is run directly, do the following:
     """ 
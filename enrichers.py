@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Derived Fields Added at Download Time
+
+This script adds fields worked out from the BOM data (e.g. the wind
+direction as an angle) to each observation when it is downloaded,
+rather than filling them in afterwards with Painless `_update_by_query`
+scripts that rewrite every document in the index.
+
+Each derived field is made by an "enricher": a function that takes an
+observation (a dictionary) and adds or changes fields in it.  New fields
+can be added by registering another enricher, and only observations
+downloaded from then on are affected; nothing has to be reindexed.
+
+    from enrichers import register
+
+    @register
+    def feels_colder(record):
+        if record.get("apparent_t") is not None and record.get("air_temp") is not None:
+            record["feels_colder"] = record["apparent_t"] < record["air_temp"]
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following:
+
+    * register - adds an enricher to the list that is run on every
+        observation
+    * enrich - runs every registered enricher on an observation
+    * parse_number - converts one of BOM's numeric strings, and the "-"
+        placeholders to None (also used by Observation.from_bom, see
+        observation.py)
+    * parse_numbers - converts every numeric field that is still a
+        string (e.g. documents indexed before this module existed)
+    * add_wind_angle - the compass wind direction as an angle (wind_angle)
+    * add_epoch_date - the observation time in milliseconds since 1970
+        (epoch_date)
+    * add_useful_date - the observation time as the date field Kibana
+        uses (useful_date), which used to be filled in by a Painless
+        script
+"""
+
+import calendar
+
+from index_mapping import PROPERTIES
+
+ENRICHERS = []
+
+
+def register(enricher):
+    # can be used as a decorator; returns the function unchanged
+    ENRICHERS.append(enricher)
+    return enricher
+
+
+def enrich(record):
+    for enricher in ENRICHERS:
+        enricher(record)
+    return record
+
+
+def _to_float(value):
+    return float(value)
+
+
+def _to_int(value):
+    return int(float(value))
+
+
+# the function used to convert each numeric field, from the mapping
+_CONVERTERS = {"float": _to_float, "integer": _to_int}
+NUMERIC_FIELDS = {name: _CONVERTERS[spec["type"]] for name, spec in PROPERTIES.items()
+                  if spec["type"] in _CONVERTERS}
+
+# values BOM uses when there is no reading
+MISSING = {"-", "", "--"}
+
+# compass points in degrees, clockwise from north
+WIND_ANGLES = {
+    "N": 0.0, "NNE": 22.5, "NE": 45.0, "ENE": 67.5,
+    "E": 90.0, "ESE": 112.5, "SE": 135.0, "SSE": 157.5,
+    "S": 180.0, "SSW": 202.5, "SW": 225.0, "WSW": 247.5,
+    "W": 270.0, "WNW": 292.5, "NW": 315.0, "NNW": 337.5,
+}
+
+
+def parse_number(value, convert):
+    # the only place BOM's numeric strings are converted
+    if value.strip() in MISSING:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        return None
+
+
+@register
+def parse_numbers(record):
+    # observations made by Observation.from_bom have no strings left, so
+    # this only has work to do for documents from elsewhere
+    for name, convert in NUMERIC_FIELDS.items():
+        value = record.get(name)
+        if isinstance(value, str):
+            record[name] = parse_number(value, convert)
+
+
+@register
+def add_wind_angle(record):
+    # "CALM" and variable winds have no direction
+    record["wind_angle"] = WIND_ANGLES.get(record.get("wind_dir"))
+
+
+@register
+def add_epoch_date(record):
+    # aifstime_utc is the observation time in UTC, e.g. 20210517033000
+    value = record.get("aifstime_utc")
+    if value and len(str(value)) == 14:
+        t = str(value)
+        record["epoch_date"] = calendar.timegm((int(t[0:4]), int(t[4:6]), int(t[6:8]),
+                                                int(t[8:10]), int(t[10:12]), int(t[12:14]))) * 1000
+    else:
+        # documents saved without aifstime_utc keep the epoch_date they
+        # were saved with
+        record.setdefault("epoch_date", None)
+
+
+@register
+def add_useful_date(record):
+    # the same time as epoch_date, in the date field the Kibana
+    # visualisations use (see "other useful files/painless_queries.txt")
+    record["useful_date"] = record.get("epoch_date")
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+
+"""Append-Only Image Packs
+
+This script saves every frame from each camera into one file per camera
+(a "pack"), instead of one file per image (blob_store.py) or base64 text
+in every Elasticsearch document.  Frames are only ever added to the end
+of a pack, next to a small index file with one fixed-size entry per
+frame:
+
+    timestamp (milliseconds since 1970, 8 bytes), offset of the frame in
+    the pack (8 bytes), length (4 bytes), sha256 of the frame (32 bytes)
+
+Because every entry is the same size and the entries are in time order,
+the frame at any time is found by a binary search of the index (without
+reading all of it), and the frame is read from the pack with one seek.
+Both files are memory-mapped, so frames are returned as memoryviews of
+the pack rather than copies, and nothing is decoded.  Frames can also be
+streamed over a period of time, e.g. one frame an hour for a timelapse.
+
+If the app stops while a frame is being added, the part-written frame
+is removed the next time the pack is opened: entries at the end of the
+index are only kept if the frame follows the one before it, is all in
+the pack and has the hash in the entry (a crash can also leave the end
+of a file filled with zeros).  See benchmarks/bench_image_pack.py.
+
+    image_packs/041529_045/frames.pack
+    image_packs/041529_045/frames.idx
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following:
+
+    * Frame - the index entry of a frame
+    * ImagePack - the pack of one camera
+    * PackStore - a folder of packs, one per camera, that can be used
+        as the image store of the collector and sinks instead of a
+        BlobStore
+    * camera_source - the source a station's images are saved under,
+        the same as the collector uses
+    * open_store - opens a folder of images as a PackStore or a
+        BlobStore, whichever it holds
+
+It can also be run from the command line to list the packs, or to save
+the frames of one camera over a period as numbered files for a
+timelapse (e.g. with ffmpeg -i frame_%05d.jpg):
+
+    python image_pack.py list [--root image_packs]
+    python image_pack.py frames 041529_045 --output timelapse
+        [--start 2021-05-01] [--end 2021-06-01] [--every 3600]
+"""
+
+import argparse
+import bisect
+import collections
+import datetime
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from urllib.parse import urlsplit
+
+from blob_store import BlobStore, image_dimensions
+
+# the first bytes of every index file
+MAGIC = b"WXPACK01"
+# timestamp, offset, length, sha256
+INDEX_FORMAT = struct.Struct("<qQI32s")
+_TIMESTAMP = struct.Struct("<q")
+
+Frame = collections.namedtuple("Frame", ["timestamp", "offset", "length", "sha256"])
+
+
+class _Timestamps:
+    # the timestamps in a memory-mapped index as a sequence, so bisect
+    # can search it without reading the whole index
+    def __init__(self, index, count):
+        self._index = index
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return _TIMESTAMP.unpack_from(self._index, len(MAGIC) + i * INDEX_FORMAT.size)[0]
+
+
+class ImagePack:
+    """
+    A class to add frames to, and read frames from, the pack of one
+    camera.
+
+    ...
+
+    Attributes
+    ----------
+    'folder' : str
+        The folder the pack (frames.pack) and its index (frames.idx)
+        are saved in.
+
+    Methods
+    -------
+    'append(data, timestamp=None)'
+        Adds a frame taken at `timestamp` (milliseconds since 1970,
+        default now) to the end of the pack, and returns its Frame.
+        Frames must be added in time order.
+    'frame(i)'
+        Returns the i-th Frame of the index.
+    'read(frame)'
+        Returns the content of a frame as a memoryview of the pack (no
+        copy is made; use bytes() to keep it after the pack is closed).
+    'find(timestamp)'
+        Returns the position in the index of the last frame taken at or
+        before `timestamp`, or -1 if there isn't one.
+    'at(timestamp)'
+        Returns the (Frame, content) of the last frame taken at or
+        before `timestamp`, or None.
+    'frames(start=None, end=None, every=None)'
+        Yields the (Frame, content) of every frame taken from `start` up
+        to (not including) `end`; with `every` (milliseconds), only the
+        first frame in each period of that length.
+    'close()'
+        Closes the pack's files.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.RLock()
+        self._data_path = os.path.join(folder, "frames.pack")
+        self._index_path = os.path.join(folder, "frames.idx")
+        self._data = open(self._data_path, "a+b")
+        self._index = open(self._index_path, "a+b")
+        self._data_map = None
+        self._index_map = None
+        self._recover()
+
+    def _recover(self):
+        # keeps only the whole entries of the index whose frames were
+        # written completely, and removes anything after the last frame
+        size = os.path.getsize(self._index_path)
+        if size < len(MAGIC):
+            self._index.truncate(0)
+            self._index.write(MAGIC)
+            self._index.flush()
+            size = len(MAGIC)
+        count = (size - len(MAGIC)) // INDEX_FORMAT.size
+        data_size = os.path.getsize(self._data_path)
+        self._count = count
+        while self._count and not self._whole(self._count - 1, data_size):
+            self._count -= 1
+        # the end of the last frame, where the next frame is written
+        self._end = self._end_of(self._count - 1) if self._count else 0
+        self._index.truncate(len(MAGIC) + self._count * INDEX_FORMAT.size)
+        self._data.truncate(self._end)
+
+    def _entry(self, i):
+        self._index.seek(len(MAGIC) + i * INDEX_FORMAT.size)
+        return Frame(*INDEX_FORMAT.unpack(self._index.read(INDEX_FORMAT.size)))
+
+    def _end_of(self, i):
+        frame = self._entry(i)
+        return frame.offset + frame.length
+
+    def _whole(self, i, data_size):
+        # only used by _recover, for the entries at the end of the index
+        frame = self._entry(i)
+        previous = self._entry(i - 1) if i else None
+        start = previous.offset + previous.length if previous else 0
+        if frame.offset != start or frame.offset + frame.length > data_size:
+            return False
+        if previous is not None and frame.timestamp < previous.timestamp:
+            return False
+        self._data.seek(frame.offset)
+        return hashlib.sha256(self._data.read(frame.length)).digest() == frame.sha256
+
+    @staticmethod
+    def _map(f, size, current):
+        # maps a file again once it has grown past the current map; the
+        # old map is left to be closed once no memoryview of it is left
+        if current is not None and len(current) >= size:
+            return current
+        f.flush()
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+
+    def _maps(self):
+        size = len(MAGIC) + self._count * INDEX_FORMAT.size
+        self._index_map = self._map(self._index, size, self._index_map)
+        self._data_map = self._map(self._data, self._end, self._data_map)
+        return self._index_map, self._data_map
+
+    def __len__(self):
+        return self._count
+
+    def append(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = int(time.time() * 1000)
+        with self._lock:
+            if self._count and timestamp < self.frame(self._count - 1).timestamp:
+                raise ValueError("Frames must be added in time order")
+            frame = Frame(int(timestamp), self._end, len(data), hashlib.sha256(data).digest())
+            # the frame is written before its index entry, so an entry
+            # never points at a frame that isn't all there (the files
+            # are opened for appending, so writes go to the end)
+            self._data.write(data)
+            self._data.flush()
+            self._index.write(INDEX_FORMAT.pack(*frame))
+            self._index.flush()
+            self._count += 1
+            self._end += len(data)
+            return frame
+
+    def frame(self, i):
+        with self._lock:
+            if not 0 <= i < self._count:
+                raise IndexError("No frame " + str(i))
+            index, _ = self._maps()
+            return Frame(*INDEX_FORMAT.unpack_from(index, len(MAGIC) + i * INDEX_FORMAT.size))
+
+    def read(self, frame):
+        with self._lock:
+            _, data = self._maps()
+            return memoryview(data)[frame.offset:frame.offset + frame.length]
+
+    def find(self, timestamp):
+        with self._lock:
+            if not self._count:
+                return -1
+            index, _ = self._maps()
+            return bisect.bisect_right(_Timestamps(index, self._count), timestamp) - 1
+
+    def at(self, timestamp):
+        i = self.find(timestamp)
+        if i < 0:
+            return None
+        frame = self.frame(i)
+        return frame, self.read(frame)
+
+    def frames(self, start=None, end=None, every=None):
+        with self._lock:
+            count = self._count
+            index, _ = self._maps()
+            timestamps = _Timestamps(index, count) if count else []
+            i = 0 if start is None else bisect.bisect_left(timestamps, start)
+            stop = count if end is None else bisect.bisect_left(timestamps, end)
+        following = None
+        while i < stop:
+            frame = self.frame(i)
+            if every:
+                if following is not None and frame.timestamp < following:
+                    # jumps straight to the first frame of the next period
+                    i = bisect.bisect_left(timestamps, following, i, stop)
+                    continue
+                following = frame.timestamp - frame.timestamp % every + every
+            yield frame, self.read(frame)
+            i += 1
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+            self._data_map = self._index_map = None
+
+
+def _camera(source):
+    # the pack name of a camera: the name of its image without the
+    # extension (e.g. 041529_045 for .../041529/041529_045.jpg)
+    name = os.path.splitext(os.path.basename(urlsplit(str(source)).path))[0]
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", name).strip(".")
+    return name or hashlib.sha1(str(source).encode("utf-8")).hexdigest()[:16]
+
+
+class PackStore:
+    """
+    A class to save camera images in one pack per camera.  It has the
+    same put/get/exists methods as a BlobStore, so it can be used as the
+    image store of the collector (see collector.py) and of the SQLite
+    sink (see sinks.py).
+
+    ...
+
+    Attributes
+    ----------
+    'root' : str
+        The folder the packs are saved in, one folder per camera.
+
+    Methods
+    -------
+    'put(data, source, timestamp=None)'
+        Adds an image from the camera `source` (its URL, or any name) to
+        the end of its pack, unless it is the same as the last image in
+        the pack.  Returns the image's hash, size and dimensions, as
+        BlobStore.put does.
+    'pack(source)'
+        Returns the ImagePack of a camera.
+    'cameras()'
+        Returns the names of the cameras with a pack.
+    'get(sha256)', 'exists(sha256)'
+        As BlobStore.  These search the indexes of every pack the first
+        time they are used; use the ImagePack methods to read by time.
+    'close()'
+        Closes every pack.
+    """
+
+    def __init__(self, root="image_packs"):
+        self.root = root
+        self._lock = threading.Lock()
+        self._packs = {}
+        # sha256 -> (camera, position in the index), made when needed
+        self._hashes = None
+
+    def pack(self, source):
+        camera = _camera(source)
+        with self._lock:
+            if camera not in self._packs:
+                self._packs[camera] = ImagePack(os.path.join(self.root, camera))
+            return self._packs[camera]
+
+    def cameras(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, "frames.idx")))
+
+    def put(self, data, source=None, timestamp=None):
+        if source is None:
+            raise ValueError("A PackStore needs to know which camera an image is from")
+        pack = self.pack(source)
+        sha256 = hashlib.sha256(data).digest()
+        with pack._lock:
+            # the same image again (e.g. the camera hasn't updated) isn't
+            # added twice
+            last = pack.frame(len(pack) - 1) if len(pack) else None
+            if last is None or last.sha256 != sha256:
+                pack.append(data, timestamp)
+                if self._hashes is not None:
+                    self._hashes[sha256.hex()] = (_camera(source), len(pack) - 1)
+        width, height = image_dimensions(data)
+        return {"image_sha256": sha256.hex(), "image_bytes": len(data),
+                "image_width": width, "image_height": height}
+
+    def _locate(self, sha256):
+        if self._hashes is None:
+            hashes = {}
+            for camera in self.cameras():
+                pack = self.pack(camera)
+                for i in range(len(pack)):
+                    hashes.setdefault(pack.frame(i).sha256.hex(), (camera, i))
+            self._hashes = hashes
+        return self._hashes.get(sha256)
+
+    def exists(self, sha256):
+        return self._locate(sha256) is not None
+
+    def get(self, sha256):
+        found = self._locate(sha256)
+        if found is None:
+            raise KeyError(sha256)
+        pack = self.pack(found[0])
+        return bytes(pack.read(pack.frame(found[1])))
+
+    def close(self):
+        with self._lock:
+            for pack in self._packs.values():
+                pack.close()
+            self._packs = {}
+
+
+def camera_source(wmo, registry):
+    """
+    Returns the source a station's images are saved under: the image URL
+    of its camera in `registry` (a StationRegistry, see stations.py), as
+    the collector uses, so images saved from elsewhere (e.g. an import)
+    go into the same pack as the camera's live frames.  The WMO number is
+    used if the station has no camera.
+    """
+
+    station = registry.get(wmo) if wmo is not None else None
+    if station is not None and station.image_url:
+        return station.image_url
+    return wmo
+
+
+def open_store(root, packs=None):
+    """
+    Returns the image store saved in the folder `root`: a PackStore if
+    `packs` is True, a BlobStore if it is False, or (None) whichever of
+    the two the folder already holds (a BlobStore if it is empty).
+    """
+
+    if packs is None:
+        packs = bool(PackStore(root).cameras())
+    return PackStore(root) if packs else BlobStore(root)
+
+
+def _millis(value):
+    # "2021-05-01" or "2021-05-01T13:30" (UTC) -> milliseconds since 1970
+    t = datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+    return int(t.timestamp() * 1000)
+
+
+def _iso(millis):
+    return datetime.datetime.fromtimestamp(millis / 1000.0, datetime.timezone.utc).isoformat()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Camera image packs")
+    parser.add_argument("--root", default="image_packs", help="folder the packs are saved in")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="list the cameras and their frames")
+    p = sub.add_parser("frames", help="save a camera's frames as numbered files")
+    p.add_argument("camera")
+    p.add_argument("--output", required=True, help="folder to save the frames in")
+    p.add_argument("--start", type=_millis, help="UTC date/time, e.g. 2021-05-01")
+    p.add_argument("--end", type=_millis, help="UTC date/time, e.g. 2021-06-01")
+    p.add_argument("--every", type=float, help="seconds between frames")
+    args = parser.parse_args()
+
+    store = PackStore(args.root)
+    if args.command == "list":
+        for name in store.cameras():
+            pack = store.pack(name)
+            if len(pack):
+                first, last = pack.frame(0), pack.frame(len(pack) - 1)
+                print("%s  %d frames  %s to %s" % (name, len(pack), _iso(first.timestamp),
+                                                   _iso(last.timestamp)))
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        every = int(args.every * 1000) if args.every else None
+        count = 0
+        for frame, content in store.pack(args.camera).frames(args.start, args.end, every):
+            count += 1
+            with open(os.path.join(args.output, "frame_%05d.jpg" % count), "wb") as f:
+                f.write(content)
+        print(str(count) + ' frames saved to ' + args.output)
+    store.close()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""Time-Partitioned Indices
+
+Rather than saving every observation into one ever-growing index, this
+script sets Elasticsearch up to save observations into a series of
+smaller indices ("partitions") named `weather-*`:
+
+    * an index template (made from the mapping in index_mapping.py) that
+        every `weather-*` index is created with,
+    * a write alias (`weather_write`) that the weather app saves new
+        observations through; it always points at the newest partition,
+    * a read alias (`weather`) that covers every partition, for queries
+        and Kibana.
+
+A new partition is started ("rolled over") once the current one is a
+month old or reaches a size limit, so searches of recent data and
+deleting old data only touch small indices.
+
+An existing single `weather_index` can be split into monthly partitions
+(`weather-2021.05`, `weather-2021.06`, ...) with the `migrate` command.
+Documents are given the derived fields from enrichers.py as they are
+copied.
+
+This script requires that `elasticsearch` be installed within the Python
+environment you are running this script in (it is only imported by the
+functions that use it, so the names of the aliases can be read without
+it).
+
+Usage:
+
+    python index_admin.py setup
+    python index_admin.py rollover [--max-age 30d] [--max-size 5gb]
+    python index_admin.py migrate [--source weather_index] [--delete-source]
+    python index_admin.py retention --keep-months 24
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * install_template - creates/updates the index template
+    * bootstrap - creates the first partition and the write alias
+    * setup - installs the template and creates the first partition
+    * rollover - starts a new partition if the current one is too old/big
+    * migrate - splits an existing index into monthly partitions
+    * retention - deletes partitions older than a number of months
+    * existing_ids - returns which document ids are already in any
+        partition
+"""
+
+import argparse
+import datetime
+
+import enrichers
+from index_mapping import PROPERTIES, SETTINGS
+
+TEMPLATE_NAME = "weather_template"
+PARTITION_PREFIX = "weather-"
+READ_ALIAS = "weather"
+WRITE_ALIAS = "weather_write"
+
+# when a new partition is started
+MAX_AGE = "30d"
+MAX_PRIMARY_SIZE = "5gb"
+
+
+def install_template(es_object):
+    es_object.indices.put_index_template(name=TEMPLATE_NAME, body={
+        "index_patterns": [PARTITION_PREFIX + "*"],
+        "template": {
+            "settings": dict(SETTINGS),
+            "mappings": {"properties": PROPERTIES},
+            "aliases": {READ_ALIAS: {}}
+        }
+    })
+
+
+def bootstrap(es_object):
+    # the first partition must end in a number so rollover can count up
+    if not es_object.indices.exists_alias(name=WRITE_ALIAS):
+        es_object.indices.create(index=PARTITION_PREFIX + "000001", body={
+            "aliases": {WRITE_ALIAS: {"is_write_index": True}}
+        })
+        print('Created first partition')
+
+
+def setup(es_object):
+    created = False
+    try:
+        install_template(es_object)
+        bootstrap(es_object)
+        created = True
+    except Exception as ex:
+        print(str(ex))
+    finally:
+        return created
+
+
+def rollover(es_object, max_age=MAX_AGE, max_size=MAX_PRIMARY_SIZE):
+    res = es_object.indices.rollover(alias=WRITE_ALIAS, body={
+        "conditions": {"max_age": max_age, "max_primary_shard_size": max_size}
+    })
+    if res.get("rolled_over"):
+        print('Rolled over to ' + res["new_index"])
+    return res
+
+
+def existing_ids(es_object, ids, index=READ_ALIAS, chunk_size=1000):
+    """
+    Returns the set of `ids` already saved in `index` (by default every
+    partition).  Saving with op_type "create" only refuses a document
+    that is already in the same index, and the write alias moves to a
+    new partition at every rollover, so an observation saved before a
+    rollover and sent again after it (e.g. replayed from the spool)
+    would be saved twice without this check.  Documents saved in the
+    last second (before Elasticsearch refreshes) aren't found, but those
+    are in the current partition, where "create" refuses them.
+    """
+    ids = list(ids)
+    found = set()
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        res = es_object.search(index=index, body={"query": {"ids": {"values": chunk}},
+                                                  "_source": False, "size": len(chunk)},
+                               ignore_unavailable=True, filter_path=["hits.hits._id"])
+        found.update(hit["_id"] for hit in res.get("hits", {}).get("hits", []))
+    return found
+
+
+def _partition_for(source):
+    # local_date_time_full is e.g. 20210517133000 -> weather-2021.05
+    t = str(source.get("local_date_time_full") or "")
+    if len(t) >= 6 and t[:6].isdigit():
+        return PARTITION_PREFIX + t[0:4] + "." + t[4:6]
+    return PARTITION_PREFIX + "undated"
+
+
+def migrate(es_object, source_index="weather_index", delete_source=False, chunk_size=500):
+    """
+    Copies every document in `source_index` into monthly partitions and
+    returns the number copied.  Documents are saved under the id the app
+    uses now (wmo-local_date_time_full, see observation.py) rather than
+    their old id, so the backfill and spool find them; documents without
+    a wmo or local_date_time_full are skipped, and documents already in
+    the partitions (e.g. from an earlier run) are left alone.  The source
+    index is only deleted if `delete_source` is True and every document
+    was copied.
+    """
+    from elasticsearch import helpers
+
+    install_template(es_object)
+
+    skipped = []
+
+    def actions():
+        for hit in helpers.scan(es_object, index=source_index, query={"query": {"match_all": {}}}):
+            document = enrichers.enrich(hit["_source"])
+            if document.get("wmo") is None or not document.get("local_date_time_full"):
+                skipped.append(hit["_id"])
+                continue
+            yield {"_op_type": "create", "_index": _partition_for(document),
+                   "_id": str(document["wmo"]) + "-" + str(document["local_date_time_full"]),
+                   "_source": document}
+
+    copied, errors = helpers.bulk(es_object, actions(), chunk_size=chunk_size,
+                                  raise_on_error=False)
+    # 409: copied by an earlier run
+    errors = [e for e in errors if e.get("create", {}).get("status") != 409]
+    print('Copied ' + str(copied) + ' documents, ' + str(len(errors)) + ' errors, ' +
+          str(len(skipped)) + ' skipped without a wmo or local_date_time_full')
+    if delete_source and not errors and not skipped:
+        es_object.indices.delete(index=source_index)
+        print('Deleted ' + source_index)
+    bootstrap(es_object)
+    return copied
+
+
+def retention(es_object, keep_months):
+    """
+    Deletes partitions whose newest observation is more than
+    `keep_months` months old.  Returns the names of deleted partitions.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=30.44 * keep_months)
+    cutoff_ms = int((cutoff - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    res = es_object.search(index=READ_ALIAS, body={
+        "size": 0,
+        "aggs": {"partitions": {"terms": {"field": "_index", "size": 10000},
+                                "aggs": {"newest": {"max": {"field": "epoch_date"}}}}}
+    })
+    write_indices = set(es_object.indices.get_alias(name=WRITE_ALIAS))
+    deleted = []
+    for bucket in res["aggregations"]["partitions"]["buckets"]:
+        newest = bucket["newest"]["value"]
+        if newest is not None and newest < cutoff_ms and bucket["key"] not in write_indices:
+            es_object.indices.delete(index=bucket["key"])
+            deleted.append(bucket["key"])
+    return deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the time-partitioned weather indices")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("setup", help="install the index template and create the first partition")
+    p = sub.add_parser("rollover", help="start a new partition if the current one is too old/big")
+    p.add_argument("--max-age", default=MAX_AGE)
+    p.add_argument("--max-size", default=MAX_PRIMARY_SIZE)
+    p = sub.add_parser("migrate", help="split an existing index into monthly partitions")
+    p.add_argument("--source", default="weather_index")
+    p.add_argument("--delete-source", action="store_true")
+    p = sub.add_parser("retention", help="delete old partitions")
+    p.add_argument("--keep-months", type=int, required=True)
+    args = parser.parse_args()
+
+    from weather_app import connect_elasticsearch
+
+    es = connect_elasticsearch()
+    if args.command == "setup":
+        setup(es)
+    elif args.command == "rollover":
+        rollover(es, args.max_age, args.max_size)
+    elif args.command == "migrate":
+        migrate(es, args.source, args.delete_source)
+    elif args.command == "retention":
+        print('Deleted: ' + ', '.join(retention(es, args.keep_months)))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""Elasticsearch Index Mapping
+
+This file contains the mapping (the list of fields and their types) of
+the Elasticsearch index the weather app saves observations to.  It is
+kept in one place so that every module that creates an index uses the
+same fields.  The mapping of the index as it exists in Elasticsearch
+(including fields added later with Painless scripts) is saved in json
+format in `other useful files/weather_index.json`.
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following:
+
+    * PROPERTIES - the fields of an observation document and their types
+    * SETTINGS - the settings used when creating the index
+    * index_body - returns the body of a request to create the index
+"""
+
+import copy
+
+# BOM dates are in the format 20210517133000 (local time for
+# local_date_time_full, UTC for aifstime_utc)
+BOM_DATE = {"type": "date", "format": "yyyyMMddHHmmss"}
+
+PROPERTIES = {
+    "wmo": {"type": "integer"},
+    "name": {"type": "text"},
+    "history_product": {"type": "text"},
+    "local_date_time": {"type": "text"},
+    "local_date_time_full": BOM_DATE,
+    "aifstime_utc": BOM_DATE,
+    "lat": {"type": "float"},
+    "lon": {"type": "float"},
+    "apparent_t": {"type": "float"},
+    "cloud": {"type": "text"},
+    "cloud_base_m": {"type": "text"},
+    "cloud_oktas": {"type": "integer"},
+    "cloud_type": {"type": "text"},
+    "cloud_type_id": {"type": "text"},
+    "delta_t": {"type": "float"},
+    "gust_kmh": {"type": "integer"},
+    "gust_kt": {"type": "integer"},
+    "air_temp": {"type": "float"},
+    "dewpt": {"type": "float"},
+    "press": {"type": "float"},
+    "press_msl": {"type": "float"},
+    "press_qnh": {"type": "float"},
+    "press_tend": {"type": "text"},
+    "rain_trace": {"type": "float"},
+    "rel_hum": {"type": "integer"},
+    "sea_state": {"type": "text"},
+    "swell_dir_worded": {"type": "text"},
+    "swell_height": {"type": "text"},
+    "swell_period": {"type": "text"},
+    "vis_km": {"type": "text"},
+    "weather": {"type": "text"},
+    "wind_dir": {"type": "keyword"},
+    "wind_spd_kmh": {"type": "integer"},
+    "wind_spd_kt": {"type": "integer"},
+    # derived when the observation is downloaded (see enrichers.py)
+    "wind_angle": {"type": "float"},
+    "epoch_date": {"type": "date", "format": "epoch_millis"},
+    "useful_date": {"type": "date", "format": "epoch_millis"},
+    # the base64 image is stored but not analysed or searchable
+    "local_image_b64": {"type": "binary"},
+    # used instead of local_image_b64 when images are saved in an image
+    # store (see blob_store.py): the sha256 hash the image is saved
+    # under, its size in bytes and its width and height in pixels
+    "image_sha256": {"type": "keyword"},
+    "image_bytes": {"type": "integer"},
+    "image_width": {"type": "integer"},
+    "image_height": {"type": "integer"}
+}
+
+SETTINGS = {
+    "number_of_shards": 1,
+    "number_of_replicas": 0
+}
+
+
+def index_body():
+    return {"settings": copy.deepcopy(SETTINGS),
+            "mappings": {"properties": copy.deepcopy(PROPERTIES)}}
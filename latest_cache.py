@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""Latest Conditions Cache
+
+This script keeps the most recent observation of each station in memory,
+so anything that wants the current conditions (a dashboard, a heading
+with the time of the data) can be answered straight away without
+downloading from the BOM website or querying Elasticsearch.
+
+Each station's entry expires when its next observation is expected to be
+published (see cadence.py); until then it is "fresh", afterwards it is
+still served but marked as stale.  Only `capacity` stations are kept;
+the station that was used least recently is removed first.
+
+The base64 image isn't kept in the cache.  Instead the entry has the
+image's hash (if images are saved in an image store, see blob_store.py)
+or the URL of the station's camera image.
+
+A small web server serves the cache as JSON:
+
+    * /stations - the WMO number, name, time and freshness of every
+        station in the cache
+    * /stations/<wmo> - the current conditions at one station, with the
+        local time of the observation in a readable format
+
+This script only requires modules from the Python standard library.
+http.server and cadence.py are only imported once they are used, so
+importing the cache (as dl_data.py does) doesn't slow down one-off runs
+(see run_once.py).
+
+This file can be imported as a module and contains the following:
+
+    * format_local_time - makes BOM's local_date_time_full readable
+    * LatestCache - the cache
+    * default_cache - the cache shared by the whole app
+    * start_http_server - serves the cache as JSON
+"""
+
+import datetime
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# fields left out of the cached observation
+EXCLUDED_FIELDS = ("local_image_b64",)
+
+
+def format_local_time(value):
+    # e.g. "20210517133000" -> "Monday, 17 May 2021 13:30:00"
+    t = datetime.datetime.strptime(str(value), "%Y%m%d%H%M%S")
+    return datetime.datetime.strftime(t, '%A, %d %B %Y %H:%M:%S')
+
+
+class _Entry:
+    __slots__ = ("observation", "expires", "body", "summary")
+
+
+class LatestCache:
+    """
+    A class to keep the most recent observation of each station.
+
+    ...
+
+    Attributes
+    ----------
+    'capacity' : int
+        The largest number of stations kept.
+    'clock' : function
+        Returns the current time in seconds since 1970 (time.time).
+
+    Methods
+    -------
+    'put(station, observation, expires=None)'
+        Saves the latest observation of a station.  `expires` is when
+        the next observation is expected (seconds since 1970); by
+        default a half-hourly period after the time of the observation.
+    'touch(station, expires)'
+        Changes when a station's entry expires, e.g. when the station
+        was downloaded again and hadn't changed.
+    'get(wmo)'
+        Returns the latest observation of a station (a dictionary without
+        the base64 image), or None if it isn't in the cache or has
+        expired.
+    'get_url(data_url)'
+        As get, for the station whose data is downloaded from data_url.
+    'lookup(wmo)'
+        Returns the entry's JSON (bytes) and whether it is fresh, or
+        (None, False) if the station isn't in the cache.
+    'summary()'
+        Returns a list of every station's WMO number, name, time and
+        freshness.
+    """
+
+    def __init__(self, capacity=10000, clock=time.time):
+        self.capacity = capacity
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._urls = {}
+
+    def put(self, station, observation, expires=None):
+        record = {k: v for k, v in observation.items() if k not in EXCLUDED_FIELDS}
+        if expires is None:
+            from cadence import DEFAULT_PERIOD, DEFAULT_DELAY, observation_time
+
+            try:
+                expires = observation_time(record) + DEFAULT_PERIOD + DEFAULT_DELAY
+            except (KeyError, TypeError, ValueError):
+                expires = self.clock() + DEFAULT_PERIOD
+
+        document = {"wmo": station.wmo, "name": station.name or record.get("name"),
+                    "local_time": None, "observation": record}
+        if record.get("local_date_time_full"):
+            document["local_time"] = format_local_time(record["local_date_time_full"])
+        if record.get("image_sha256"):
+            document["image_sha256"] = record["image_sha256"]
+        elif station.image_url:
+            document["image_url"] = station.image_url
+
+        entry = _Entry()
+        entry.observation = record
+        entry.expires = expires
+        # the JSON is made once here, so reads only have to send it
+        entry.body = json.dumps(document, separators=(",", ":")).encode("utf-8")
+        entry.summary = {"wmo": station.wmo, "name": document["name"],
+                         "local_time": document["local_time"]}
+
+        with self._lock:
+            self._entries[station.wmo] = entry
+            self._entries.move_to_end(station.wmo)
+            self._urls[station.data_url] = station.wmo
+            while len(self._entries) > self.capacity:
+                wmo, _ = self._entries.popitem(last=False)
+                self._urls = {u: w for u, w in self._urls.items() if w != wmo}
+
+    def touch(self, station, expires):
+        with self._lock:
+            entry = self._entries.get(station.wmo)
+            if entry is not None:
+                entry.expires = expires
+
+    def _entry(self, wmo):
+        # must be called with the lock held
+        entry = self._entries.get(wmo)
+        if entry is not None:
+            self._entries.move_to_end(wmo)
+        return entry
+
+    def get(self, wmo):
+        with self._lock:
+            entry = self._entry(wmo)
+        if entry is None or entry.expires <= self.clock():
+            return None
+        return entry.observation
+
+    def get_url(self, data_url):
+        with self._lock:
+            wmo = self._urls.get(data_url)
+        return None if wmo is None else self.get(wmo)
+
+    def lookup(self, wmo):
+        with self._lock:
+            entry = self._entry(wmo)
+        if entry is None:
+            return None, False
+        return entry.body, entry.expires > self.clock()
+
+    def summary(self):
+        now = self.clock()
+        with self._lock:
+            entries = list(self._entries.values())
+        return [dict(e.summary, fresh=e.expires > now) for e in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+default_cache = LatestCache()
+
+
+def _send(handler, status, body):
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def _send_stations(handler):
+    parts = [p for p in handler.path.split("?")[0].split("/") if p]
+    if parts == ["stations"]:
+        _send(handler, 200, json.dumps(handler.cache.summary()).encode("utf-8"))
+        return
+    if len(parts) == 2 and parts[0] == "stations" and parts[1].isdigit():
+        body, fresh = handler.cache.lookup(int(parts[1]))
+        if body is not None:
+            # adds the freshness to the JSON made when it was cached
+            _send(handler, 200, b'{"fresh":' + (b"true," if fresh else b"false,") + body[1:])
+            return
+    _send(handler, 404, b'{"error":"not found"}')
+
+
+def start_http_server(cache=None, port=8081, address="127.0.0.1"):
+    # http.server is only imported when the cache is served, as in
+    # metrics.py
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    handler = type("CacheHandler", (BaseHTTPRequestHandler,),
+                   {"cache": cache if cache is not None else default_cache,
+                    "do_GET": _send_stations, "log_message": lambda self, *args: None})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""Stored Observation Ledger
+
+This script keeps a record of the id of the last observation saved to
+Elasticsearch for each station.  The weather app checks this record
+before indexing, so an observation that has already been saved doesn't
+cost another write to Elasticsearch.
+
+The record is kept in memory.  Changes are saved by `flush()` (once per
+run, rather than once per observation) by adding one line of json with
+the changed stations to the end of a file (`stored_ids.json` by default),
+so it is still available after the app is restarted.  Once the file has
+more than COMPACT_RATIO lines per station it is written again as a
+single line, so it never grows past a few lines per station.  If the
+app stops before a flush, the observations saved since the last flush
+are only written again as "already saved" (documents are never
+overwritten, see sinks.py), so nothing is lost.
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following
+class:
+
+    * StoredIdLedger - the last stored document id for each station
+"""
+
+import json
+import os
+import threading
+
+
+DEFAULT_LEDGER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "stored_ids.json")
+
+# the file is written again as one line once it has more than this many
+# lines per station
+COMPACT_RATIO = 4
+
+
+class StoredIdLedger:
+    """
+    A class to remember the last document stored for each station.
+
+    ...
+
+    Attributes
+    ----------
+    'path' : str or None
+        The json file the ledger is saved to.  If None, the ledger is
+        only kept in memory.
+
+    Methods
+    -------
+    'is_stored(wmo, doc_id)'
+        Returns True if `doc_id` is the last document stored for the
+        station with WMO number `wmo`.
+    'record(wmo, doc_id)'
+        Records `doc_id` as the last document stored for the station.
+    'flush()'
+        Saves the changes made since the last flush to the file.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER):
+        self.path = path
+        self._lock = threading.Lock()
+        self._last = {}
+        # changes not yet saved to the file
+        self._changed = {}
+        self._lines = 0
+        # True if the file has to be written again as one line
+        self._compact = False
+        if path is not None and os.path.exists(path):
+            self._load(path)
+
+    def _load(self, path):
+        # each line is {wmo: doc_id} for the stations changed by one
+        # flush (the ledger files of older versions are a single line)
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    self._last.update(json.loads(line))
+                    self._lines += 1
+                except ValueError:
+                    # a line left half written by a crash
+                    self._compact = True
+
+    def is_stored(self, wmo, doc_id):
+        with self._lock:
+            return self._last.get(str(wmo)) == doc_id
+
+    def record(self, wmo, doc_id):
+        with self._lock:
+            if self._last.get(str(wmo)) == doc_id:
+                return
+            self._last[str(wmo)] = doc_id
+            self._changed[str(wmo)] = doc_id
+
+    def flush(self):
+        with self._lock:
+            if self.path is None or not (self._changed or self._compact):
+                self._changed = {}
+                return
+            if self._compact or self._lines >= COMPACT_RATIO * len(self._last):
+                # written to a temporary file first so a crash can't
+                # leave a half written ledger behind
+                tmp = self.path + ".tmp"
+                with open(tmp, "w") as f:
+                    f.write(json.dumps(self._last, separators=(",", ":")) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                self._lines = 1
+                self._compact = False
+            else:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(self._changed, separators=(",", ":")) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._lines += 1
+            self._changed = {}
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""Pipeline Metrics
+
+This script records how long each stage of the weather app's pipeline
+takes and how much data passes through it, so it is possible to see why
+a scheduled run was slow or missed, and which station is slow.
+
+The following are recorded:
+
+    * weather_stage_seconds - histogram of the time taken by each stage
+        (bom_fetch, image_fetch, b64_encode, es_index, store, sweep)
+    * weather_records_total - count of observations by outcome (success,
+        failure, skip)
+    * weather_bytes_total - count of bytes downloaded/sent, by source
+        (bom, image, es)
+    * weather_payload_bytes - histogram of the size of each download and
+        document, by kind
+    * weather_station_fetch_seconds - the time the last download of each
+        station took, by WMO number
+    * weather_scheduler_lag_seconds - histogram of how late each scheduled
+        run started
+    * weather_scheduler_misfires_total - count of scheduled runs that
+        were missed
+    * weather_upstream_events_total - count of hedged requests (and
+        those where the second request won, or that weren't sent as the
+        host had no request free), timeouts and requests refused by a
+        circuit breaker (see upstream.py)
+    * weather_rollup_dropped_total - count of observations dropped from
+        the rollup queue while Elasticsearch was down (see rollups.py)
+
+The metrics can be read in the Prometheus text format from a small web
+server (`start_http_server`, e.g. http://localhost:9465/metrics) or from
+a file written regularly (`write_file`).
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the metrics above
+and the following functions:
+
+    * timed - a context manager that records the time taken by a stage
+    * render - returns every metric in the Prometheus text format
+    * write_file - writes every metric to a file
+    * start_http_server - serves the metrics at /metrics
+    * watch_scheduler - records lag and misfires of an APScheduler
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Counter:
+    """A value that only goes up, e.g. the number of records stored"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + _label_text(k), v) for k, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, e.g. the last fetch time"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram:
+    """Counts of values in buckets, with their sum and count"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels -> [count per bucket..., count, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += value
+
+    def count(self, **labels):
+        with self._lock:
+            values = self._values.get(tuple(sorted(labels.items())))
+            return values[-2] if values else 0
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, values):
+                    result.append((self.name + "_bucket" + _label_text(key + (("le", repr(float(bound))),)), n))
+                result.append((self.name + "_bucket" + _label_text(key + (("le", "+Inf"),)), values[-2]))
+                result.append((self.name + "_count" + _label_text(key), values[-2]))
+                result.append((self.name + "_sum" + _label_text(key), values[-1]))
+        return result
+
+
+class Registry:
+    """The list of metrics rendered by render()"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help_text))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    "weather_stage_seconds", "Time taken by each stage of the pipeline"))
+RECORDS = REGISTRY.add(Counter(
+    "weather_records_total", "Observations by outcome (success, failure, skip)"))
+BYTES = REGISTRY.add(Counter(
+    "weather_bytes_total", "Bytes downloaded or sent, by source"))
+PAYLOAD_BYTES = REGISTRY.add(Histogram(
+    "weather_payload_bytes", "Size of each download or document", BYTE_BUCKETS))
+STATION_FETCH_SECONDS = REGISTRY.add(Gauge(
+    "weather_station_fetch_seconds", "Time the last download of each station took"))
+SCHEDULER_LAG = REGISTRY.add(Histogram(
+    "weather_scheduler_lag_seconds", "How late each scheduled run started"))
+SCHEDULER_MISFIRES = REGISTRY.add(Counter(
+    "weather_scheduler_misfires_total", "Scheduled runs that were missed"))
+UPSTREAM_EVENTS = REGISTRY.add(Counter(
+    "weather_upstream_events_total", "Hedged requests, timeouts and open circuit breakers, by host"))
+ROLLUP_DROPPED = REGISTRY.add(Counter(
+    "weather_rollup_dropped_total", "Observations dropped from the rollup queue while it was full"))
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def render():
+    return REGISTRY.render()
+
+
+def write_file(path):
+    # written to a temporary file and renamed so readers never see half
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def _send_metrics(handler):
+    if handler.path.split("?")[0] != "/metrics":
+        handler.send_response(404)
+        handler.end_headers()
+        return
+    body = render().encode("utf-8")
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def start_http_server(port=9465, address="127.0.0.1"):
+    # http.server is only imported when the metrics are served, so
+    # one-off runs (see run_once.py) don't pay for importing it
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    handler = type("MetricsHandler", (BaseHTTPRequestHandler,),
+                   {"do_GET": _send_metrics, "log_message": lambda self, *args: None})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def watch_scheduler(scheduler):
+    """
+    Records how late each job of an APScheduler scheduler starts, and
+    counts the runs that are missed, either because they started too
+    late (misfire_grace_time exceeded) or because the last run was still
+    going (max_instances reached).
+    """
+    from datetime import datetime, timezone
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_SUBMITTED
+
+    def listener(event):
+        if event.code == EVENT_JOB_MISSED:
+            SCHEDULER_MISFIRES.inc(job=event.job_id, reason="late")
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            SCHEDULER_MISFIRES.inc(job=event.job_id, reason="still_running")
+        elif event.scheduled_run_times:
+            late = datetime.now(timezone.utc) - event.scheduled_run_times[-1]
+            SCHEDULER_LAG.observe(max(0.0, late.total_seconds()), job=event.job_id)
+
+    scheduler.add_listener(listener, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_SUBMITTED)
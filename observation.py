@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""Compact Weather Observation
+
+This script holds a single set of weather conditions downloaded from the
+BOM website.  Rather than a dictionary, an `Observation` keeps each field
+of the Elasticsearch mapping (see index_mapping.py) in its own slot, so
+holding the latest observation of thousands of stations in memory takes
+a fraction of the space.  Any field BOM sends that isn't in the mapping
+is kept in a small dictionary of extra fields, so nothing is lost.
+
+An Observation still behaves like a dictionary (`obs["air_temp"]`,
+`obs.get(...)`, `obs.update(...)`, `obs.pop(...)`, iteration etc.), so
+the rest of the app uses it the same way.
+
+BOM's numbers are sent as strings, with "-" when there is no reading.
+`Observation.from_bom` converts them into the numbers the mapping expects
+(and "-" into None, with enrichers.parse_number) in the same step as
+building the observation, and
+`to_json` turns it back into the JSON sent to Elasticsearch.
+
+If `orjson` is installed it is used to read and write JSON, as it is much
+faster than the standard library's `json`; otherwise `json` is used.
+
+This file can be imported as a module and contains the following:
+
+    * Observation - a single set of weather conditions
+    * loads - reads JSON (bytes or str)
+    * dumps - writes JSON (bytes)
+"""
+
+import json
+from collections.abc import MutableMapping
+
+from index_mapping import PROPERTIES
+from enrichers import NUMERIC_FIELDS, parse_number
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FIELDS = tuple(PROPERTIES)
+_FIELD_SET = frozenset(FIELDS)
+
+# fields BOM sends that are never stored
+DROPPED = frozenset(["sort_order"])
+
+# marks a slot that has no value (as opposed to a value of None)
+_UNSET = object()
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+class Observation(MutableMapping):
+    """
+    A single set of weather conditions downloaded from the BOM website.
+
+    Behaves like the dictionary BOM returns for one entry in
+    ["observations"]["data"], but each field of the index mapping is
+    kept in a slot rather than a dictionary.  It also knows which
+    document id it should be stored under, so the data can be
+    downloaded once and passed along rather than being turned into a
+    string and back again.
+
+    ...
+
+    Methods
+    -------
+    'from_bom(record)'
+        Builds an observation from one entry of BOM's JSON, converting
+        numeric fields from strings (and "-" into None) and leaving out
+        "sort_order".
+    'doc_id'
+        The id of the Elasticsearch document this observation is
+        stored as: the WMO number of the station and the local time the
+        observation was made (e.g. "99435-20210517133000"), so that
+        stations reporting at the same time don't overwrite each other.
+    'to_dict()'
+        Returns a plain dictionary copy of the observation, ready to be
+        used as the body of an Elasticsearch request.
+    'to_json()'
+        Returns the observation as JSON (bytes).
+    """
+
+    __slots__ = FIELDS + ("_extra",)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    @classmethod
+    def from_bom(cls, record):
+        obs = cls()
+        for name, value in record.items():
+            if name in DROPPED:
+                continue
+            if isinstance(value, str):
+                convert = NUMERIC_FIELDS.get(name)
+                if convert is not None:
+                    value = parse_number(value, convert)
+            obs[name] = value
+        return obs
+
+    def __getitem__(self, key):
+        if key in _FIELD_SET:
+            value = getattr(self, key, _UNSET)
+            if value is not _UNSET:
+                return value
+        elif self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for name in FIELDS:
+            if getattr(self, name, _UNSET) is not _UNSET:
+                yield name
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        if key in _FIELD_SET:
+            return getattr(self, key, _UNSET) is not _UNSET
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key, _UNSET)
+            return default if value is _UNSET else value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __repr__(self):
+        return "Observation(" + repr(self.to_dict()) + ")"
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self._extra = None
+        self.update(state)
+
+    def copy(self):
+        return Observation(self.to_dict())
+
+    @property
+    def doc_id(self):
+        return str(self['wmo']) + '-' + str(self['local_date_time_full'])
+
+    def to_dict(self):
+        result = {}
+        for name in FIELDS:
+            value = getattr(self, name, _UNSET)
+            if value is not _UNSET:
+                result[name] = value
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    def to_json(self):
+        return dumps(self.to_dict())
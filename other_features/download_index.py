@@ -17,10 +17,24 @@ This script currently contains two options:
 2. Option 2 downloads the content of the Elasticsearch documents as the text
     of a command to re-add the documents to an index as needed.
 
+Documents whose image was saved in an image store (see blob_store.py and
+image_pack.py) only hold the image's hash.  The image is read from the
+weather app's image store (IMAGE_STORE_DIR and IMAGE_PACKS in
+weather_app.py) and added back to the saved document as local_image_b64 so
+the backup doesn't depend on the image store.
+
 """
+import base64
+import os
+import sys
+
 import elasticsearch
 import json
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from index_admin import READ_ALIAS
+from weather_app import open_image_store
+
 """
 Connects to the ElasticSearch server
 Can replace IP and Port if if different
@@ -30,12 +44,13 @@ es = elasticsearch.Elasticsearch(["127.0.0.1:9200"])
 """
 Accesses the required index and searches for the required data
 Can change:
-    index= relevant index name
+    index= relevant index name (READ_ALIAS reads every partition, see
+           index_admin.py)
     query= to whatever query brings up the elastic search documents wanted to be downloaded/saved
     size= if not included defaults to 10, can be changed to a maximum of 10,000
           Currently set to download the first 100 results where "wmo" = "99435"
 """
-res = es.search(index="weather_index", body={
+res = es.search(index=READ_ALIAS, body={
 					"query": {
 						"bool": {
 							"must": [
@@ -54,6 +69,23 @@ Can change name of the txt file data is saved to
 """
 filename = "weather_save_4.txt"
 
+"""
+The weather app's image store, images are read from (None if the app keeps the
+images in the documents)
+"""
+image_store = open_image_store()
+
+
+def with_image(source):
+	"""Adds the image a document refers to by hash back into the document"""
+	sha256 = source.get("image_sha256")
+	if image_store is not None and sha256 and "local_image_b64" not in source \
+			and image_store.exists(sha256):
+		source = dict(source)
+		source["local_image_b64"] = base64.b64encode(image_store.get(sha256)).decode("utf-8")
+	return source
+
+
 """
 Prints the number of elastic search documents ["hits"] to the console.
 Not the same number of documents that will be downloaded if the number of documents 
@@ -76,6 +108,6 @@ with open(filename, 'a') as f:
 	""" Option 2 """
 	try:
 		for hit in es_documents:
-			f.write("POST /weather_index/_doc/" + str(hit["_id"]) + '\n' + str(json.dumps(hit["_source"])) + '\n\n')
+			f.write("POST /weather_index/_doc/" + str(hit["_id"]) + '\n' + str(json.dumps(with_image(hit["_source"]))) + '\n\n')
 	except Exception:
 		f.write("Error while downloading")
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Export the Whole Elasticsearch Index
+
+This script saves every document in the user's Elasticsearch index (or
+every document matching a query) to compressed files in the format used
+by the Elasticsearch bulk API, so they can be loaded back into an index
+with `import_index.py` or with a `_bulk` request.  Unlike
+`download_index.py` there is no limit on the number of documents.
+
+Documents are read a page at a time using a point in time and
+`search_after` (or a scroll, with `--scroll`), and written straight to
+the file, so memory use stays the same however large the index is.  The
+export can be split into several slices that are read in parallel, each
+written to its own file.  Fields can be left out of the export, e.g.
+`--exclude local_image_b64` to save the documents without their images.
+Images saved in the weather app's image store (a folder of images or of
+packs, see blob_store.py and image_pack.py) are added back to the
+documents, so the export doesn't depend on the image store.
+
+This script requires that `elasticsearch` be installed within the Python
+environment you are running this script in.
+
+Usage:
+
+    python export_index.py [--index weather] [--output weather_export]
+        [--query '{"match": {"wmo": 99435}}'] [--include FIELD ...]
+        [--exclude FIELD ...] [--slices 4] [--page-size 1000] [--scroll]
+        [--image-store ../image_packs]
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * iter_pit - yields the documents using a point in time
+    * iter_scroll - yields the documents using a scroll
+    * write_bulk - writes documents to a compressed bulk NDJSON file
+    * export - exports the index to one file per slice
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import elasticsearch
+from elasticsearch import helpers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_pack import open_store
+from index_admin import READ_ALIAS
+
+
+def _search_body(query, includes, excludes, page_size, slice_id, slices):
+	body = {"size": page_size, "query": query or {"match_all": {}}}
+	if includes or excludes:
+		body["_source"] = {"includes": includes or [], "excludes": excludes or []}
+	if slices and slices > 1:
+		body["slice"] = {"id": slice_id, "max": slices}
+	return body
+
+
+def iter_pit(es, index, query=None, includes=None, excludes=None, page_size=1000,
+			 slice_id=0, slices=1, pit_id=None, keep_alive="5m"):
+	"""Yields every hit (one slice of them if slices > 1) using a point in time"""
+	own_pit = pit_id is None
+	if own_pit:
+		pit_id = es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+	try:
+		body = _search_body(query, includes, excludes, page_size, slice_id, slices)
+		body["sort"] = [{"_shard_doc": "asc"}]
+		while True:
+			body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+			hits = es.search(body=body)["hits"]["hits"]
+			if not hits:
+				break
+			for hit in hits:
+				yield hit
+			body["search_after"] = hits[-1]["sort"]
+	finally:
+		if own_pit:
+			es.close_point_in_time(body={"id": pit_id})
+
+
+def iter_scroll(es, index, query=None, includes=None, excludes=None, page_size=1000,
+				slice_id=0, slices=1, keep_alive="5m"):
+	"""Yields every hit (one slice of them if slices > 1) using a scroll"""
+	body = _search_body(query, includes, excludes, page_size, slice_id, slices)
+	body.pop("size")
+	for hit in helpers.scan(es, index=index, query=body, size=page_size, scroll=keep_alive):
+		yield hit
+
+
+def write_bulk(hits, path, target_index=None, image_store=None, excludes=None):
+	"""
+	Writes hits to a gzip compressed file in bulk NDJSON format (an
+	"index" action line followed by the document).  If an image store is
+	given, images saved in it are added back to the documents, unless
+	local_image_b64 is one of the `excludes`.  Returns the number of
+	documents written.
+	"""
+	if excludes and "local_image_b64" in excludes:
+		image_store = None
+	count = 0
+	with gzip.open(path, "wt", encoding="utf-8") as f:
+		for hit in hits:
+			source = hit.get("_source", {})
+			sha256 = source.get("image_sha256")
+			if image_store is not None and sha256 and "local_image_b64" not in source \
+					and image_store.exists(sha256):
+				source["local_image_b64"] = base64.b64encode(image_store.get(sha256)).decode("utf-8")
+			action = {"index": {"_index": target_index or hit["_index"], "_id": hit["_id"]}}
+			f.write(json.dumps(action, separators=(",", ":")) + "\n")
+			f.write(json.dumps(source, separators=(",", ":")) + "\n")
+			count += 1
+	return count
+
+
+def export(es, index, output, query=None, includes=None, excludes=None, slices=1,
+		   page_size=1000, use_scroll=False, target_index=None, image_store=None):
+	"""
+	Exports the index to `output`.ndjson.gz, or to `output`-00.ndjson.gz,
+	`output`-01.ndjson.gz, ... (one file per slice, read in parallel) if
+	slices > 1.  Returns the list of files written and the number of
+	documents written.
+	"""
+	slices = max(1, slices)
+	if slices == 1:
+		paths = [output + ".ndjson.gz"]
+	else:
+		paths = ["%s-%02d.ndjson.gz" % (output, i) for i in range(slices)]
+
+	pit_id = None
+	if not use_scroll:
+		pit_id = es.open_point_in_time(index=index, keep_alive="5m")["id"]
+
+	def export_slice(i):
+		if use_scroll:
+			hits = iter_scroll(es, index, query, includes, excludes, page_size, i, slices)
+		else:
+			hits = iter_pit(es, index, query, includes, excludes, page_size, i, slices, pit_id)
+		return write_bulk(hits, paths[i], target_index, image_store, excludes)
+
+	try:
+		with ThreadPoolExecutor(max_workers=slices) as pool:
+			total = sum(pool.map(export_slice, range(slices)))
+	finally:
+		if pit_id is not None:
+			es.close_point_in_time(body={"id": pit_id})
+	return paths, total
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Export an Elasticsearch index to bulk NDJSON files")
+	parser.add_argument("--host", default="127.0.0.1:9200")
+	parser.add_argument("--index", default=READ_ALIAS,
+						help="index or alias to export (default: every partition)")
+	parser.add_argument("--output", default="weather_export",
+						help="file name (without .ndjson.gz) to export to")
+	parser.add_argument("--query", help="query (in json) of the documents to export")
+	parser.add_argument("--include", nargs="*", help="only export these fields")
+	parser.add_argument("--exclude", nargs="*", help="don't export these fields")
+	parser.add_argument("--slices", type=int, default=1, help="number of slices read in parallel")
+	parser.add_argument("--page-size", type=int, default=1000)
+	parser.add_argument("--scroll", action="store_true", help="use a scroll instead of a point in time")
+	parser.add_argument("--target-index", help="index name written in the bulk actions")
+	parser.add_argument("--image-store",
+						help="image store folder (a BlobStore or PackStore) to add images back "
+							 "from (default: the weather app's IMAGE_STORE_DIR)")
+	args = parser.parse_args()
+
+	from weather_app import image_store_path
+
+	root = args.image_store or image_store_path()
+	# whichever kind of store the folder holds
+	image_store = open_store(root) if root else None
+	es = elasticsearch.Elasticsearch([args.host], maxsize=max(10, args.slices))
+	try:
+		paths, total = export(es, args.index, args.output,
+							  json.loads(args.query) if args.query else None,
+							  args.include, args.exclude, args.slices, args.page_size,
+							  args.scroll, args.target_index, image_store)
+	finally:
+		if image_store is not None:
+			image_store.close()
+	print("Saved %d documents to %s" % (total, ", ".join(paths)))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""Import/Restore a Saved Elasticsearch Index
+
+This script loads documents saved by `download_index.py` or
+`export_index.py` back into an Elasticsearch index, rather than copying
+and pasting them into Kibana Dev Tools one at a time.
+
+Two file formats are understood, and files are read a line at a time so
+files of any size can be imported:
+1. The text files written by download_index.py (weather_save_*.txt), made
+    of "POST /weather_index/_doc/<id>" lines each followed by the document.
+    Older files were saved before the app's current id and derived fields,
+    so each document is given the derived fields (see enrichers.py) and
+    the id the app uses now (wmo-local_date_time_full).
+2. Bulk NDJSON files written by export_index.py (optionally gzip
+    compressed, ending in .gz), made of an action line followed by the
+    document.
+
+Documents are sent by several worker threads using the bulk API in
+batches limited by both the number of documents and their size in bytes.
+If Elasticsearch answers "429 Too Many Requests" the batch is retried
+after a growing wait, and the file is only read as fast as the workers
+can send it.  While importing, the index's refresh is turned off and its
+replicas set to 0; both are set back afterwards.  If the index is an
+alias (e.g. index_admin.WRITE_ALIAS) this is done to every index behind
+it.
+
+This script requires that `elasticsearch` be installed within the Python
+environment you are running this script in.
+
+Usage:
+
+    python import_index.py FILE [FILE ...] [--index weather_index]
+        [--workers 4] [--batch-docs 1000] [--batch-bytes 10485760]
+        [--create] [--image-store ../image_store] [--image-packs]
+
+This file can also be imported as a module and contains the following
+functions:
+
+    * read_legacy - yields (index, id, document) from a download_index file
+    * read_ndjson - yields (index, id, document) from a bulk NDJSON file
+    * read_file - reads either format, depending on the file's content
+    * bulk_load - sends documents to Elasticsearch with parallel workers
+    * import_files - imports files with refresh and replicas turned off
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import elasticsearch
+from elasticsearch import helpers
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import enrichers
+import index_admin
+from image_pack import camera_source, open_store
+from index_mapping import index_body
+from stations import StationRegistry
+
+
+def _open(path):
+	if path.endswith(".gz"):
+		return gzip.open(path, "rt", encoding="utf-8")
+	return open(path, encoding="utf-8")
+
+
+def read_legacy(path):
+	"""Yields (index, id, document) from a file written by download_index.py"""
+	with _open(path) as f:
+		target = None
+		for line in f:
+			line = line.strip()
+			if line.startswith("POST /"):
+				# POST /weather_index/_doc/<id>
+				parts = line[len("POST /"):].split("/")
+				target = (parts[0], parts[2] if len(parts) > 2 else None)
+			elif line and target is not None:
+				document = enrichers.enrich(json.loads(line))
+				doc_id = target[1]
+				if document.get("wmo") is not None and document.get("local_date_time_full"):
+					# the id of the same observation saved by the app
+					doc_id = str(document["wmo"]) + "-" + str(document["local_date_time_full"])
+				yield target[0], doc_id, document
+				target = None
+
+
+def read_ndjson(path):
+	"""Yields (index, id, document) from a bulk NDJSON file"""
+	with _open(path) as f:
+		for line in f:
+			if not line.strip():
+				continue
+			op, meta = next(iter(json.loads(line).items()))
+			if op == "delete":
+				continue
+			document = json.loads(next(f))
+			yield meta.get("_index"), meta.get("_id"), document
+
+
+def read_file(path):
+	"""Reads a file in either format, depending on its first line"""
+	with _open(path) as f:
+		first = ""
+		for line in f:
+			if line.strip():
+				first = line.strip()
+				break
+	if first.startswith("POST /"):
+		return read_legacy(path)
+	return read_ndjson(path)
+
+
+def _batches(actions, batch_docs, batch_bytes):
+	# splits the actions into batches by number of documents and bytes
+	batch = []
+	size = 0
+	for action in actions:
+		action_size = len(json.dumps(action["_source"], separators=(",", ":"))) + 100
+		if batch and (len(batch) >= batch_docs or size + action_size > batch_bytes):
+			yield batch
+			batch = []
+			size = 0
+		batch.append(action)
+		size += action_size
+	if batch:
+		yield batch
+
+
+def bulk_load(es, actions, workers=4, batch_docs=1000, batch_bytes=10 * 1024 * 1024,
+			  max_retries=8, initial_backoff=2):
+	"""
+	Sends bulk actions to Elasticsearch using `workers` threads.  At most
+	two batches per worker are held in memory at once, so reading waits
+	for the workers (backpressure).  Returns the number of documents
+	stored and the number that failed (documents that already exist are
+	not counted as failed when using "create").
+	"""
+	in_flight = threading.BoundedSemaphore(workers * 2)
+	lock = threading.Lock()
+	counts = {"ok": 0, "failed": 0}
+
+	def send(batch):
+		try:
+			# streaming_bulk retries 429 responses, waiting initial_backoff,
+			# then twice as long each time
+			for ok, item in helpers.streaming_bulk(es, batch, chunk_size=len(batch),
+												   max_chunk_bytes=batch_bytes * 2,
+												   raise_on_error=False,
+												   max_retries=max_retries,
+												   initial_backoff=initial_backoff):
+				info = next(iter(item.values()))
+				with lock:
+					if ok:
+						counts["ok"] += 1
+					elif info.get("status") != 409:
+						counts["failed"] += 1
+						print("Error in indexing data: " + str(item))
+		except Exception as ex:
+			with lock:
+				counts["failed"] += len(batch)
+			print("Error in sending batch")
+			print(str(ex))
+		finally:
+			in_flight.release()
+
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		for batch in _batches(actions, batch_docs, batch_bytes):
+			in_flight.acquire()
+			pool.submit(send, batch)
+	return counts["ok"], counts["failed"]
+
+
+def _to_image_store(document, image_store, registry):
+	# saves an inline image in the image store and keeps only its hash;
+	# a PackStore adds it to the pack of the station's camera (the same
+	# pack as the camera's live frames) at the time of the observation
+	image = document.get("local_image_b64")
+	if image_store is not None and image:
+		try:
+			document.update(image_store.put(base64.b64decode(image),
+											source=camera_source(document.get("wmo"), registry),
+											timestamp=document.get("epoch_date")))
+		except ValueError as ex:
+			# older than the last frame in the camera's pack, the image
+			# is kept in the document rather than lost
+			print("Image of %s kept in the document: %s" % (document.get("wmo"), ex))
+			return document
+		document.pop("local_image_b64")
+	return document
+
+
+def import_files(es, paths, index=None, workers=4, batch_docs=1000,
+				 batch_bytes=10 * 1024 * 1024, create=False, image_store=None):
+	"""
+	Imports every document in `paths` into `index` (or the index each
+	document was saved from, e.g. each of the weather-* partitions).
+	Indices that don't exist are created using the weather app's
+	mapping.  Refresh is turned off and replicas set to 0 on every index
+	imported into, and set back afterwards.  Returns the number of
+	documents stored and the number that failed.
+	"""
+	op_type = "create" if create else "index"
+	registry = StationRegistry() if image_store is not None else None
+	# the indices (or aliases) documents are imported into
+	prepared = set()
+	# index behind them -> its refresh_interval and number_of_replicas
+	# before the import
+	saved = {}
+
+	def prepare(name):
+		# called the first time a document for `name` is read, before it
+		# is sent, so every index is tuned however many the files hold
+		prepared.add(name)
+		if not es.indices.exists(index=name):
+			if name == index_admin.WRITE_ALIAS:
+				# the template, first partition and aliases
+				index_admin.setup(es)
+			else:
+				es.indices.create(index=name, body=index_body())
+		# the settings are keyed by the indices an alias points to
+		for concrete, settings in es.indices.get_settings(index=name).items():
+			if concrete in saved:
+				continue
+			settings = settings["settings"]["index"]
+			saved[concrete] = {"refresh_interval": settings.get("refresh_interval"),
+							   "number_of_replicas": settings.get("number_of_replicas")}
+			es.indices.put_settings(index=concrete, body={"index": {"refresh_interval": "-1",
+																	"number_of_replicas": 0}})
+
+	def actions():
+		for path in paths:
+			for doc_index, doc_id, document in read_file(path):
+				name = index or doc_index or "weather_index"
+				if name not in prepared:
+					prepare(name)
+				action = {"_op_type": op_type, "_index": name,
+						  "_source": _to_image_store(document, image_store, registry)}
+				if doc_id is not None:
+					action["_id"] = doc_id
+				yield action
+
+	try:
+		return bulk_load(es, actions(), workers, batch_docs, batch_bytes)
+	finally:
+		for name, settings in saved.items():
+			# None puts refresh_interval back to Elasticsearch's default
+			es.indices.put_settings(index=name, body={"index": settings})
+			es.indices.refresh(index=name)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Import saved documents into an Elasticsearch index")
+	parser.add_argument("files", nargs="+", help="weather_save_*.txt or *.ndjson(.gz) files")
+	parser.add_argument("--host", default="127.0.0.1:9200")
+	parser.add_argument("--index", help="index to import into (default: the index saved in the file)")
+	parser.add_argument("--workers", type=int, default=4)
+	parser.add_argument("--batch-docs", type=int, default=1000)
+	parser.add_argument("--batch-bytes", type=int, default=10 * 1024 * 1024)
+	parser.add_argument("--create", action="store_true", help="don't overwrite documents that already exist")
+	parser.add_argument("--image-store",
+						help="save images in this image store instead of the documents "
+							 "(default: the weather app's IMAGE_STORE_DIR)")
+	parser.add_argument("--image-packs", action="store_true",
+						help="save the images as one pack per camera (see image_pack.py) "
+							 "(default: as the weather app's IMAGE_PACKS, or the kind of "
+							 "store --image-store already holds)")
+	args = parser.parse_args()
+
+	from weather_app import open_image_store
+
+	if args.image_store:
+		image_store = open_store(args.image_store, True if args.image_packs else None)
+	else:
+		image_store = open_image_store(packs=True if args.image_packs else None)
+	es = elasticsearch.Elasticsearch([args.host], maxsize=max(10, args.workers))
+	try:
+		ok, failed = import_files(es, args.files, args.index, args.workers, args.batch_docs,
+								  args.batch_bytes, args.create, image_store)
+	finally:
+		if image_store is not None:
+			image_store.close()
+	print("Imported %d documents, %d failed" % (ok, failed))
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""Read Observations from Elasticsearch
+
+This script reads the observations saved by the weather app back out of
+Elasticsearch, for dashboards, exports and analysis.  It is written so
+that reading a lot of observations stays small and fast:
+
+    * the base64 image (local_image_b64) is left out unless it is asked
+        for, as it is most of the size of every observation
+    * only the fields asked for are returned; numbers, dates and
+        keywords are read from Elasticsearch's column store
+        (`docvalue_fields`) instead of the saved document, and the saved
+        document isn't read at all if every field is one of these
+    * results are read a page at a time with a point in time and
+        `search_after`, so any number of observations can be read
+        without the memory or time limits of deep `from`/`size` paging,
+        and each page is yielded as soon as it arrives
+    * only the parts of each response that are used are sent back
+        (`filter_path`)
+
+e.g. a year of half-hourly temperatures from one station is about 35
+pages of 500 observations, about 50 KB a page.
+
+By default observations are read from every partition through the
+index_admin.READ_ALIAS alias (see index_admin.py).  Points in time need
+Elasticsearch 7.12 or later (as export_index.py does).
+
+This script requires that `elasticsearch` be installed within the
+Python environment you are running this script in.
+
+This file can be imported as a module and contains the following
+functions:
+
+    * latest - returns a station's most recent observation
+    * time_range - yields a station's observations between two times
+    * iter_all - yields every observation matching a query
+    * columns - turns observations into one list per field
+
+It can also be run from the command line, printing one observation per
+line as JSON:
+
+    python query.py latest 99435 [--fields air_temp rel_hum]
+    python query.py range 99435 --start 2021-05-01 --end 2021-06-01
+        [--fields epoch_date air_temp] [--columns]
+"""
+
+import argparse
+import datetime
+import json
+
+from index_admin import READ_ALIAS
+from index_mapping import PROPERTIES
+
+# fields left out unless include_images is True
+IMAGE_FIELDS = ("local_image_b64",)
+
+PAGE_SIZE = 500
+
+# how long (Elasticsearch time units) the point in time is kept between
+# pages
+KEEP_ALIVE = "1m"
+
+# the parts of a search response that are used
+_FILTER_PATH = ["pit_id", "hits.hits._source", "hits.hits.fields", "hits.hits.sort"]
+
+# the format each date field is returned in from docvalue_fields, the
+# same as in the saved documents
+_DATE_FORMATS = {"epoch_date": "epoch_millis", "useful_date": "epoch_millis"}
+_DOC_VALUE_TYPES = ("float", "integer", "date", "keyword")
+
+
+def _doc_value_field(name):
+    spec = {"field": name}
+    if PROPERTIES[name]["type"] == "date":
+        spec["format"] = _DATE_FORMATS.get(name, PROPERTIES[name].get("format"))
+    return spec
+
+
+def _from_doc_value(name, value):
+    kind = PROPERTIES[name]["type"]
+    if kind == "float":
+        # float fields are kept as 32 bit floats, so 16.1 comes back as
+        # 16.100000381469727; 7 significant digits gives back the value
+        # that was saved
+        return float("%.7g" % value)
+    if name in _DATE_FORMATS:
+        return int(value)
+    return value
+
+
+def _search_body(query, fields, include_images, size):
+    body = {"size": size, "query": query or {"match_all": {}}, "track_total_hits": False}
+    if fields is None:
+        if not include_images:
+            body["_source"] = {"excludes": list(IMAGE_FIELDS)}
+        return body
+    from_columns = [f for f in fields if PROPERTIES.get(f, {}).get("type") in _DOC_VALUE_TYPES]
+    from_source = [f for f in fields if f not in from_columns]
+    if from_columns:
+        body["docvalue_fields"] = [_doc_value_field(f) for f in from_columns]
+    # False doesn't read the saved document at all
+    body["_source"] = {"includes": from_source} if from_source else False
+    return body
+
+
+def _record(hit, fields):
+    record = hit.get("_source") or {}
+    for name, values in hit.get("fields", {}).items():
+        record[name] = _from_doc_value(name, values[0]) if values else None
+    if fields is not None:
+        # every record has every field asked for, in the same order
+        record = {name: record.get(name) for name in fields}
+    return record
+
+
+def _millis(value):
+    # epoch milliseconds, or a datetime (naive datetimes are UTC)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(value.timestamp() * 1000)
+    return int(value)
+
+
+def latest(es_object, wmo, fields=None, index=READ_ALIAS, include_images=False):
+    """
+    Returns the most recent observation of station `wmo` (a dictionary
+    of `fields`, or of every field but the image), or None if there
+    isn't one.
+    """
+
+    body = _search_body({"term": {"wmo": wmo}}, fields, include_images, 1)
+    body["sort"] = [{"epoch_date": "desc"}]
+    res = es_object.search(index=index, body=body, filter_path=_FILTER_PATH)
+    hits = res.get("hits", {}).get("hits", [])
+    return _record(hits[0], fields) if hits else None
+
+
+def iter_all(es_object, query=None, fields=None, index=READ_ALIAS, include_images=False,
+             page_size=PAGE_SIZE, order="asc"):
+    """
+    Yields every observation matching `query` (an Elasticsearch query,
+    default every observation) in time order (`order` "asc" or "desc"),
+    as dictionaries of `fields` (default every field but the image).
+    Observations are read `page_size` at a time.
+    """
+
+    body = _search_body(query, fields, include_images, page_size)
+    # _shard_doc breaks ties between observations with the same time, so
+    # search_after never skips or repeats an observation
+    body["sort"] = [{"epoch_date": {"order": order, "missing": "_last"}}, {"_shard_doc": "asc"}]
+    pit_id = es_object.open_point_in_time(index=index, keep_alive=KEEP_ALIVE)["id"]
+    try:
+        while True:
+            body["pit"] = {"id": pit_id, "keep_alive": KEEP_ALIVE}
+            res = es_object.search(body=body, filter_path=_FILTER_PATH)
+            # the id can change from one page to the next
+            pit_id = res.get("pit_id", pit_id)
+            hits = res.get("hits", {}).get("hits", [])
+            for hit in hits:
+                yield _record(hit, fields)
+            if len(hits) < page_size:
+                break
+            body["search_after"] = hits[-1]["sort"]
+    finally:
+        es_object.close_point_in_time(body={"id": pit_id})
+
+
+def time_range(es_object, wmo, start=None, end=None, fields=None, index=READ_ALIAS,
+               include_images=False, page_size=PAGE_SIZE, order="asc"):
+    """
+    Yields the observations of station `wmo` from `start` up to (not
+    including) `end`, as iter_all does.  Times are datetimes (naive
+    datetimes are UTC) or milliseconds since 1970; None has no limit.
+    """
+
+    filters = [{"term": {"wmo": wmo}}]
+    limits = {}
+    if start is not None:
+        limits["gte"] = _millis(start)
+    if end is not None:
+        limits["lt"] = _millis(end)
+    if limits:
+        filters.append({"range": {"epoch_date": limits}})
+    return iter_all(es_object, {"bool": {"filter": filters}}, fields, index, include_images,
+                    page_size, order)
+
+
+def columns(records, fields):
+    """
+    Returns {field: list of values} for the observations in `records`,
+    e.g. columns(time_range(es, 99435, start, end, ["epoch_date",
+    "air_temp"]), ["epoch_date", "air_temp"]) for a chart.
+    """
+
+    result = {name: [] for name in fields}
+    lists = [(name, result[name].append) for name in fields]
+    for record in records:
+        for name, append in lists:
+            append(record.get(name))
+    return result
+
+
+def _date(value):
+    # "2021-05-01" or "2021-05-01T13:30", in UTC
+    return datetime.datetime.fromisoformat(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read observations from Elasticsearch")
+    parser.add_argument("--index", default=READ_ALIAS, help="index or alias to read from")
+    parser.add_argument("--fields", nargs="+", help="fields to read (default: all but the image)")
+    parser.add_argument("--images", action="store_true", help="include the base64 image")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("latest", help="a station's most recent observation")
+    p.add_argument("wmo", type=int)
+    p = sub.add_parser("range", help="a station's observations between two times (UTC)")
+    p.add_argument("wmo", type=int)
+    p.add_argument("--start", type=_date)
+    p.add_argument("--end", type=_date)
+    p.add_argument("--columns", action="store_true", help="print one list per field")
+    args = parser.parse_args()
+
+    from weather_app import connect_elasticsearch
+
+    es = connect_elasticsearch()
+    if args.command == "latest":
+        print(json.dumps(latest(es, args.wmo, args.fields, args.index, args.images)))
+    else:
+        fields = args.fields or (["epoch_date", "air_temp"] if args.columns else None)
+        records = time_range(es, args.wmo, args.start, args.end, fields, args.index, args.images)
+        if args.columns:
+            print(json.dumps(columns(records, fields)))
+        else:
+            for record in records:
+                print(json.dumps(record))
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+"""Hourly and Daily Rollups
+
+Long-range dashboards (e.g. a year of temperatures) have to read every
+half-hourly observation, including the large ones with an image.  This
+script keeps a summary of each station's observations for every hour
+and every day in a separate, much smaller rollup index: the minimum,
+maximum, sum, count and mean of each of the fields in ROLLUP_FIELDS.
+
+The rollups are updated as each observation arrives rather than being
+worked out again from all of the observations.  Each rollup document
+remembers the times of the observations it includes, so an observation
+that arrives twice (e.g. from the backfill and the weather app) is only
+counted once, and a rollup that is no longer in memory (e.g. after the
+app is restarted) is read back from the index before it is updated.
+
+Hours and days are in the station's local time (local_date_time_full),
+the same as the observations.
+
+Observations are queued until the next flush; only the fields that are
+rolled up are kept in the queue.  If Elasticsearch is down for so long
+that the queue fills up (MAX_PENDING), the oldest observations are
+dropped, counted in the weather_rollup_dropped_total metric (see
+metrics.py), and the times dropped for each station are remembered.
+Once Elasticsearch is back those stations' rollups are rebuilt from the
+observations saved in `source_index` (once the spool has sent them, see
+spool.py), so the rollups end up right rather than quietly missing
+observations.
+
+This script requires that `elasticsearch` be installed within the
+Python environment you are running this script in.
+
+This file can be imported as a module and contains the following:
+
+    * rollup_body - the settings and mapping of the rollup index
+    * RollupEngine - keeps the rollups up to date
+    * create_rollup_index - creates the rollup index
+    * rebuild - builds the rollups from the observations in an index
+
+It can also be run from the command line to build the rollups from the
+observations already in the index:
+
+    python rollups.py rebuild [--source weather] [--index weather_rollup]
+"""
+
+import argparse
+import copy
+import datetime
+import threading
+from collections import deque
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+
+import metrics
+from index_mapping import BOM_DATE, SETTINGS
+
+ROLLUP_INDEX = "weather_rollup"
+
+# the index (or alias, index_admin.READ_ALIAS) observations are read
+# from to rebuild rollups
+SOURCE_INDEX = "weather"
+
+ROLLUP_FIELDS = ("air_temp", "apparent_t", "dewpt", "delta_t", "rel_hum",
+                 "press", "press_msl", "press_qnh", "rain_trace", "gust_kmh",
+                 "wind_spd_kmh", "cloud_oktas")
+
+# the fields of an observation kept in the queue
+_QUEUED_FIELDS = ("wmo", "name", "local_date_time_full") + ROLLUP_FIELDS
+
+# the length of each interval, as the number of characters of
+# local_date_time_full (yyyyMMddHHmmss) that are the same for every
+# observation in the interval
+INTERVALS = {"hour": 10, "day": 8}
+
+# the largest number of observations waiting to be added, and the
+# number of days of rollups kept in memory
+MAX_PENDING = 100000
+KEEP_DAYS = 4
+
+_STATS = {"type": "object", "properties": {
+    "min": {"type": "float"}, "max": {"type": "float"}, "sum": {"type": "float"},
+    "mean": {"type": "float"}, "count": {"type": "integer"}}}
+
+PROPERTIES = {
+    "wmo": {"type": "integer"},
+    "name": {"type": "keyword"},
+    "interval": {"type": "keyword"},
+    "start": BOM_DATE,
+    "count": {"type": "integer"},
+    # the times of the observations included, only used by this script
+    "observations": {"type": "keyword", "index": False, "doc_values": False},
+}
+PROPERTIES.update({name: _STATS for name in ROLLUP_FIELDS})
+
+
+def rollup_body():
+    return {"settings": copy.deepcopy(SETTINGS),
+            "mappings": {"properties": copy.deepcopy(PROPERTIES)}}
+
+
+class _Rollup:
+    __slots__ = ("wmo", "name", "interval", "start", "times", "stats", "dirty")
+
+    def __init__(self, wmo, name, interval, start):
+        self.wmo = wmo
+        self.name = name
+        self.interval = interval
+        self.start = start
+        self.times = set()
+        # field -> [min, max, sum, count]
+        self.stats = {}
+        self.dirty = False
+
+    @property
+    def doc_id(self):
+        return str(self.wmo) + "-" + self.interval + "-" + self.start
+
+    def add(self, time, observation):
+        if time in self.times:
+            return False
+        self.times.add(time)
+        for name in ROLLUP_FIELDS:
+            value = observation.get(name)
+            if value is None or isinstance(value, str):
+                continue
+            s = self.stats.get(name)
+            if s is None:
+                self.stats[name] = [value, value, value, 1]
+            else:
+                if value < s[0]:
+                    s[0] = value
+                if value > s[1]:
+                    s[1] = value
+                s[2] += value
+                s[3] += 1
+        self.dirty = True
+        return True
+
+    def to_dict(self):
+        doc = {"wmo": self.wmo, "name": self.name, "interval": self.interval,
+               "start": self.start, "count": len(self.times),
+               "observations": sorted(self.times)}
+        for name, (lo, hi, total, n) in self.stats.items():
+            doc[name] = {"min": lo, "max": hi, "sum": total, "count": n, "mean": total / n}
+        return doc
+
+    @classmethod
+    def from_dict(cls, doc):
+        rollup = cls(doc["wmo"], doc.get("name"), doc["interval"], doc["start"])
+        rollup.times = set(doc.get("observations", []))
+        for name in ROLLUP_FIELDS:
+            s = doc.get(name)
+            if s:
+                rollup.stats[name] = [s["min"], s["max"], s["sum"], s["count"]]
+        return rollup
+
+
+class RollupEngine:
+    """
+    A class to keep the hourly and daily rollups of every station up to
+    date.
+
+    ...
+
+    Attributes
+    ----------
+    'es_object' : Elasticsearch
+        The Elasticsearch client the rollups are read from and saved to.
+    'index_name' : str
+        The rollup index.
+    'source_index' : str or None
+        The index (or alias) of the observations, read to rebuild the
+        rollups of observations dropped from a full queue.  None doesn't
+        rebuild them.
+
+    Methods
+    -------
+    'add(observations)'
+        Queues observations to be added to the rollups.  Doesn't need
+        Elasticsearch, so it can be called even while it is down.  If
+        the queue is full the oldest observations are dropped, to be
+        rebuilt from `source_index` later.
+    'flush()'
+        Adds the queued observations to the rollups, rebuilds the
+        rollups of dropped observations, and saves the rollups that
+        changed.  Returns the number of rollups saved.  Anything not
+        saved (e.g. Elasticsearch is down) is kept for the next flush.
+    """
+
+    def __init__(self, es_object, index_name=ROLLUP_INDEX, source_index=SOURCE_INDEX):
+        self.es_object = es_object
+        self.index_name = index_name
+        self.source_index = source_index
+        # _lock protects the queue, _flush_lock the rollups, so
+        # observations can be queued while a flush is waiting on
+        # Elasticsearch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = deque()
+        self._rollups = {}
+        # wmo -> [first time, last time, number] of the observations
+        # dropped from the queue, until they have been rebuilt
+        self._dropped = {}
+
+    def add(self, observations):
+        dropped = 0
+        with self._lock:
+            for o in observations:
+                if not o.get("local_date_time_full"):
+                    continue
+                # only what is rolled up (not e.g. the image) is queued
+                self._pending.append({name: o.get(name) for name in _QUEUED_FIELDS})
+                if len(self._pending) > MAX_PENDING:
+                    self._drop(self._pending.popleft())
+                    dropped += 1
+        if dropped:
+            metrics.ROLLUP_DROPPED.inc(dropped)
+            print(str(dropped) + ' observations dropped from the full rollup queue, '
+                  'they will be rebuilt from ' + str(self.source_index))
+
+    def _drop(self, observation):
+        # must be called with _lock held
+        time = str(observation["local_date_time_full"])
+        span = self._dropped.get(observation["wmo"])
+        if span is None:
+            self._dropped[observation["wmo"]] = [time, time, 1]
+        else:
+            span[0] = min(span[0], time)
+            span[1] = max(span[1], time)
+            span[2] += 1
+
+    def _rebuild_dropped(self):
+        # adds the dropped observations back from the saved observations;
+        # rollups only count each observation once, so reading ones that
+        # were already added does no harm.  A station is only done once
+        # at least as many observations as were dropped are found (until
+        # then they may still be in the spool)
+        with self._lock:
+            dropped = dict(self._dropped)
+        for wmo, (first, last, count) in dropped.items():
+            query = {"bool": {"filter": [
+                {"term": {"wmo": wmo}},
+                {"range": {"local_date_time_full": {"gte": first, "lte": last}}}]}}
+            found = []
+            for hit in helpers.scan(self.es_object, index=self.source_index,
+                                    query={"query": query, "_source": list(_QUEUED_FIELDS)}):
+                found.append(hit["_source"])
+            self._load(found)
+            for observation in found:
+                for time, key in self._keys(observation):
+                    self._rollups[key].add(time, observation)
+            if len(found) >= count:
+                with self._lock:
+                    if self._dropped.get(wmo) == [first, last, count]:
+                        del self._dropped[wmo]
+                print('Rebuilt the rollups of ' + str(len(found)) + ' observations of ' + str(wmo))
+
+    @staticmethod
+    def _keys(observation):
+        time = str(observation["local_date_time_full"])
+        for interval, length in INTERVALS.items():
+            yield time, (observation["wmo"], interval, time[:length].ljust(14, "0"))
+
+    def _load(self, batch):
+        # the rollups of the batch that aren't in memory are read from
+        # the index in one request, carrying on from them if they exist
+        missing = {}
+        for observation in batch:
+            for _, key in self._keys(observation):
+                if key not in self._rollups and key not in missing:
+                    missing[key] = _Rollup(key[0], observation.get("name"), key[1], key[2])
+        if not missing:
+            return
+        try:
+            res = self.es_object.mget(index=self.index_name,
+                                      body={"ids": [r.doc_id for r in missing.values()]})
+            found = {d["_id"]: d["_source"] for d in res["docs"] if d.get("found")}
+        except NotFoundError:
+            # the rollup index doesn't exist yet
+            found = {}
+        for key, rollup in missing.items():
+            doc = found.get(rollup.doc_id)
+            self._rollups[key] = _Rollup.from_dict(doc) if doc else rollup
+
+    def _fold(self):
+        # adds the queued observations to the rollups; if Elasticsearch
+        # can't be read the observations not yet added are put back in
+        # the queue, so nothing is lost (and nothing is counted twice,
+        # as each rollup remembers the observations it includes)
+        with self._lock:
+            batch = deque(self._pending)
+            self._pending.clear()
+        try:
+            self._load(batch)
+            while batch:
+                observation = batch[0]
+                for time, key in self._keys(observation):
+                    self._rollups[key].add(time, observation)
+                batch.popleft()
+        finally:
+            if batch:
+                with self._lock:
+                    self._pending.extendleft(reversed(batch))
+
+    def _evict(self):
+        # forgets rollups that have been saved and are too old to change
+        starts = [k[2] for k in self._rollups]
+        if not starts:
+            return
+        newest = datetime.datetime.strptime(max(starts)[:8], "%Y%m%d")
+        cutoff = (newest - datetime.timedelta(days=KEEP_DAYS)).strftime("%Y%m%d")
+        for key in [k for k, r in self._rollups.items() if not r.dirty and k[2][:8] < cutoff]:
+            del self._rollups[key]
+
+    def flush(self):
+        with self._flush_lock:
+            try:
+                self._fold()
+                if self._dropped and self.source_index is not None and not self._pending:
+                    self._rebuild_dropped()
+            except Exception as ex:
+                print('Error in reading rollups')
+                print(str(ex))
+            dirty = [r for r in self._rollups.values() if r.dirty]
+            if not dirty:
+                return 0
+            actions = ({"_op_type": "index", "_index": self.index_name, "_id": r.doc_id,
+                        "_source": r.to_dict()} for r in dirty)
+            saved = set()
+            try:
+                for ok, item in helpers.streaming_bulk(self.es_object, actions,
+                                                       raise_on_error=False):
+                    if ok:
+                        saved.add(item["index"]["_id"])
+                    else:
+                        print('Error in saving rollup: ' + str(item))
+            except Exception as ex:
+                print('Error in saving rollups')
+                print(str(ex))
+            # rollups that weren't saved are saved again next time
+            for r in dirty:
+                if r.doc_id in saved:
+                    r.dirty = False
+            self._evict()
+            return len(saved)
+
+
+def create_rollup_index(es_object, index_name=ROLLUP_INDEX):
+    if not es_object.indices.exists(index=index_name):
+        # Ignore 400 means to ignore "Index Already Exist" error.
+        es_object.indices.create(index=index_name, ignore=400, body=rollup_body())
+
+
+def rebuild(es_object, source_index, index_name=ROLLUP_INDEX, chunk_size=1000):
+    """
+    Builds the rollups from every observation in `source_index`, in
+    batches of `chunk_size`.  Only the fields that are rolled up are
+    read (not the images).  Returns the number of observations read.
+    """
+
+    create_rollup_index(es_object, index_name)
+    engine = RollupEngine(es_object, index_name, source_index)
+    fields = list(_QUEUED_FIELDS)
+    total = 0
+    batch = []
+    for hit in helpers.scan(es_object, index=source_index, size=chunk_size,
+                            query={"_source": fields}):
+        batch.append(hit["_source"])
+        if len(batch) >= chunk_size:
+            engine.add(batch)
+            engine.flush()
+            total += len(batch)
+            batch = []
+    engine.add(batch)
+    engine.flush()
+    return total + len(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hourly and daily rollups of the observations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("rebuild", help="build the rollups from the observations in the index")
+    p.add_argument("--source", default=SOURCE_INDEX, help="index or alias to read observations from")
+    p.add_argument("--index", default=ROLLUP_INDEX, help="rollup index")
+    args = parser.parse_args()
+
+    from weather_app import connect_elasticsearch
+
+    es = connect_elasticsearch()
+    print(str(rebuild(es, args.source, args.index)) + ' observations rolled up')
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+"""Run the Weather App Once
+
+This script downloads the latest observations for a list of stations,
+saves them and exits, for hosts that run the weather app from cron or a
+systemd timer instead of keeping weather_app.py (and its scheduler)
+running:
+
+    python run_once.py --wmo 94576 99435 --sink sqlite
+
+Nothing is imported until the arguments have been read, and then only
+what the chosen sink needs (e.g. `elasticsearch` isn't imported to save
+to SQLite, and the web servers, cadence and rollups aren't imported at
+all).  Most of the startup time (about 0.2 seconds) is importing
+`requests`, which every run needs.  Elasticsearch isn't pinged first: the first
+request to it tells whether it is up.  See benchmarks/bench_startup.py
+to measure how long starting takes.
+
+Progress messages are printed to stderr, so stdout only has the
+observations printed by the stdout sink.
+
+The exit status tells cron/systemd how the run went:
+
+    * 0 (EXIT_OK) - every station was downloaded and saved
+    * 1 (EXIT_PARTIAL) - some stations couldn't be downloaded or saved
+    * 2 (EXIT_USAGE) - the arguments were wrong (e.g. an unknown WMO
+        number)
+    * 3 (EXIT_FAILED) - no station could be downloaded or saved
+    * 4 (EXIT_SINK) - the sink couldn't be used (e.g. Elasticsearch is
+        down)
+
+This script requires the same modules as the weather app, although
+`apscheduler` isn't needed and `elasticsearch` is only needed for the
+elasticsearch sink.
+
+This file can be imported as a module and contains the following
+functions:
+
+    * parse_args - reads the command line arguments
+    * run_once - downloads and saves the stations once, returns the exit
+        status
+    * main - runs run_once from the command line
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_FAILED = 3
+EXIT_SINK = 4
+
+SINKS = ('elasticsearch', 'sqlite', 'stdout')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Download and save the latest observations once, then exit")
+    parser.add_argument("--wmo", type=int, nargs="+", metavar="WMO",
+                        help="WMO numbers of the stations to download (default: every "
+                             "station in the registry)")
+    parser.add_argument("--registry", help="station registry file (default: stations.json)")
+    parser.add_argument("--sink", choices=SINKS, default='elasticsearch',
+                        help="where to save the observations; stdout prints them as "
+                             "JSON lines")
+    parser.add_argument("--sqlite-path", default='weather.db',
+                        help="database file for the sqlite sink")
+    parser.add_argument("--es-url", default='http://localhost:9200',
+                        help="Elasticsearch URL for the elasticsearch sink")
+    parser.add_argument("--index", help="index or write alias for the elasticsearch sink "
+                                        "(default: as the weather app)")
+    parser.add_argument("--image-store", help="folder to save camera images in (see "
+                                              "blob_store.py)")
+    parser.add_argument("--image-packs", action="store_true",
+                        help="save the images in --image-store as one pack per camera (see "
+                             "image_pack.py)")
+    parser.add_argument("--no-images", action="store_true",
+                        help="don't download camera images")
+    parser.add_argument("--budget", type=float, default=20,
+                        help="seconds each station can take to download")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="stations downloaded at the same time")
+    parser.add_argument("--per-host", type=int,
+                        help="requests made to one website at the same time (default: "
+                             "collector.PER_HOST); every station's data is on the BOM "
+                             "website, so this sets how long a large sweep takes")
+    parser.add_argument("--metrics-file",
+                        help="write the run's metrics to this file (e.g. for the "
+                             "node_exporter textfile collector)")
+    parser.add_argument("--quiet", action="store_true", help="don't print progress messages")
+    return parser.parse_args(argv)
+
+
+def _stations(args):
+    from stations import Station, StationRegistry
+
+    registry = StationRegistry(args.registry) if args.registry else StationRegistry()
+    if not args.wmo:
+        stations = list(registry)
+    else:
+        unknown = [wmo for wmo in args.wmo if registry.get(wmo) is None]
+        if unknown:
+            print('Unknown WMO number(s): ' + ', '.join(str(w) for w in unknown),
+                  file=sys.stderr)
+            return None
+        stations = [registry.get(wmo) for wmo in args.wmo]
+    if args.no_images:
+        stations = [Station(s.wmo, s.data_url, None, s.name, s.timezone, s.lat, s.lon)
+                    for s in stations]
+    return stations
+
+
+class _StdoutSink:
+    # prints each observation as a line of JSON, e.g. to pipe into
+    # another program or to try the app without a database
+    def __init__(self, out):
+        self.out = out
+
+    def ensure(self):
+        return True
+
+    def store_many(self, records):
+        from observation import dumps
+
+        count = 0
+        for record in records:
+            self.out.write(dumps(record.to_dict()).decode("utf-8") + "\n")
+            count += 1
+        self.out.flush()
+        return count, []
+
+    def close(self):
+        pass
+
+
+def _sink(args, image_store, out):
+    # returns the sink, the ledger of saved observations and a function
+    # to call with the saved observations (e.g. to update the rollups)
+    if args.sink == 'stdout':
+        return _StdoutSink(out), None, None
+
+    from ledger import StoredIdLedger
+
+    if args.sink == 'sqlite':
+        from sinks import SQLiteSink
+        from stations import StationRegistry
+
+        # images are saved under their camera, from the same registry
+        registry = StationRegistry(args.registry) if args.registry else None
+        return (SQLiteSink(args.sqlite_path, image_store=image_store, registry=registry),
+                StoredIdLedger(), None)
+
+    from elasticsearch import Elasticsearch
+
+    import index_admin
+    import rollups
+    import weather_app
+    from sinks import ElasticsearchSink
+
+    es = Elasticsearch([args.es_url], maxsize=args.workers)
+    index_name = args.index or weather_app.INDEX_NAME
+    # observations saved before a rollover are looked for in every
+    # partition (see index_admin.existing_ids)
+    search_index = None
+    if index_name == index_admin.WRITE_ALIAS:
+        search_index = index_admin.READ_ALIAS
+    sink = ElasticsearchSink(es, index_name, prepare=weather_app.ensure_index,
+                             search_index=search_index)
+    if not weather_app.ROLLUPS:
+        return sink, StoredIdLedger(), None
+    engine = rollups.RollupEngine(es, source_index=search_index or index_name)
+
+    def update_rollups(observations):
+        engine.add(observations)
+        weather_app.flush_rollups(es, engine)
+
+    return sink, StoredIdLedger(), update_rollups
+
+
+def run_once(args, out=None):
+    stations = _stations(args)
+    if stations is None:
+        return EXIT_USAGE
+    if not stations:
+        print('No stations to download', file=sys.stderr)
+        return EXIT_USAGE
+
+    import metrics
+    import sessions
+    from blob_store import BlobStore
+    from collector import Collector, PER_HOST
+    from sinks import store_records
+
+    image_store = None
+    if args.image_store:
+        if args.image_packs:
+            from image_pack import PackStore
+
+            image_store = PackStore(args.image_store)
+        else:
+            image_store = BlobStore(args.image_store)
+    sink = None
+    collector = Collector(stations, max_workers=min(args.workers, len(stations)),
+                          per_host=args.per_host or PER_HOST, image_store=image_store,
+                          station_budget=args.budget)
+    try:
+        with metrics.timed('sweep'):
+            results = collector.collect()
+        downloaded = [(s, r) for s, r in results if r]
+        metrics.RECORDS.inc(len(results) - len(downloaded), outcome='failure')
+        print('Data downloaded for ' + str(len(downloaded)) + ' of ' + str(len(results)) +
+              ' stations')
+        if not downloaded:
+            return EXIT_FAILED
+
+        sink, ledger, saved = _sink(args, image_store, out or sys.stdout)
+        try:
+            ready = sink.ensure()
+        except Exception as ex:
+            print(str(ex), file=sys.stderr)
+            ready = False
+        if not ready:
+            print('Could not save to ' + args.sink, file=sys.stderr)
+            return EXIT_SINK
+        try:
+            failed = store_records(sink, downloaded, ledger)
+        except Exception as ex:
+            print('Error in saving observations', file=sys.stderr)
+            print(str(ex), file=sys.stderr)
+            return EXIT_SINK
+        if saved is not None:
+            saved(r for _, r in downloaded)
+
+        if len(failed) == len(downloaded):
+            return EXIT_FAILED
+        if failed or len(downloaded) < len(results):
+            return EXIT_PARTIAL
+        return EXIT_OK
+    finally:
+        collector.close()
+        if sink is not None:
+            sink.close()
+        if image_store is not None:
+            image_store.close()
+        sessions.close_session()
+        if args.metrics_file:
+            metrics.write_file(args.metrics_file)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = sys.stdout
+    with contextlib.redirect_stdout(io.StringIO() if args.quiet else sys.stderr):
+        return run_once(args, out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
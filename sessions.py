@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""Shared HTTP Session
+
+This script provides a single `requests` session that is shared by every
+download made by the weather app.  A session keeps its connections to
+the BOM and AirServices Australia websites open between requests
+(keep-alive), so each download doesn't have to open a new connection
+and the connections are reused from one scheduled run to the next.
+
+This script requires that `requests` be installed within the Python
+environment you are running this script in.
+
+This file can be imported as a module and contains the following
+functions:
+
+    * get_session - returns the shared session, creating it if needed
+    * close_session - closes the shared session and its connections
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# the number of hosts that keep a pool of connections, and the number
+# of open connections kept for each host (should be at least as large
+# as the number of worker threads downloading at the same time)
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+
+_session = None
+_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                  pool_maxsize=POOL_MAXSIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def close_session():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""Storage Sinks
+
+This script lets the weather app save observations somewhere other than
+Elasticsearch.  Every sink has the same methods, so the app doesn't need
+to know where the observations end up:
+
+    * ElasticsearchSink - saves observations in an Elasticsearch index
+        (or write alias), as the app always has
+    * SQLiteSink - saves observations in a single SQLite database file,
+        for small sites (e.g. a Raspberry Pi) that can't run an
+        Elasticsearch cluster
+
+The SQLite database uses write-ahead logging (WAL) so it can be read
+while observations are being saved, saves each batch of observations in
+one transaction, and has an index on (wmo, time) so a station's
+observations over a period can be found quickly.  Images aren't saved in
+the database: they are saved in an image store (see blob_store.py) and
+the observation only keeps the image's hash, so the database stays
+small and fast to read.
+
+This script requires that `elasticsearch` be installed within the
+Python environment you are running this script in (for the
+ElasticsearchSink only); `sqlite3` is part of the standard library.
+
+This file can be imported as a module and contains the following
+classes:
+
+    * Sink - the methods every sink has
+    * ElasticsearchSink - saves observations in Elasticsearch
+    * SQLiteSink - saves observations in a SQLite database
+
+and the function:
+
+    * store_records - saves a run's observations in a sink, skipping
+        the ones already saved
+"""
+
+import abc
+import base64
+import json
+import os
+import sqlite3
+import threading
+
+import metrics
+from blob_store import BlobStore
+from image_pack import camera_source
+from stations import StationRegistry
+from index_mapping import PROPERTIES
+
+# the number of observations sent in each bulk request to Elasticsearch
+CHUNK_SIZE = 500
+
+
+class Sink(abc.ABC):
+    """
+    The methods every sink has.  Subclasses must implement store.
+
+    ...
+
+    Methods
+    -------
+    'ensure()'
+        Gets the sink ready (e.g. creates the index or tables).  Returns
+        True if observations can be saved.
+    'store(record)'
+        Saves one observation.  Returns True if it was saved, or False
+        if it had already been saved.  Raises an exception if it
+        couldn't be saved.
+    'store_many(records)'
+        Saves a batch of observations.  Returns the number saved and a
+        list of the document ids of the observations that couldn't be
+        saved (observations that had already been saved aren't
+        failures).
+    'close()'
+        Closes any connections.
+    """
+
+    def ensure(self):
+        return True
+
+    @abc.abstractmethod
+    def store(self, record):
+        pass
+
+    def store_many(self, records):
+        created = 0
+        failed = []
+        for record in records:
+            try:
+                created += self.store(record)
+            except Exception as ex:
+                print('Error in storing ' + str(record.doc_id) + ': ' + str(ex))
+                failed.append(record.doc_id)
+        return created, failed
+
+    def close(self):
+        pass
+
+
+class ElasticsearchSink(Sink):
+    """
+    A class to save observations in an Elasticsearch index.
+
+    ...
+
+    Attributes
+    ----------
+    'es_object' : Elasticsearch
+        The Elasticsearch client.
+    'index_name' : str
+        The index (or write alias) observations are saved in.
+    'prepare' : function or None
+        Called with (es_object, index_name) by ensure() to create the
+        index; returns True if the index is ready.
+    'search_index' : str or None
+        If set, the index or alias (e.g. index_admin.READ_ALIAS) searched
+        for observations that are already saved before saving them, so
+        an observation saved before a rollover isn't saved again in the
+        new partition (see index_admin.existing_ids).
+    """
+
+    def __init__(self, es_object, index_name, prepare=None, search_index=None):
+        self.es_object = es_object
+        self.index_name = index_name
+        self.prepare = prepare
+        self.search_index = search_index
+
+    def _unsaved(self, records):
+        # the observations not already saved in another partition
+        if self.search_index is None:
+            return records
+        from index_admin import existing_ids
+
+        records = list(records)
+        found = existing_ids(self.es_object, [r.doc_id for r in records], self.search_index)
+        return [r for r in records if r.doc_id not in found]
+
+    def ensure(self):
+        if self.prepare is None:
+            return True
+        return self.prepare(self.es_object, self.index_name)
+
+    def store(self, record):
+        from elasticsearch import ConflictError
+
+        if not self._unsaved([record]):
+            return False
+        try:
+            # op_type='create' never overwrites an existing document
+            self.es_object.index(index=self.index_name, id=record.doc_id,
+                                 body=record.to_dict(), op_type='create')
+        except ConflictError:
+            # 409: a document with this id is already in the index
+            return False
+        return True
+
+    def store_many(self, records):
+        from elasticsearch import helpers
+
+        actions = ({"_op_type": "create", "_index": self.index_name,
+                    "_id": r.doc_id, "_source": r.to_dict()} for r in self._unsaved(records))
+        created = 0
+        failed = []
+        for ok, item in helpers.streaming_bulk(self.es_object, actions, chunk_size=CHUNK_SIZE,
+                                               raise_on_error=False):
+            info = item.get("create", {})
+            if ok:
+                created += 1
+            elif info.get("status") != 409:
+                print('Error in indexing data: ' + str(item))
+                failed.append(info.get("_id"))
+        return created, failed
+
+    def close(self):
+        self.es_object.transport.close()
+
+
+# the columns of the observations table: every numeric field of the
+# mapping has its own column (so it can be searched and compared), the
+# rest of the observation is kept as json in `data`
+_COLUMN_TYPES = {"float": "REAL", "integer": "INTEGER"}
+NUMERIC_COLUMNS = tuple(name for name, spec in PROPERTIES.items()
+                        if spec["type"] in _COLUMN_TYPES and name != "wmo")
+COLUMNS = ("doc_id", "wmo", "time", "local_date_time_full", "image_sha256") + NUMERIC_COLUMNS + ("data",)
+_IMAGE_COLUMNS = tuple(name for name in COLUMNS if name.startswith("image_"))
+
+
+class SQLiteSink(Sink):
+    """
+    A class to save observations in a SQLite database.
+
+    ...
+
+    Attributes
+    ----------
+    'path' : str
+        The database file.
+    'image_store' : BlobStore or PackStore
+        Where images are saved.  Defaults to a folder next to the
+        database ("weather_images" for "weather.db").
+    'registry' : StationRegistry
+        The stations, to save each image under its camera as the
+        collector does (see image_pack.camera_source).  Defaults to the
+        station registry, read when the first image is saved.
+
+    Methods
+    -------
+    'query(wmo, start=None, end=None, limit=None)'
+        Returns a station's observations (most recent first) between
+        `start` and `end` (times in milliseconds since 1970, UTC).
+    'latest(wmo)'
+        Returns a station's most recent observation, or None.
+    """
+
+    def __init__(self, path="weather.db", image_store=None, registry=None):
+        self.path = path
+        self.image_store = image_store if image_store is not None else \
+            BlobStore(os.path.splitext(path)[0] + "_images")
+        self.registry = registry
+        self._lock = threading.Lock()
+        # one connection shared by the scheduler's threads, one at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only syncs to disk at checkpoints, which is
+        # still safe if the app crashes (only a power cut can lose the
+        # last transactions)
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # the same statement is used for every insert, so sqlite3 only
+        # prepares it once
+        self._insert = "INSERT OR IGNORE INTO observations (" + ", ".join(COLUMNS) + \
+                       ") VALUES (" + ", ".join("?" * len(COLUMNS)) + ")"
+
+    def ensure(self):
+        columns = ["doc_id TEXT PRIMARY KEY", "wmo INTEGER NOT NULL", "time INTEGER",
+                   "local_date_time_full TEXT", "image_sha256 TEXT"]
+        columns += [name + " " + _COLUMN_TYPES[PROPERTIES[name]["type"]] for name in NUMERIC_COLUMNS]
+        columns.append("data TEXT")
+        with self._lock, self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS observations (" + ", ".join(columns) + ")")
+            self._db.execute("CREATE INDEX IF NOT EXISTS observations_wmo_time "
+                             "ON observations (wmo, time)")
+        return True
+
+    def _row(self, record):
+        doc_id = record.doc_id
+        record = record.to_dict()
+        image = record.pop("local_image_b64", None)
+        if image:
+            # the image is saved in the image store, not the database
+            if self.registry is None:
+                self.registry = StationRegistry()
+            source = camera_source(record.get("wmo"), self.registry)
+            record.update(self.image_store.put(base64.b64decode(image), source=source))
+        row = [doc_id, record.pop("wmo", None), record.pop("epoch_date", None),
+               record.pop("local_date_time_full", None), record.pop("image_sha256", None)]
+        row += [record.pop(name, None) for name in NUMERIC_COLUMNS]
+        # everything else
+        row.append(json.dumps(record, separators=(",", ":")))
+        return row
+
+    def store_many(self, records):
+        rows = [self._row(record) for record in records]
+        if not rows:
+            return 0, []
+        # one transaction for the whole batch
+        with self._lock, self._db:
+            before = self._db.total_changes
+            self._db.executemany(self._insert, rows)
+            created = self._db.total_changes - before
+        return created, []
+
+    def store(self, record):
+        return self.store_many([record])[0] == 1
+
+    def _to_record(self, row):
+        record = json.loads(row[-1])
+        record.update(zip(COLUMNS[1:-1], row[1:-1]))
+        record["epoch_date"] = record.pop("time")
+        if record["image_sha256"] is None:
+            # no image was saved with the observation
+            for name in _IMAGE_COLUMNS:
+                del record[name]
+        return record
+
+    def query(self, wmo, start=None, end=None, limit=None):
+        sql = "SELECT " + ", ".join(COLUMNS) + " FROM observations WHERE wmo = ?"
+        args = [wmo]
+        if start is not None:
+            sql += " AND time >= ?"
+            args.append(start)
+        if end is not None:
+            sql += " AND time < ?"
+            args.append(end)
+        sql += " ORDER BY time DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def latest(self, wmo):
+        rows = self.query(wmo, limit=1)
+        return rows[0] if rows else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def store_records(sink, results, ledger=None):
+    # saves a run's observations in one batch (one bulk request or one
+    # transaction), returns the (station, observation) pairs that
+    # couldn't be saved
+    pending = []
+    for station, result in results:
+        if ledger is not None and ledger.is_stored(station.wmo, result.doc_id):
+            metrics.RECORDS.inc(outcome='skip')
+        else:
+            pending.append((station, result))
+    if not pending:
+        return []
+    with metrics.timed('store'):
+        created, failed = sink.store_many(r for _, r in pending)
+    failed = set(failed)
+    metrics.RECORDS.inc(created, outcome='success')
+    metrics.RECORDS.inc(len(pending) - created - len(failed), outcome='skip')
+    metrics.RECORDS.inc(len(failed), outcome='failure')
+    print(str(created) + ' observations saved, ' + str(len(failed)) + ' failed')
+    if ledger is not None:
+        for station, result in pending:
+            if result.doc_id not in failed:
+                ledger.record(station.wmo, result.doc_id)
+        ledger.flush()
+    return [(s, r) for s, r in pending if r.doc_id in failed]
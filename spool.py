@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+"""Durable Local Spool
+
+This script saves every downloaded observation to the local disk before
+it is sent to Elasticsearch, so observations are not lost while
+Elasticsearch is down (e.g. during maintenance).  A drainer sends the
+saved observations to Elasticsearch using the bulk API once it can be
+reached again.
+
+Observations are appended to "segment" files in a spool folder, one json
+document per line.  A new segment is started once the current one
+reaches `segment_bytes`.  Writes are flushed to disk (fsync) in batches
+rather than after every observation.  A checkpoint file records how far
+through the segments the drainer has got, and segments that have been
+completely sent to Elasticsearch are deleted.
+
+Observations that Elasticsearch refuses for good (e.g. a mapping error)
+are moved to a dead letter file (dead-letter.ndjson) in the spool folder
+with the error, so they aren't lost and can be sent again with
+`Spool.requeue_dead_letters()` once the problem is fixed.  Observations
+that fail for a reason that may go away (e.g. Elasticsearch is
+overloaded) aren't checkpointed, so they are sent again by the next
+drain.
+
+This script requires that `elasticsearch` be installed within the
+Python environment you are running this script in (for the drainer).
+
+This file can be imported as a module and contains the following
+classes:
+
+    * Spool - the append-only segment files and the checkpoint
+    * SpoolDrainer - sends saved observations to Elasticsearch
+"""
+
+import json
+import os
+import threading
+import time
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import ConnectionError, TransportError
+
+import metrics
+from index_admin import existing_ids
+
+
+class Spool:
+    """
+    A class to save observations to disk until they are stored in
+    Elasticsearch.
+
+    ...
+
+    Attributes
+    ----------
+    'directory' : str
+        The folder the segment files and checkpoint are saved in.
+    'segment_bytes' : int
+        The size a segment file can grow to before a new one is started.
+    'fsync_every' : int
+        The number of appends between each fsync (sync() can also be
+        called to fsync straight away, e.g. at the end of each run).
+
+    Methods
+    -------
+    'append(index_name, doc_id, source)'
+        Saves a document to be stored in `index_name` with id `doc_id`.
+    'sync()'
+        Makes sure everything appended so far is saved to disk.
+    'pending(limit)'
+        Returns up to `limit` saved documents that haven't been drained
+        yet, as a list of (position, document) pairs.
+    'commit(position)'
+        Records that everything up to `position` has been drained and
+        deletes any segment files that are no longer needed.
+    'dead_letter(documents)'
+        Saves documents that Elasticsearch refused (each with its
+        "error") to the dead letter file.
+    'requeue_dead_letters()'
+        Appends the documents in the dead letter file to the spool again
+        and empties the file.  Returns the number of documents.
+    'close()'
+        Saves everything to disk and closes the current segment file.
+    """
+
+    def __init__(self, directory="spool", segment_bytes=16 * 1024 * 1024, fsync_every=100):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+        self._checkpoint = self._load_checkpoint()
+        segments = self._segments()
+        self._number = max(segments[-1] if segments else 1, self._checkpoint[0])
+        path = self._segment_path(self._number)
+        if os.path.exists(path):
+            self._repair(path)
+        self._file = open(path, "ab")
+        self._unsynced = 0
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, "segment-%08d.ndjson" % number)
+
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".ndjson"):
+                numbers.append(int(name[8:-7]))
+        return sorted(numbers)
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.directory, "checkpoint.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                checkpoint = json.load(f)
+            return checkpoint["segment"], checkpoint["offset"]
+        segments = self._segments()
+        return (segments[0] if segments else 1), 0
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, "checkpoint.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self._checkpoint[0], "offset": self._checkpoint[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _repair(path):
+        # removes a half written last line left behind by a crash
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                f.truncate(end)
+
+    def append(self, index_name, doc_id, source):
+        line = json.dumps({"_index": index_name, "_id": doc_id, "_source": source},
+                          separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._lock:
+            if self._file.tell() and self._file.tell() + len(line) > self.segment_bytes:
+                self._rotate()
+            self._file.write(line)
+            metrics.BYTES.inc(len(line), source='spool')
+            metrics.PAYLOAD_BYTES.observe(len(line), kind='document')
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def _rotate(self):
+        self.sync()
+        self._file.close()
+        self._number += 1
+        self._file = open(self._segment_path(self._number), "ab")
+
+    def pending(self, limit=500):
+        with self._lock:
+            self._file.flush()
+            number, offset = self._checkpoint
+            last = self._number
+        result = []
+        while number <= last and len(result) < limit:
+            path = self._segment_path(number)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    while len(result) < limit:
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        result.append(((number, offset), json.loads(line)))
+            if len(result) < limit and number < last:
+                number, offset = number + 1, 0
+            else:
+                break
+        return result
+
+    def commit(self, position):
+        with self._lock:
+            self._checkpoint = position
+            self._save_checkpoint()
+            for number in self._segments():
+                if number < position[0] and number != self._number:
+                    os.remove(self._segment_path(number))
+
+    def _dead_letter_path(self):
+        return os.path.join(self.directory, "dead-letter.ndjson")
+
+    def dead_letter(self, documents):
+        if not documents:
+            return
+        with self._lock:
+            with open(self._dead_letter_path(), "ab") as f:
+                for document in documents:
+                    f.write(json.dumps(document, separators=(",", ":")).encode("utf-8") + b"\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def requeue_dead_letters(self):
+        path = self._dead_letter_path()
+        with self._lock:
+            if not os.path.exists(path):
+                return 0
+            self._repair(path)
+            count = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    document = json.loads(line)
+                    self.append(document["_index"], document["_id"], document["_source"])
+                    count += 1
+            self.sync()
+            os.remove(path)
+            return count
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._file.close()
+
+
+def _retryable(status):
+    # statuses of bulk items that may succeed if they are sent again
+    # (no status means the item wasn't answered at all)
+    return status is None or status == 429 or status >= 500
+
+
+class SpoolDrainer:
+    """
+    A class to send the observations saved in a Spool to Elasticsearch.
+
+    ...
+
+    Attributes
+    ----------
+    'spool' : Spool
+        The spool to send observations from.
+    'es_object' : Elasticsearch
+        The Elasticsearch client to send observations to.
+    'batch_size' : int
+        The number of observations sent in each bulk request.
+    'max_retries' : int
+        The number of times a bulk request is retried (waiting longer
+        each time) before giving up until the next drain.
+    'backoff' : float
+        The number of seconds to wait before the first retry.
+    'ledger' : StoredIdLedger or None
+        If set, the last observation stored for each station is recorded
+        in the ledger (see ledger.py).
+    'search_index' : str or None
+        If set, the index or alias (e.g. index_admin.READ_ALIAS) searched
+        for observations that are already saved before sending them, so
+        an observation saved before a rollover isn't saved again in the
+        new partition (see index_admin.existing_ids).
+
+    Methods
+    -------
+    'drain()'
+        Sends every saved observation to Elasticsearch, up to the first
+        one that failed for a reason that may go away.  Returns the
+        number of observations that were sent.
+    """
+
+    def __init__(self, spool, es_object, batch_size=500, max_retries=3, backoff=2.0, ledger=None,
+                 search_index=None):
+        self.spool = spool
+        self.es_object = es_object
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.ledger = ledger
+        self.search_index = search_index
+        self._lock = threading.Lock()
+
+    def _send(self, batch):
+        actions = [{"_op_type": "create", "_index": d["_index"], "_id": d["_id"],
+                    "_source": d["_source"]} for _, d in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                found = set()
+                if self.search_index is not None:
+                    # observations already saved in another partition
+                    # are answered as if "create" had refused them
+                    found = existing_ids(self.es_object, [a["_id"] for a in actions],
+                                         self.search_index)
+                # 429 (too many requests) responses are retried by
+                # streaming_bulk itself
+                return [(False, {"create": {"_id": i, "status": 409}}) for i in found] + \
+                    list(helpers.streaming_bulk(self.es_object,
+                                                [a for a in actions if a["_id"] not in found],
+                                                chunk_size=self.batch_size,
+                                                raise_on_error=False,
+                                                max_retries=self.max_retries,
+                                                initial_backoff=self.backoff))
+            except (ConnectionError, TransportError) as ex:
+                if attempt == self.max_retries:
+                    print('Elasticsearch unavailable, observations kept in spool')
+                    print(str(ex))
+                    return None
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def drain(self):
+        total = 0
+        # only one drain at a time, so observations aren't sent twice
+        with self._lock:
+            while True:
+                batch = self.spool.pending(self.batch_size)
+                if not batch:
+                    return total
+                with metrics.timed('es_index'):
+                    results = self._send(batch)
+                if results is None:
+                    return total
+                # retried items can come back out of order, so results
+                # are matched to documents by id
+                items = {}
+                for ok, item in results:
+                    info = item.get("create", {})
+                    items[info.get("_id")] = (ok, info.get("status"), item)
+                done = 0
+                dead = []
+                for _, document in batch:
+                    ok, status, item = items.get(document["_id"], (False, None, None))
+                    if not ok and status != 409 and _retryable(status):
+                        # e.g. Elasticsearch is overloaded; this document
+                        # and the ones after it are sent again next drain
+                        print('Error in indexing data, will retry: ' + str(item))
+                        break
+                    done += 1
+                    if ok:
+                        total += 1
+                        metrics.RECORDS.inc(outcome='success')
+                    elif status == 409:
+                        metrics.RECORDS.inc(outcome='skip')
+                    else:
+                        # e.g. a mapping error; retrying won't help, so
+                        # the document is kept in the dead letter file
+                        metrics.RECORDS.inc(outcome='failure')
+                        print('Error in indexing data: ' + str(item))
+                        dead.append(dict(document, error=item))
+                        continue
+                    if self.ledger is not None:
+                        self.ledger.record(document["_source"].get("wmo"), document["_id"])
+                if self.ledger is not None:
+                    self.ledger.flush()
+                self.spool.dead_letter(dead)
+                if not done:
+                    return total
+                self.spool.commit(batch[done - 1][0])
+                if done < len(batch):
+                    return total
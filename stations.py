@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""Station Registry
+
+This script keeps track of every location the weather app downloads
+data for.  Each location ("station") is identified by its WMO number and
+has a BOM data URL, an optional camera image URL and a timezone.
+
+The stations are saved in a json file (`stations.json` by default) so
+new locations can be added by editing that file rather than by copying
+a URL module for every location (or found automatically, see
+discovery.py).  An example entry is:
+
+    {"wmo": 99435, "name": "Toowoomba Wellcamp Airport",
+     "data_url": "http://www.bom.gov.au/fwo/IDQ60801/IDQ60801.99435.json",
+     "image_url": "https://weathercams.airservicesaustralia.com/...jpg",
+     "timezone": "Australia/Brisbane"}
+
+This script only requires modules from the Python standard library.
+
+This file can be imported as a module and contains the following
+classes:
+
+    * Station - the URLs and details of a single location
+    * StationRegistry - loads, updates and saves the list of stations
+"""
+
+import json
+import os
+
+
+DEFAULT_REGISTRY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "stations.json")
+
+
+class Station:
+    """
+    A class holding the details of a single weather station.
+
+    ...
+
+    Attributes
+    ----------
+    'wmo' : int
+        The World Meteorological Organization number of the station.
+    'name' : str
+        The name of the station.
+    'data_url' : str
+        The URL of the station's data in JSON format on the BOM website.
+    'image_url' : str or None
+        The URL of an image of the location, None if there is no camera.
+    'timezone' : str
+        The name of the timezone the station is in.
+    'lat', 'lon' : float or None
+        The location of the station in degrees (see discovery.py), None
+        if it isn't known.
+    """
+
+    def __init__(self, wmo, data_url, image_url=None, name="",
+                 timezone="Australia/Brisbane", lat=None, lon=None):
+        self.wmo = int(wmo)
+        self.name = name
+        self.data_url = data_url
+        self.image_url = image_url
+        self.timezone = timezone
+        self.lat = lat
+        self.lon = lon
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry["wmo"], entry["data_url"], entry.get("image_url"),
+                   entry.get("name", ""),
+                   entry.get("timezone", "Australia/Brisbane"),
+                   entry.get("lat"), entry.get("lon"))
+
+    def to_dict(self):
+        entry = {"wmo": self.wmo, "name": self.name,
+                 "data_url": self.data_url, "image_url": self.image_url,
+                 "timezone": self.timezone}
+        if self.lat is not None and self.lon is not None:
+            entry["lat"] = self.lat
+            entry["lon"] = self.lon
+        return entry
+
+    def __repr__(self):
+        return "Station(%d, %r)" % (self.wmo, self.name)
+
+
+class StationRegistry:
+    """
+    A class to load and save the list of stations to download data for.
+
+    ...
+
+    Attributes
+    ----------
+    'path' : str
+        The json file the stations are saved in.
+
+    Methods
+    -------
+    'load()'
+        Reads the stations from the registry file.
+    'save()'
+        Writes the stations back to the registry file.
+    'add(station)'
+        Adds a station, replacing any station with the same WMO number.
+    'get(wmo)'
+        Returns the station with the given WMO number (or None).
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY):
+        self.path = path
+        self._stations = {}
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path) as f:
+            entries = json.load(f)
+        self._stations = {}
+        for entry in entries:
+            station = Station.from_dict(entry)
+            self._stations[station.wmo] = station
+        return self
+
+    def save(self):
+        # written to a temporary file first so a crash can't leave a
+        # half written registry behind
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump([s.to_dict() for s in self], f, indent=4)
+            f.write("\n")
+        os.replace(tmp, self.path)
+
+    def add(self, station):
+        self._stations[station.wmo] = station
+
+    def get(self, wmo):
+        return self._stations.get(int(wmo))
+
+    def __iter__(self):
+        return iter(sorted(self._stations.values(), key=lambda s: s.wmo))
+
+    def __len__(self):
+        return len(self._stations)
+
+
+if __name__ == "__main__":
+    # prints the stations in the registry
+    for s in StationRegistry():
+        print("{:<8}{:<35}{}".format(s.wmo, s.name, s.data_url))
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""Guarded Downloads from the BOM and AirServices Websites
+
+Every download of weather data or a camera image goes through this
+script, so that one slow or dead website can't hold up a whole sweep:
+
+    * every request has a connect and a read timeout, and can also be
+        given a deadline (e.g. the time left in the station's time
+        budget) that the timeouts are cut down to
+    * if a request to a host takes longer than usual (longer than 95% of
+        its recent requests), a second identical request is sent
+        ("hedged") and whichever answers first is used.  The second
+        request takes a request of its own from the host's limit (see
+        HostLimiter in collector.py), and isn't sent if the host has
+        none free, so hedging never adds to the load on a busy host
+    * each host (and each camera) has a circuit breaker: after
+        FAILURE_THRESHOLD failures in a row (errors, timeouts or 5xx
+        responses) requests are refused straight away (CircuitOpenError)
+        for RESET_TIMEOUT seconds, then one request is let through to
+        test if it is back
+
+This script requires that `requests` be installed within the Python
+environment you are running this script in.
+
+This file can be imported as a module and contains the following:
+
+    * CircuitOpenError - raised instead of making a request to a host
+        whose circuit breaker is open
+    * CircuitBreaker - tracks the failures of each host
+    * LatencyTracker - tracks how long each host takes to answer
+    * Fetcher - makes guarded requests
+    * default_fetcher - the Fetcher shared by the whole app
+    * get - makes a guarded GET request with the default_fetcher
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics
+
+# seconds to wait for a connection, and between bytes of the answer
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+# a request is hedged once it has taken longer than this percentile of
+# the host's last LATENCY_SAMPLES requests (and at least
+# HEDGE_MIN_DELAY seconds); hosts with fewer than HEDGE_MIN_SAMPLES
+# requests aren't hedged
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_DELAY = 0.2
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+
+# failures in a row before a host's circuit breaker opens, and how long
+# (seconds) it stays open
+FAILURE_THRESHOLD = 3
+RESET_TIMEOUT = 300
+
+
+def _host(url):
+    return urlsplit(url).netloc
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of making a request to a host that is down."""
+
+
+class CircuitBreaker:
+    """
+    A class to stop requests being made to hosts (or any other key, e.g.
+    a camera's URL) that keep failing.
+
+    ...
+
+    Methods
+    -------
+    'allow(host)'
+        Returns True if a request can be made to the host.  While the
+        breaker is open only one test request is allowed every
+        `reset_timeout` seconds.
+    'success(host)'
+        Records a successful request, closing the breaker.
+    'failure(host)'
+        Records a failed request, opening the breaker after
+        `threshold` failures in a row.
+    'is_open(host)'
+        Returns True if requests to the host are being refused.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        # host -> [failures in a row, time the breaker opened or None]
+        self._hosts = {}
+
+    def allow(self, host):
+        with self._lock:
+            failures, opened = self._hosts.get(host, (0, None))
+            if opened is None:
+                return True
+            if self.clock() - opened >= self.reset_timeout:
+                # lets one request through to test the host, and waits
+                # another reset_timeout before the next test
+                self._hosts[host] = [failures, self.clock()]
+                return True
+            return False
+
+    def is_open(self, host):
+        with self._lock:
+            return self._hosts.get(host, (0, None))[1] is not None
+
+    def success(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def failure(self, host):
+        with self._lock:
+            failures, opened = self._hosts.get(host, (0, None))
+            failures += 1
+            if opened is None and failures >= self.threshold:
+                print('Circuit breaker opened for ' + host)
+                opened = self.clock()
+            self._hosts[host] = [failures, opened]
+
+
+class LatencyTracker:
+    """
+    A class to keep the time taken by each host's recent requests.
+
+    ...
+
+    Methods
+    -------
+    'add(host, seconds)'
+        Records the time taken by a request.
+    'percentile(host, p)'
+        Returns the p-th percentile of the host's recent request times,
+        or None if there aren't HEDGE_MIN_SAMPLES of them yet.
+    """
+
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def add(self, host, seconds):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = deque(maxlen=self.samples)
+            self._hosts[host].append(seconds)
+
+    def percentile(self, host, p):
+        with self._lock:
+            samples = sorted(self._hosts.get(host, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def _close_when_done(future):
+    # the answer of the request that lost a hedge isn't needed
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class Fetcher:
+    """
+    A class to make GET requests with timeouts, hedging and circuit
+    breakers.
+
+    ...
+
+    Attributes
+    ----------
+    'breaker' : CircuitBreaker
+        The circuit breakers of every host.
+    'latency' : LatencyTracker
+        The recent request times of every host.
+    'hedge' : bool
+        False never sends a second request.
+
+    Methods
+    -------
+    'get(session, url, deadline=None, breaker_key=None, limiter=None, **kwargs)'
+        Makes a GET request using `session`, as session.get(url,
+        **kwargs) does.  `deadline` is a time (time.monotonic) the
+        request must finish by.  `breaker_key` is the name of the
+        circuit breaker used, if it isn't the host (e.g. the URL of one
+        camera, as all of the cameras are on the same host).
+        `limiter` is the HostLimiter the request is made under; a
+        hedged request is only sent if the host has a request free.  Raises
+        CircuitOpenError if the host is down, or
+        requests.exceptions.Timeout if the request took too long.
+    """
+
+    def __init__(self, breaker=None, latency=None, hedge=True, max_workers=32):
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.latency = latency if latency is not None else LatencyTracker()
+        self.hedge = hedge
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+
+    def _timeout(self, timeout, deadline):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        if connect is None:
+            connect, read = CONNECT_TIMEOUT, READ_TIMEOUT
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout('Out of time before the request was made')
+            connect, read = min(connect, remaining), min(read, remaining)
+        return connect, read
+
+    def _hedged(self, session, url, delay, kwargs, limiter=None):
+        # the first request is given `delay` seconds before a second,
+        # identical request is sent; the first answer is used
+        first = self._pool.submit(session.get, url, **kwargs)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        # the first request already holds one of the host's requests, so
+        # the second needs one of its own
+        if limiter is not None and not limiter.try_acquire(url):
+            metrics.UPSTREAM_EVENTS.inc(event='hedge_skipped', host=_host(url))
+            return first.result()
+        metrics.UPSTREAM_EVENTS.inc(event='hedge', host=_host(url))
+        second = self._pool.submit(session.get, url, **kwargs)
+        if limiter is not None:
+            # given back when the second request finishes, even if it lost
+            second.add_done_callback(lambda future: limiter.release(url))
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        metrics.UPSTREAM_EVENTS.inc(event='hedge_won', host=_host(url))
+                    for other in pending:
+                        other.add_done_callback(_close_when_done)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def get(self, session, url, deadline=None, timeout=None, breaker_key=None, limiter=None,
+            **kwargs):
+        host = _host(url)
+        key = breaker_key or host
+        if not self.breaker.allow(key):
+            metrics.UPSTREAM_EVENTS.inc(event='circuit_open', host=host)
+            raise CircuitOpenError('Circuit breaker is open for ' + key)
+        kwargs["timeout"] = self._timeout(timeout, deadline)
+
+        delay = self.latency.percentile(host, HEDGE_PERCENTILE) if self.hedge else None
+        start = time.perf_counter()
+        try:
+            if delay is None:
+                response = session.get(url, **kwargs)
+            else:
+                response = self._hedged(session, url, max(delay, HEDGE_MIN_DELAY), kwargs,
+                                        limiter)
+        except requests.exceptions.RequestException as ex:
+            if isinstance(ex, requests.exceptions.Timeout):
+                metrics.UPSTREAM_EVENTS.inc(event='timeout', host=host)
+            self.breaker.failure(key)
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.failure(key)
+        else:
+            self.breaker.success(key)
+            self.latency.add(host, time.perf_counter() - start)
+        return response
+
+
+default_fetcher = Fetcher()
+
+
+def get(session, url, **kwargs):
+    return default_fetcher.get(session, url, **kwargs)
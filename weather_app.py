@@ -3,67 +3,106 @@
 """ NOTE: THIS IS A DRAFT ONLY VERSION OF THIS FILE
 linked modules not all uploaded yet so don't try to run """
 
-import json
 import logging
-from pprint import pprint
-import requests
-from elasticsearch import Elasticsearch
-from datetime import datetime
-from apscheduler.schedulers.blocking import BlockingScheduler
-from dl_data import *
+import os
+from collector import Collector, PER_HOST
+from cadence import CadenceScheduler
+import latest_cache
+from change_detection import NOT_MODIFIED, default_tracker
+from ledger import StoredIdLedger
+import sessions
+from index_mapping import index_body
+from image_pack import open_store
+from sinks import ElasticsearchSink, SQLiteSink, store_records
+import index_admin
+import metrics
 # from time import sleep
 
+# where observations are saved (see sinks.py): 'elasticsearch', or
+# 'sqlite' to save them in the SQLite database SQLITE_PATH for sites
+# without an Elasticsearch cluster (the spool, rollups and partitions
+# are only used with Elasticsearch)
+SINK = 'elasticsearch'
+SQLITE_PATH = 'weather.db'
 
-def create_index(es_object, index_name):
+# folder to save camera images in (see blob_store.py) instead of putting
+# the base64 encoded image into every document; None keeps the images
+# in the documents as local_image_b64.  A relative folder is in the
+# folder of this file, not the current directory, so the export and
+# import tools in other_features find the same images
+IMAGE_STORE_DIR = None
+# True saves the images in IMAGE_STORE_DIR as one append-only pack per
+# camera (see image_pack.py), so a camera's frames can be read back by
+# time, e.g. for a timelapse
+IMAGE_PACKS = False
+
+# folder every downloaded observation is saved in until it has been
+# stored in Elasticsearch (see spool.py), and how often (in seconds) the
+# saved observations are sent to Elasticsearch
+SPOOL_DIR = 'spool'
+DRAIN_INTERVAL = 15
+
+# True saves observations into monthly/size based partitions through the
+# index_admin.WRITE_ALIAS alias (see index_admin.py), with queries made
+# across the index_admin.READ_ALIAS alias; False saves everything into
+# the single index weather_index
+PARTITIONED = True
+INDEX_NAME = index_admin.WRITE_ALIAS if PARTITIONED else 'weather_index'
+
+# names of the indices that have been checked/created by this process,
+# so the index only has to be checked once rather than on every run
+_ready_indices = set()
+
+# True only downloads each station when a new observation is due (see
+# cadence.py), checking which stations are due every POLL_TICK seconds;
+# False downloads every station every 60 seconds
+ADAPTIVE = True
+POLL_TICK = 5
+
+# the number of requests made to one website at the same time (see
+# collector.py); every station's data is on the BOM website, so with
+# ADAPTIVE = False and hundreds of stations a higher limit makes each
+# sweep faster, at the cost of more load on the BOM website
+PER_HOST_LIMIT = PER_HOST
+
+# port the metrics (see metrics.py) are served on at /metrics, and a file
+# they are also written to every METRICS_INTERVAL seconds; None turns
+# either off
+METRICS_PORT = 9465
+METRICS_FILE = None
+METRICS_INTERVAL = 15
+
+# True keeps hourly and daily rollups of each station's observations in
+# the rollups.ROLLUP_INDEX index (see rollups.py)
+ROLLUPS = True
+
+# port the latest conditions of each station are served on as JSON (see
+# latest_cache.py); None turns it off
+CACHE_PORT = 8081
+
+
+def image_store_path(root=None):
+    # the folder of the image store (IMAGE_STORE_DIR, or `root`), or None
+    # if images are kept in the documents
+    root = root or IMAGE_STORE_DIR
+    if not root:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), root)
+
+
+def open_image_store(root=None, packs=None):
+    # the image store set by IMAGE_STORE_DIR and IMAGE_PACKS (or `root`
+    # and `packs`), or None if images are kept in the documents
+    path = image_store_path(root)
+    if path is None:
+        return None
+    return open_store(path, IMAGE_PACKS if packs is None else packs)
+
+
+def create_index(es_object, index_name, body=None):
     created = False
-    # index settings
-    var_to_name = {
-        "settings": {
-            "number_of_shards": 1,
-            "number_of_replicas": 0
-        },
-        "mappings": {
-            "observation": {
-                "properties": {
-                    "wmo": {"type": "integer"},
-                    "name": {"type": "text"},
-                    "history_product": {"type": "text"},
-                    "local_date_time": {"type": "text"},
-                    "local_date_time_full": {"type": "date"},
-                    "aifstime_utc": {"type": "date"},
-                    "lat": {"type": "float"},
-                    "lon": {"type": "float"},
-                    "apparent_t": {"type": "float"},
-                    "cloud": {"type": "text"},
-                    "cloud_base_m": {"type": "text"},
-                    "cloud_oktas": {"type": "integer"},
-                    "cloud_type": {"type": "text"},
-                    "cloud_type_id": {"type": "text"},
-                    "delta_t": {"type": "float"},
-                    "gust_kmh": {"type": "integer"},
-                    "gust_kt": {"type": "integer"},
-                    "air_temp": {"type": "float"},
-                    "dewpt": {"type": "float"},
-                    "press": {"type": "float"},
-                    "press_msl": {"type": "float"},
-                    "press_qnh": {"type": "float"},
-                    "press_tend": {"type": "text"},
-                    "rain_trace": {"type": "float"},
-                    "rel_hum": {"type": "integer"},
-                    "sea_state": {"type": "text"},
-                    "swell_dir_worded": {"type": "text"},
-                    "swell_height": {"type": "text"},
-                    "swell_period": {"type": "text"},
-                    "vis_km": {"type": "text"},
-                    "weather": {"type": "text"},
-                    "wind_dir": {"type": "keyword"},
-                    "wind_spd_kmh": {"type": "integer"},
-                    "wind_spd_kt": {"type": "integer"},
-                    "local_image_b64": {"type": "text"}
-                }
-            }
-        }
-    }
+    # index settings (see index_mapping.py)
+    var_to_name = body if body is not None else index_body()
 
     try:
         if not es_object.indices.exists(index_name):
@@ -77,26 +116,41 @@ def create_index(es_object, index_name):
         return created
 
 
-def store_record(elastic_object, index_name, record):
-    is_stored = True
-    try:
-        result = eval(str(get_data()))
-        my_id = str((result['local_date_time_full']))
-        elastic_object.index(index=index_name, id=my_id, body=record)  # doc_type='observation',
-        # id=my_id,
-#        print(outcome)
-        print('Data indexed successfully')
-    except Exception as ex:
-        print('Error in indexing data')
-        print(str(ex))
-        is_stored = False
-    finally:
-        return is_stored
+def ensure_index(es_object, index_name):
+    import rollups
+
+    # only asks Elasticsearch about the index until it has been found or
+    # created once (e.g. if Elasticsearch was down when the app started)
+    if index_name not in _ready_indices:
+        if index_name == index_admin.WRITE_ALIAS:
+            # index template, first partition and aliases
+            ready = index_admin.setup(es_object)
+        elif index_name == rollups.ROLLUP_INDEX:
+            ready = create_index(es_object, index_name, rollups.rollup_body())
+        else:
+            ready = create_index(es_object, index_name)
+        if ready:
+            _ready_indices.add(index_name)
+    return index_name in _ready_indices
+
+
+def rollover_partitions(es):
+    # starts a new partition once the current one is too old or too big
+    if PARTITIONED and ensure_index(es, INDEX_NAME):
+        try:
+            index_admin.rollover(es)
+        except Exception as ex:
+            print('Error in rolling over partitions')
+            print(str(ex))
 
 
 def connect_elasticsearch():
+    from elasticsearch import Elasticsearch
+
     _es = None
-    _es = Elasticsearch([{'host': 'localhost', 'port': 9200}])
+    # the client keeps a pool of connections, so it is created once and
+    # shared by every scheduled run (maxsize = connections per node)
+    _es = Elasticsearch([{'host': 'localhost', 'port': 9200}], maxsize=16)
     if _es.ping():
         print('Connected successfully')
     else:
@@ -104,51 +158,206 @@ def connect_elasticsearch():
     return _es
 
 
-def get_data():
-    weather_data = {}
-    # what happens if data download fails???
-    try:
-        weather_data = DownloadData().dl_weather(data_url, image_url)
-        print('Data downloaded successfully')
+def get_data(collector=None, stations=None):
+    # Downloads every station in the registry (or only `stations`)
+    # concurrently, returns a list of (station, observation) pairs;
+    # observation is None if the download for that station failed
+    if collector is None:
+        collector = Collector()
+    weather_data = collector.collect(stations)
+    metrics.RECORDS.inc(sum(1 for _, r in weather_data if r is None), outcome='failure')
+    metrics.RECORDS.inc(sum(1 for _, r in weather_data if r is NOT_MODIFIED), outcome='skip')
+    print('Data downloaded for ' + str(sum(1 for _, r in weather_data if r)) +
+          ' of ' + str(len(weather_data)) + ' stations, ' +
+          str(sum(1 for _, r in weather_data if r is NOT_MODIFIED)) + ' unchanged')
+    print('Change detection: ' + str(default_tracker.stats()))
+    return weather_data
 
-    except Exception as ex:
-        print('Exception while getting data')
-        print(str(ex))
-        print("ERROR: " + str(ex.info))
 
-    finally:
-        return weather_data
+def spool_records(spool, index_name, results, ledger=None):
+    # saves the observations to disk, they are sent to Elasticsearch by
+    # drain_spool so downloading doesn't depend on Elasticsearch being up
+    for station, result in results:
+        if ledger is not None and ledger.is_stored(station.wmo, result.doc_id):
+            metrics.RECORDS.inc(outcome='skip')
+            continue
+        spool.append(index_name, result.doc_id, result.to_dict())
+    spool.sync()
+    print(str(len(results)) + ' observations saved to spool')
+    return True
+
+
+def forget_unsaved(results, cadence=None):
+    # the change tracker remembers every download as seen, so stations
+    # whose observations couldn't be saved are forgotten again; otherwise
+    # they would be skipped as "unchanged" until the next observation
+    for station, _ in results:
+        default_tracker.forget(station.data_url)
+        if cadence is not None:
+            cadence.retry(station)
+
+
+def drain_spool(es, drainer):
+    # sends the observations saved in the spool to Elasticsearch
+    if ensure_index(es, INDEX_NAME):
+        sent = drainer.drain()
+        if sent:
+            print(str(sent) + ' observations sent to Elasticsearch')
+
+
+def flush_rollups(es, engine):
+    import rollups
 
+    # saves the hourly and daily rollups changed by new observations
+    if ensure_index(es, rollups.ROLLUP_INDEX):
+        saved = engine.flush()
+        if saved:
+            print(str(saved) + ' rollups saved')
 
-def new_download():
-    es = connect_elasticsearch()
-    # Get data from website:
-    result = eval(str(get_data()))
-    #        print(result)
+
+def new_download(sink, collector=None, ledger=None, spool=None, cadence=None, rollup_engine=None):
+    # with a cadence only the stations due a new observation are
+    # downloaded, so most runs have nothing to do
+    stations = None
+    if cadence is not None:
+        if collector is None:
+            collector = Collector()
+        stations = cadence.due(collector.stations)
+        if not stations:
+            return True
+    # times the whole run, so runs that are slow can be seen in metrics
+    with metrics.timed('sweep'):
+        return _new_download(sink, collector, ledger, spool, cadence, stations, rollup_engine)
+
+
+def _new_download(sink, collector=None, ledger=None, spool=None, cadence=None, stations=None,
+                  rollup_engine=None):
+    # sink (see sinks.py) is created when the app started, it is reused
+    # by every run rather than connecting again each time
+    # Get data from website (only once per run), unchanged stations
+    # (NOT_MODIFIED) are skipped without being encoded or indexed:
+    weather_data = get_data(collector, stations)
+    for station, result in weather_data:
+        expires = None
+        if cadence is not None:
+            cadence.update(station, result)
+            expires = cadence.expected_release(station)
+        # keeps the latest conditions for dashboards and dl_time
+        if result:
+            latest_cache.default_cache.put(station, result, expires)
+        elif result is NOT_MODIFIED and expires is not None:
+            latest_cache.default_cache.touch(station, expires)
+    results = [(s, r) for s, r in weather_data if r]
+    if not results:
+        print('No data to index')
+        return False
+    if rollup_engine is not None:
+        rollup_engine.add(r for _, r in results)
+    if spool is not None:
+        try:
+            return spool_records(spool, INDEX_NAME, results, ledger)
+        except Exception as ex:
+            print('Error in saving observations to spool')
+            print(str(ex))
+            forget_unsaved(results, cadence)
+            return False
     # create index and stick data in it?
-    my_id = str((result['local_date_time_full']))
+    failed = results
     try:
-        if es is not None:
-            if create_index(es, 'weather_index'):
-                out = store_record(es, 'weather_index', result)
-                print('Index ' + str(my_id) + ' created\n')
-                return out
+        if sink is not None and sink.ensure():
+            failed = store_records(sink, results, ledger)
     except Exception as ex:
-        print('Error in creating record' + str(my_id))
+        print('Error in creating records')
         print(str(ex))
+    # so the same data isn't skipped as "unchanged" next run
+    forget_unsaved(failed, cadence)
+    return not failed
 
 
 if __name__ == '__main__':
+    # only needed when the app runs on its own schedule (see run_once.py
+    # for running it from cron or a systemd timer instead)
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    from backfill import backfill
+
     logging.basicConfig(level=logging.ERROR)
 
+    # connect and check the index once, the client, the HTTP session
+    # and the collector then live for as long as the app is running
+    image_store = open_image_store()
+    collector = Collector(per_host=PER_HOST_LIMIT, image_store=image_store)
+    ledger = StoredIdLedger()
+    cadence = CadenceScheduler() if ADAPTIVE else None
+    if SINK == 'sqlite':
+        es = None
+        sink = SQLiteSink(SQLITE_PATH, image_store=image_store)
+        spool = drainer = rollup_engine = None
+    else:
+        # only imported here, so the SQLite sink works without
+        # `elasticsearch` installed
+        import rollups
+        from spool import Spool, SpoolDrainer
+
+        es = connect_elasticsearch()
+        # observations saved before a rollover are looked for in every
+        # partition, as "create" only refuses them in the same partition
+        search_index = index_admin.READ_ALIAS if PARTITIONED else None
+        sink = ElasticsearchSink(es, INDEX_NAME, prepare=ensure_index, search_index=search_index)
+        spool = Spool(SPOOL_DIR)
+        drainer = SpoolDrainer(spool, es, ledger=ledger, search_index=search_index)
+        rollup_engine = None
+        if ROLLUPS:
+            rollup_engine = rollups.RollupEngine(
+                es, source_index=index_admin.READ_ALIAS if PARTITIONED else INDEX_NAME)
+
+    # fill in anything missed while the app wasn't running, BOM keeps
+    # the last ~72 hours of observations for each station
+    if sink.ensure():
+        backfill(es, INDEX_NAME, ledger=ledger, collector=collector, include_latest=False,
+                 search_index=index_admin.READ_ALIAS if PARTITIONED else None, cadence=cadence,
+                 rollups=rollup_engine, sink=sink if es is None else None)
+
+    # jobs run in the scheduler's default thread pool (in this process)
+    # so the connections above are reused by every run
     scheduler = BlockingScheduler()
-    scheduler.add_executor('processpool')
-    scheduler.add_job(new_download, 'interval', seconds=60, misfire_grace_time=3)
+    # records how late each run starts and which runs are missed
+    metrics.watch_scheduler(scheduler)
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    if CACHE_PORT:
+        latest_cache.start_http_server(port=CACHE_PORT)
+    if METRICS_FILE:
+        scheduler.add_job(metrics.write_file, 'interval', args=[METRICS_FILE],
+                          seconds=METRICS_INTERVAL)
+    scheduler.add_job(new_download, 'interval', args=[sink],
+                      kwargs={'collector': collector, 'ledger': ledger, 'spool': spool,
+                              'cadence': cadence, 'rollup_engine': rollup_engine},
+                      seconds=POLL_TICK if ADAPTIVE else 60, misfire_grace_time=3, max_instances=1)
+    if drainer is not None:
+        scheduler.add_job(drain_spool, 'interval', args=[es, drainer],
+                          seconds=DRAIN_INTERVAL, max_instances=1)
+    if rollup_engine is not None:
+        scheduler.add_job(flush_rollups, 'interval', args=[es, rollup_engine],
+                          seconds=DRAIN_INTERVAL, max_instances=1)
+    if es is not None:
+        scheduler.add_job(rollover_partitions, 'interval', args=[es], hours=1)
     print('Press Ctrl+C to exit')
 
     try:
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        if rollup_engine is not None:
+            rollup_engine.flush()
+        if spool is not None:
+            spool.close()
+        collector.close()
+        ledger.flush()
+        sink.close()
+        if image_store is not None:
+            image_store.close()
+        sessions.close_session()
 
 